@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+End-to-end benchmark of the collage filter: a local thumbor app, configured
+like the tests, serves collages of the fixtures in tests/fixtures/filters.
+For each mode, size and number of tiles it measures the latency
+percentiles of sequential requests, the throughput of concurrent ones, the
+mean time of each stage reported to the metrics, the tracemalloc peak of a
+single request and the peak RSS of the process so far. Collages are sent
+as JPEG, so the PNG encoding of the base image does not dominate them.
+
+    python -m benchmarks.collage [--requests N] [--concurrency N]
+                                 [--modes http,local] [--json PATH]
+                                 [--baseline PATH]
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import subprocess
+import time
+import tracemalloc
+from collections import defaultdict
+from os.path import dirname, join
+
+from thumbor.app import ThumborServiceApp
+from thumbor.config import Config
+from thumbor.context import Context, ServerParameters
+from thumbor.importer import Importer
+from thumbor.metrics import BaseMetrics
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+FIXTURES = join(dirname(__file__), "..", "tests", "fixtures", "filters")
+SOURCES = (
+    "800px-Guido-portrait-2014.jpg",
+    "800px-Katherine_Maher.jpg",
+    "Giunchedi%2C_Filippo_January_2015_01.jpg",
+    "800px-Christophe_Henner_-_June_2016.jpg",
+    "800px-Coffee_berries_1.jpg",
+    "800px-A_small_cup_of_coffee.JPG",
+)
+SIZES = ((300, 200), (1200, 800), (0, 0))
+TILES = (1, 2, 4)
+
+
+class StageMetrics(BaseMetrics):
+    """Keeps the timings of the collage stages reported by every request."""
+
+    timings = defaultdict(list)
+
+    def incr(self, metricname, value=1):
+        pass
+
+    def timing(self, metricname, value):
+        # leaves the timings of each tile slot out
+        if metricname.startswith("distributed_collage.") and metricname.count(".") <= 2:
+            StageMetrics.timings[metricname].append(value)
+
+
+def make_server(mode):
+    config = Config(
+        DETECTORS=["thumbor.detectors.face_detector"],
+        FILTERS=[
+            "thumbor.filters.format",
+            "thumbor_distributed_collage_filter.filter",
+        ],
+        DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER="thumbor.loaders.http_loader",
+        DISTRIBUTED_COLLAGE_FILTER_MODE=mode,
+        LOADER="thumbor.loaders.file_loader",
+        FILE_LOADER_ROOT_PATH=FIXTURES,
+    )
+    importer = Importer(config)
+    importer.import_modules()
+    importer.metrics = StageMetrics
+
+    server = ServerParameters(None, "localhost", None, None, "ERROR", None)
+    server.security_key = "MY_SECURE_KEY"
+
+    sock, port = bind_unused_port()
+    http_server = HTTPServer(ThumborServiceApp(Context(server, config, importer)))
+    http_server.add_sockets([sock])
+    return http_server, port
+
+
+def get_url(port, size, count, index):
+    # a different set of sources for each request, so concurrent requests
+    # are not coalesced into a single collage
+    sources = [SOURCES[(index + offset) % len(SOURCES)] for offset in range(count)]
+    return (
+        "http://localhost:%d/unsafe/%dx%d/filters:format(jpeg):distributed_collage"
+        "(horizontal,smart,%s)/distributed_collage_fallback.png"
+        % (port, size[0], size[1], "|".join(sources))
+    )
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+async def fetch(client, url):
+    start = time.perf_counter()
+    response = await client.fetch(url, raise_error=False)
+    if response.code != 200:
+        raise RuntimeError("%s returned %d" % (url, response.code))
+    return (time.perf_counter() - start) * 1000
+
+
+async def measure(client, port, size, count, requests, concurrency):
+    # warm the detector data of the storage and the imports up
+    for index in range(len(SOURCES)):
+        await fetch(client, get_url(port, size, count, index))
+
+    StageMetrics.timings.clear()
+    latencies = []
+    for index in range(requests):
+        latencies.append(await fetch(client, get_url(port, size, count, index)))
+    stages = {
+        name.split(".", 1)[1]: round(sum(values) / len(values), 3)
+        for name, values in StageMetrics.timings.items()
+    }
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(index):
+        async with semaphore:
+            await fetch(client, get_url(port, size, count, index))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[bounded(index) for index in range(requests)])
+    throughput = requests / (time.perf_counter() - start)
+
+    tracemalloc.start()
+    await fetch(client, get_url(port, size, count, 0))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "size": "%dx%d" % size,
+        "tiles": count,
+        "p50_ms": round(percentile(latencies, 0.5), 3),
+        "p90_ms": round(percentile(latencies, 0.9), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "throughput_rps": round(throughput, 3),
+        "stages_ms": stages,
+        "tracemalloc_peak_bytes": peak,
+        # kilobytes on Linux
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+async def run(modes, requests, concurrency):
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    results = []
+    for mode in modes:
+        http_server, port = make_server(mode)
+        try:
+            for size in SIZES:
+                for count in TILES:
+                    result = await measure(
+                        client, port, size, count, requests, concurrency
+                    )
+                    result["mode"] = mode
+                    results.append(result)
+        finally:
+            http_server.stop()
+    client.close()
+    return results
+
+
+def get_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=dirname(__file__),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)
+    return {
+        (row["mode"], row["size"], row["tiles"]): row for row in baseline["results"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--modes", default="http,local")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument(
+        "--baseline", help="results of a previous run to compare the p50 with"
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.modes.split(","), args.requests, args.concurrency))
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+
+    print(
+        "%-5s %-9s %5s %9s %9s %9s %9s %9s"
+        % ("mode", "size", "tiles", "p50 ms", "p90 ms", "p99 ms", "req/s", "vs base")
+    )
+    for row in results:
+        previous = baseline.get((row["mode"], row["size"], row["tiles"]))
+        change = ""
+        if previous is not None:
+            change = "%+.1f%%" % ((row["p50_ms"] / previous["p50_ms"] - 1) * 100)
+        print(
+            "%-5s %-9s %5d %9.3f %9.3f %9.3f %9.2f %9s"
+            % (
+                row["mode"],
+                row["size"],
+                row["tiles"],
+                row["p50_ms"],
+                row["p90_ms"],
+                row["p99_ms"],
+                row["throughput_rps"],
+                change,
+            )
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(
+                {
+                    "commit": get_commit(),
+                    "requests": args.requests,
+                    "concurrency": args.concurrency,
+                    "results": results,
+                },
+                output,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Compares compositing the decoded tiles of a collage with a merged
+engine.paste per tile against writing them into a single NumPy canvas.
+
+    python -m benchmarks.compositing [--rounds N] [--json PATH]
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+from os.path import dirname, join
+
+from thumbor.config import Config
+from thumbor.context import Context
+from thumbor.engines.pil import Engine
+
+from thumbor_distributed_collage_filter.canvas import Canvas, to_rgba
+
+FIXTURES = join(dirname(__file__), "..", "tests", "fixtures", "filters")
+SOURCES = (
+    "800px-Guido-portrait-2014.jpg",
+    "800px-Katherine_Maher.jpg",
+    "800px-Christophe_Henner_-_June_2016.jpg",
+    "800px-Coffee_berries_1.jpg",
+)
+SIZES = ((300, 200), (1200, 800))
+
+
+def make_tiles(context, count, size):
+    width, height = size
+    tile_width = width // count
+    tiles = []
+    for source in SOURCES[:count]:
+        with open(join(FIXTURES, source), "rb") as source_file:
+            engine = Engine(context)
+            engine.load(source_file.read(), None)
+        engine.resize(tile_width, height)
+        tiles.append(engine)
+    return tiles, tile_width
+
+
+def paste_per_tile(context, tiles, tile_width, size):
+    base = Engine(context)
+    base.image = base.gen_image(size, "white")
+    for index, engine in enumerate(tiles):
+        base.paste(engine, [index * tile_width, 0], merge=True)
+
+
+def numpy_canvas(context, tiles, tile_width, size):
+    base = Engine(context)
+    base.image = base.gen_image(size, "white")
+    canvas = Canvas(*size)
+    for index, engine in enumerate(tiles):
+        mode, data = engine.image_data_as_rgb()
+        canvas.paste(to_rgba(mode, data, engine.size), index * tile_width, 0)
+
+    result = Engine(context)
+    result.image = result.gen_image(size, "transparent")
+    result.set_image_data(canvas.pixels.tobytes())
+    base.image = result.image
+
+
+def measure(fn, rounds, *args):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(*args)
+    elapsed = (time.perf_counter() - start) * 1000 / rounds
+
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(elapsed, 3), peak
+
+
+def run(rounds):
+    context = Context(config=Config())
+    results = []
+    for size in SIZES:
+        for count in (1, 2, 4):
+            tiles, tile_width = make_tiles(context, count, size)
+            for name, fn in (("paste", paste_per_tile), ("numpy", numpy_canvas)):
+                elapsed, peak = measure(fn, rounds, context, tiles, tile_width, size)
+                results.append(
+                    {
+                        "method": name,
+                        "size": "%dx%d" % size,
+                        "tiles": count,
+                        "ms": elapsed,
+                        "peak_bytes": peak,
+                    }
+                )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args.rounds)
+
+    print("%-6s %-9s %5s %10s %12s" % ("method", "size", "tiles", "ms", "peak bytes"))
+    for row in results:
+        print(
+            "%-6s %-9s %5d %10.3f %12d"
+            % (row["method"], row["size"], row["tiles"], row["ms"], row["peak_bytes"])
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Compares decoding the source of a tile rendered in process at full size
+against decoding it at the smallest JPEG scale covering the tile. The
+pixels are read before the resize, as thumbor's smart detection does, and
+the memory reported is the size of the decoded image (PIL allocates it
+outside of tracemalloc's reach).
+
+    python -m benchmarks.decode [--rounds N] [--json PATH]
+"""
+
+import argparse
+import json
+import time
+from os.path import dirname, join
+
+from thumbor.config import Config
+from thumbor.context import Context
+from thumbor.engines.pil import Engine
+
+from thumbor_distributed_collage_filter.draft import draft
+
+FIXTURES = join(dirname(__file__), "..", "tests", "fixtures", "filters")
+SOURCES = (
+    "800px-Guido-portrait-2014.jpg",
+    "800px-Katherine_Maher.jpg",
+    "800px-Coffee_berries_1.jpg",
+)
+TILE_SIZES = ((75, 50), (75, 200), (150, 200), (300, 200))
+
+
+def decode(context, buffer, size, reduced):
+    """Returns the bytes of the decoded image."""
+    engine = Engine(context)
+    engine.load(buffer, None)
+    if reduced:
+        draft(engine, *size)
+
+    engine.image.load()
+    width, height = engine.size
+    decoded = width * height * len(engine.image.getbands())
+
+    engine.resize(*size)
+    return decoded
+
+
+def measure(context, buffer, size, reduced, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decoded = decode(context, buffer, size, reduced)
+    elapsed = (time.perf_counter() - start) * 1000 / rounds
+    return elapsed, decoded
+
+
+def run(rounds):
+    context = Context(config=Config())
+    buffers = []
+    for source in SOURCES:
+        with open(join(FIXTURES, source), "rb") as source_file:
+            buffers.append(source_file.read())
+
+    results = []
+    for size in TILE_SIZES:
+        for name, reduced in (("full", False), ("draft", True)):
+            total_ms = total_decoded = 0
+            for buffer in buffers:
+                elapsed, decoded = measure(context, buffer, size, reduced, rounds)
+                total_ms += elapsed
+                total_decoded += decoded
+
+            results.append(
+                {
+                    "decode": name,
+                    "tile": "%dx%d" % size,
+                    "ms": round(total_ms / len(buffers), 3),
+                    "decoded_bytes": total_decoded // len(buffers),
+                }
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args.rounds)
+
+    print("%-6s %-8s %10s %14s" % ("decode", "tile", "ms", "decoded bytes"))
+    for row in results:
+        print(
+            "%-6s %-8s %10.3f %14d"
+            % (row["decode"], row["tile"], row["ms"], row["decoded_bytes"])
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
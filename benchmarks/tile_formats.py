@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Measures the cost of each intermediate tile format: the bytes moved per
+tile and the time the tile server spends encoding it plus the time the
+collage spends decoding it again.
+
+    python -m benchmarks.tile_formats [--rounds N] [--json PATH]
+"""
+
+import argparse
+import json
+import time
+from os.path import dirname, join
+
+from thumbor.config import Config
+from thumbor.context import Context
+from thumbor.engines.pil import Engine
+
+FIXTURES = join(dirname(__file__), "..", "tests", "fixtures", "filters")
+SOURCES = (
+    "800px-Guido-portrait-2014.jpg",
+    "800px-Katherine_Maher.jpg",
+    "800px-Coffee_berries_1.jpg",
+    "PNG_transparency_demonstration_1.png",
+)
+TILE_SIZES = ((75, 200), (150, 200), (300, 400))
+
+# extension and quality thumbor uses to write each tile format
+FORMATS = {
+    "jpeg": (".jpg", 100),
+    "png": (".png", None),
+    "webp": (".webp", 100),
+}
+
+
+def make_tile(context, source, size):
+    with open(join(FIXTURES, source), "rb") as source_file:
+        buffer = source_file.read()
+
+    engine = Engine(context)
+    engine.load(buffer, None)
+    engine.resize(*size)
+    return engine
+
+
+def measure(context, tile, extension, quality, rounds):
+    encode_ms = decode_ms = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        buffer = tile.read(extension, quality)
+        encode_ms += (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        engine = Engine(context)
+        engine.load(buffer, None)
+        # PIL decodes lazily, force it the same way engine.paste does
+        engine.image_data_as_rgb()
+        decode_ms += (time.perf_counter() - start) * 1000
+
+    return len(buffer), encode_ms / rounds, decode_ms / rounds
+
+
+def run(rounds):
+    context = Context(config=Config())
+    results = []
+    for size in TILE_SIZES:
+        tiles = [make_tile(context, source, size) for source in SOURCES]
+        for name, (extension, quality) in FORMATS.items():
+            total_bytes = total_encode = total_decode = 0
+            for tile in tiles:
+                size_bytes, encode_ms, decode_ms = measure(
+                    context, tile, extension, quality, rounds
+                )
+                total_bytes += size_bytes
+                total_encode += encode_ms
+                total_decode += decode_ms
+
+            results.append(
+                {
+                    "format": name,
+                    "tile": "%dx%d" % size,
+                    "bytes": total_bytes // len(tiles),
+                    "encode_ms": round(total_encode / len(tiles), 3),
+                    "decode_ms": round(total_decode / len(tiles), 3),
+                }
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args.rounds)
+
+    print("%-6s %-8s %10s %10s %10s" % ("format", "tile", "bytes", "enc ms", "dec ms"))
+    for row in results:
+        print(
+            "%-6s %-8s %10d %10.3f %10.3f"
+            % (
+                row["format"],
+                row["tile"],
+                row["bytes"],
+                row["encode_ms"],
+                row["decode_ms"],
+            )
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -56,12 +56,13 @@ Distributed collage is a filter for creating side-by-side images.
         "thumbor>=7.0.0",
     ],
     extras_require={
+        # keep-alive connections of the tile loader
+        "curl": ["pycurl"],
         "tests": tests_require,
     },
     entry_points={
         "console_scripts": [
-            # add cli scripts here in this form:
-            # 'thumbor-distributed-collage-filter=thumbor_distributed_collage_filter.cli:main',
+            "thumbor-collage-warm=thumbor_distributed_collage_filter.warm:main",
         ],
     },
 )
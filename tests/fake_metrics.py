@@ -0,0 +1,34 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2011 globo.com thumbor@googlegroups.com
+
+from collections import defaultdict
+
+from thumbor.metrics import BaseMetrics
+
+
+class Metrics(BaseMetrics):
+    """
+    Collects the metrics sent by every context, use it with
+    METRICS = "tests.fake_metrics".
+    """
+
+    counters = defaultdict(int)
+    timings = defaultdict(list)
+
+    @classmethod
+    def reset(cls):
+        cls.counters.clear()
+        cls.timings.clear()
+
+    def incr(self, metricname, value=1):
+        Metrics.counters[metricname] += value
+
+    def timing(self, metricname, value):
+        Metrics.timings[metricname].append(value)
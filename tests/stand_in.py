@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2011 globo.com thumbor@googlegroups.com
+
+import asyncio
+from io import BytesIO
+
+from PIL import Image
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+
+def get_jpeg(color, size=(300, 200)):
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+class StandInHandler(RequestHandler):
+    def initialize(self, server):
+        self.server = server
+
+    async def get(self):
+        self.server.requests.append(self.request.path)
+        if "If-None-Match" in self.request.headers:
+            self.server.revalidations.append(self.request.path)
+        await asyncio.sleep(self.server.delay)
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(self.server.body)
+
+
+class StandInServer(object):
+    """
+    Stand-in of a thumbor tile server on the IOLoop of the test, answering
+    every request with a solid `color` JPEG after `delay` seconds. Like
+    thumbor, it sends an ETag and answers 304 to requests revalidating it.
+    """
+
+    def __init__(self, color, delay=0):
+        self.delay = delay
+        self.body = get_jpeg(color)
+        self.requests = []
+        self.revalidations = []
+
+        sock, port = bind_unused_port()
+        self.http_server = HTTPServer(
+            Application([(r"/.*", StandInHandler, {"server": self})])
+        )
+        self.http_server.add_sockets([sock])
+        self.url = "http://127.0.0.1:%d" % port
+
+    def stop(self):
+        self.http_server.stop()
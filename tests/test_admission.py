@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+import asyncio
+from unittest import TestCase
+
+from preggy import expect
+from thumbor.config import Config
+
+from thumbor_distributed_collage_filter import admission
+from thumbor_distributed_collage_filter.admission import (
+    MemoryBudget,
+    get_collage_bytes,
+    get_memory_budget,
+)
+from thumbor_distributed_collage_filter.layout import get_slots
+
+
+class GetCollageBytesTestCase(TestCase):
+    def test_counts_the_canvas_its_copy_and_the_tiles(self):
+        slots = get_slots("horizontal", 300, 200, 2)
+
+        expect(get_collage_bytes(300, 200, slots)).to_equal(3 * 300 * 200 * 4)
+
+    def test_counts_a_single_tile_when_streaming(self):
+        slots = get_slots("horizontal", 300, 200, 2)
+
+        expect(get_collage_bytes(300, 200, slots, streaming=True)).to_equal(
+            (2 * 300 * 200 + 150 * 200) * 4
+        )
+
+
+class MemoryBudgetTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.budget = MemoryBudget(100)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_admits_collages_within_the_budget(self):
+        expect(self.run_async(self.budget.acquire(60))).to_be_true()
+        expect(self.run_async(self.budget.acquire(40))).to_be_true()
+        expect(self.budget.in_flight).to_equal(100)
+
+        self.budget.release(60)
+        expect(self.budget.in_flight).to_equal(40)
+
+    def test_rejects_collages_larger_than_the_budget(self):
+        expect(self.run_async(self.budget.acquire(101))).to_be_false()
+        expect(self.budget.in_flight).to_equal(0)
+
+    def test_times_out_waiting_for_memory(self):
+        self.run_async(self.budget.acquire(60))
+
+        expect(self.run_async(self.budget.acquire(60, timeout=0.01))).to_be_false()
+        expect(self.budget.stats()).to_equal(
+            {"max_bytes": 100, "in_flight": 60, "waiting": 0}
+        )
+
+    def test_admits_waiting_collages_in_order(self):
+        async def scenario():
+            await self.budget.acquire(100)
+            admitted = []
+
+            async def acquire(name, nbytes):
+                await self.budget.acquire(nbytes)
+                admitted.append(name)
+
+            tasks = [
+                asyncio.ensure_future(acquire("first", 80)),
+                asyncio.ensure_future(acquire("second", 10)),
+            ]
+            await asyncio.sleep(0)
+            expect(self.budget.stats()["waiting"]).to_equal(2)
+
+            # the second one fits, but waits for the first one
+            self.budget.release(20)
+            await asyncio.sleep(0)
+            expect(admitted).to_be_empty()
+
+            self.budget.release(80)
+            await asyncio.gather(*tasks)
+            return admitted
+
+        expect(self.run_async(scenario())).to_equal(["first", "second"])
+        expect(self.budget.in_flight).to_equal(90)
+
+    def test_gives_back_the_memory_of_cancelled_waits(self):
+        async def scenario():
+            await self.budget.acquire(100)
+            task = asyncio.ensure_future(self.budget.acquire(50))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.sleep(0)
+            self.budget.release(100)
+
+        self.run_async(scenario())
+
+        expect(self.budget.stats()).to_equal(
+            {"max_bytes": 100, "in_flight": 0, "waiting": 0}
+        )
+
+
+class GetMemoryBudgetTestCase(TestCase):
+    def setUp(self):
+        admission.budgets.clear()
+
+    def test_is_disabled_by_default(self):
+        expect(get_memory_budget(Config())).to_be_null()
+
+    def test_shares_the_budget_of_the_process(self):
+        config = Config(DISTRIBUTED_COLLAGE_FILTER_MEMORY_BUDGET=1024)
+
+        budget = get_memory_budget(config)
+
+        expect(budget.max_bytes).to_equal(1024)
+        expect(get_memory_budget(config)).to_equal(budget)
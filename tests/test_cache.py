@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+import asyncio
+from unittest import TestCase
+
+from preggy import expect
+from thumbor.loaders import LoaderResult
+
+from thumbor_distributed_collage_filter.cache import (
+    LRUCache,
+    SingleFlight,
+    get_aged_cache_control,
+    get_ttl,
+    get_validators,
+    pack_tile,
+    parse_cache_control,
+    unpack_tile,
+)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTestCase(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(10, clock=self.clock)
+
+    def test_returns_stored_values(self):
+        self.cache.put("a", "value", 1, 60)
+
+        expect(self.cache.get("a")).to_equal("value")
+        expect(self.cache.get("b")).to_be_null()
+        expect(self.cache.hits).to_equal(1)
+        expect(self.cache.misses).to_equal(1)
+
+    def test_evicts_least_recently_used_values_over_the_size_limit(self):
+        self.cache.put("a", "a", 4, 60)
+        self.cache.put("b", "b", 4, 60)
+        self.cache.get("a")
+        self.cache.put("c", "c", 4, 60)
+
+        expect("a" in self.cache).to_be_true()
+        expect("b" in self.cache).to_be_false()
+        expect("c" in self.cache).to_be_true()
+        expect(self.cache.size).to_equal(8)
+        expect(self.cache.evictions).to_equal(1)
+
+    def test_does_not_store_values_bigger_than_the_cache(self):
+        self.cache.put("a", "a", 11, 60)
+
+        expect(len(self.cache)).to_equal(0)
+
+    def test_expires_values_after_their_ttl(self):
+        self.cache.put("a", "a", 1, 60)
+        self.clock.now = 59
+        expect(self.cache.get("a")).to_equal("a")
+
+        self.clock.now = 60
+        expect(self.cache.get("a")).to_be_null()
+        expect(self.cache.size).to_equal(0)
+
+    def test_does_not_store_values_without_ttl(self):
+        self.cache.put("a", "a", 1, 0)
+
+        expect(len(self.cache)).to_equal(0)
+
+    def test_replaces_values(self):
+        self.cache.put("a", "a", 4, 60)
+        self.cache.put("a", "b", 2, 60)
+
+        expect(self.cache.get("a")).to_equal("b")
+        expect(self.cache.size).to_equal(2)
+
+
+class SingleFlightTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.single_flight = SingleFlight()
+        self.calls = 0
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def compute(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return self.calls
+
+    async def fail(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    def gather(self, *calls, **kwargs):
+        async def run():
+            return await asyncio.gather(*calls, **kwargs)
+
+        return self.loop.run_until_complete(run())
+
+    def test_shares_the_result_of_concurrent_calls(self):
+        results = self.gather(
+            self.single_flight.do("a", self.compute),
+            self.single_flight.do("a", self.compute),
+            self.single_flight.do("b", self.compute),
+        )
+
+        expect(self.calls).to_equal(2)
+        expect(results[0]).to_equal(results[1])
+        expect(len(self.single_flight)).to_equal(0)
+
+    def test_runs_again_once_the_call_is_done(self):
+        self.loop.run_until_complete(self.single_flight.do("a", self.compute))
+        self.loop.run_until_complete(self.single_flight.do("a", self.compute))
+
+        expect(self.calls).to_equal(2)
+
+    def test_shares_errors_of_concurrent_calls(self):
+        results = self.gather(
+            self.single_flight.do("a", self.fail),
+            self.single_flight.do("a", self.fail),
+            return_exceptions=True,
+        )
+
+        expect(self.calls).to_equal(1)
+        expect(results[0]).to_be_instance_of(ValueError)
+        expect(results[1]).to_be_instance_of(ValueError)
+
+    def test_keeps_running_when_one_of_the_callers_is_cancelled(self):
+        async def run():
+            leader = asyncio.ensure_future(self.single_flight.do("a", self.compute))
+            follower = asyncio.ensure_future(self.single_flight.do("a", self.compute))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await asyncio.gather(leader, follower, return_exceptions=True)
+
+        results = self.loop.run_until_complete(run())
+
+        expect(results[0]).to_be_instance_of(asyncio.CancelledError)
+        expect(results[1]).to_equal(1)
+        expect(self.calls).to_equal(1)
+
+    def test_cancels_the_call_with_its_last_caller(self):
+        async def run():
+            caller = asyncio.ensure_future(self.single_flight.do("a", self.compute))
+            await asyncio.sleep(0)
+            caller.cancel()
+            await asyncio.gather(caller, return_exceptions=True)
+            return await self.single_flight.do("a", self.compute)
+
+        expect(self.loop.run_until_complete(run())).to_equal(2)
+        expect(len(self.single_flight)).to_equal(0)
+
+
+class CacheControlTestCase(TestCase):
+    def test_parses_directives(self):
+        directives = parse_cache_control(
+            'public, Max-Age=60,s-maxage="120", stale-while-revalidate=30, x=y'
+        )
+
+        expect(directives).to_equal(
+            {
+                "public": True,
+                "max-age": 60,
+                "s-maxage": 120,
+                "stale-while-revalidate": 30,
+                "x": "y",
+            }
+        )
+
+    def test_parses_empty_headers(self):
+        expect(parse_cache_control(None)).to_equal({})
+        expect(parse_cache_control(" , ")).to_equal({})
+
+    def test_ttl_is_the_max_age(self):
+        expect(get_ttl("public,max-age=60", 10)).to_equal(60)
+        expect(get_ttl("max-age=60,public", 10)).to_equal(60)
+
+    def test_ttl_prefers_s_maxage(self):
+        expect(get_ttl("max-age=60, s-maxage=600", 10)).to_equal(600)
+
+    def test_ttl_of_browsers_ignores_s_maxage(self):
+        expect(get_ttl("max-age=60, s-maxage=600", 10, shared=False)).to_equal(60)
+        expect(get_ttl("s-maxage=600", 10, shared=False)).to_equal(10)
+
+    def test_ttl_defaults_when_there_is_no_max_age(self):
+        expect(get_ttl(None, 10)).to_equal(10)
+        expect(get_ttl("public", 10)).to_equal(10)
+        expect(get_ttl("max-age=invalid", 10)).to_equal(10)
+
+    def test_ttl_is_zero_when_responses_must_not_be_stored(self):
+        expect(get_ttl("no-store", 10)).to_equal(0)
+        expect(get_ttl("max-age=60, no-cache", 10)).to_equal(0)
+        expect(get_ttl("private, max-age=60", 10)).to_equal(0)
+
+    def test_aged_cache_control_keeps_the_remaining_max_age(self):
+        header = get_aged_cache_control("public, max-age=60, s-maxage=600", 100, 10)
+
+        expect(header).to_equal("public, max-age=0, s-maxage=500")
+
+    def test_aged_cache_control_defaults_when_there_is_no_max_age(self):
+        expect(get_aged_cache_control(None, 4, 10)).to_equal("max-age=6")
+        expect(get_aged_cache_control("public", 4, 10)).to_equal("public, max-age=6")
+
+    def test_validators_revalidate_the_etag_and_last_modified(self):
+        validators = get_validators(
+            {"Etag": '"abc"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+        )
+
+        expect(validators).to_equal(
+            {
+                "If-None-Match": '"abc"',
+                "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT",
+            }
+        )
+        expect(get_validators({"Cache-Control": "max-age=60"})).to_equal({})
+
+
+class PackTileTestCase(TestCase):
+    def setUp(self):
+        self.result = LoaderResult(
+            buffer=b"tile",
+            metadata={
+                "cache-control": "max-age=60",
+                "ETag": '"abc"',
+                "Content-Type": "image/jpeg",
+            },
+        )
+
+    def test_keeps_the_buffer_and_headers_of_tiles(self):
+        result = unpack_tile(pack_tile(self.result, 60, now=100), now=159)
+
+        expect(result.buffer).to_equal(b"tile")
+        expect(result.metadata).to_equal(
+            {"Cache-Control": "max-age=60", "ETag": '"abc"'}
+        )
+
+    def test_keeps_the_freshness_of_tiles(self):
+        self.result.extras["fresh_until"] = 130
+        self.result.extras["engine"] = object()
+
+        result = unpack_tile(pack_tile(self.result, 60, now=100), now=120)
+
+        expect(result.extras).to_equal({"fresh_until": 130})
+
+    def test_expires_tiles_after_their_ttl(self):
+        expect(unpack_tile(pack_tile(self.result, 60, now=100), now=160)).to_be_null()
+
+    def test_ignores_values_that_are_not_tiles(self):
+        expect(unpack_tile(None)).to_be_null()
+        expect(unpack_tile(b"")).to_be_null()
+        expect(unpack_tile(b"\xff\xd8\xff\xe0 a jpeg")).to_be_null()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+from unittest import TestCase
+
+import numpy as np
+from preggy import expect
+
+from thumbor_distributed_collage_filter.canvas import Canvas, to_rgba
+
+
+def solid(width, height, color):
+    tile = np.empty((height, width, 4), dtype=np.uint8)
+    tile[...] = color
+    return tile
+
+
+class ToRGBATestCase(TestCase):
+    def test_keeps_rgba_pixels(self):
+        data = bytes([1, 2, 3, 4] * 6)
+        pixels = to_rgba("RGBA", data, (3, 2))
+
+        expect(pixels.shape).to_equal((2, 3, 4))
+        expect(pixels[1, 2].tolist()).to_equal([1, 2, 3, 4])
+
+    def test_adds_an_opaque_alpha_channel_to_rgb_pixels(self):
+        pixels = to_rgba("RGB", bytes([1, 2, 3] * 6), (3, 2))
+
+        expect(pixels[0, 0].tolist()).to_equal([1, 2, 3, 255])
+
+    def test_reorders_channels(self):
+        pixels = to_rgba("BGRA", bytes([1, 2, 3, 4] * 6), (3, 2))
+
+        expect(pixels[0, 0].tolist()).to_equal([3, 2, 1, 4])
+
+
+class CanvasTestCase(TestCase):
+    def test_writes_tiles_into_their_slots(self):
+        canvas = Canvas(4, 2)
+        canvas.paste(solid(2, 2, (255, 0, 0, 255)), 0, 0)
+        canvas.paste(solid(2, 2, (0, 0, 255, 255)), 2, 0)
+
+        expect(canvas.size).to_equal((4, 2))
+        expect(canvas.pixels[1, 1].tolist()).to_equal([255, 0, 0, 255])
+        expect(canvas.pixels[1, 2].tolist()).to_equal([0, 0, 255, 255])
+        expect(canvas.opaque).to_be_true()
+
+    def test_clips_tiles_bigger_than_the_canvas(self):
+        canvas = Canvas(3, 2)
+        canvas.paste(solid(2, 2, (255, 0, 0, 255)), 0, 0)
+        canvas.paste(solid(2, 3, (0, 0, 255, 255)), 2, 0)
+
+        expect(canvas.pixels[1, 2].tolist()).to_equal([0, 0, 255, 255])
+        expect(canvas.opaque).to_be_true()
+
+    def test_is_not_opaque_when_partially_covered(self):
+        canvas = Canvas(4, 2)
+        canvas.paste(solid(2, 2, (255, 0, 0, 255)), 0, 0)
+
+        expect(canvas.opaque).to_be_false()
+        expect(canvas.pixels[0, 3].tolist()).to_equal([0, 0, 0, 0])
+
+    def test_is_not_opaque_with_transparent_tiles(self):
+        canvas = Canvas(2, 2)
+        canvas.paste(solid(2, 2, (255, 0, 0, 128)), 0, 0)
+
+        expect(canvas.opaque).to_be_false()
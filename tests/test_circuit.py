@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+from unittest import TestCase
+
+from preggy import expect
+from thumbor.config import Config
+
+from thumbor_distributed_collage_filter import circuit
+from thumbor_distributed_collage_filter.circuit import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    get_breaker,
+    get_origin,
+)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class GetOriginTestCase(TestCase):
+    def test_returns_the_host_of_urls(self):
+        expect(get_origin("http://Example.com:8080/a.jpg")).to_equal("example.com:8080")
+        expect(get_origin("s.glbimg.com/a/b.jpg")).to_equal("s.glbimg.com")
+        expect(get_origin("localhost:8888/a.jpg")).to_equal("localhost:8888")
+        expect(get_origin("image.jpg")).to_be_null()
+        expect(get_origin("images/a.jpg")).to_be_null()
+
+
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(3, 30, clock=self.clock)
+
+    def trip(self):
+        for _ in range(3):
+            self.breaker.failure()
+
+    def test_opens_after_consecutive_failures(self):
+        expect(self.breaker.failure()).to_be_false()
+        expect(self.breaker.failure()).to_be_false()
+        expect(self.breaker.failure()).to_be_true()
+
+        expect(self.breaker.state).to_equal(OPEN)
+        expect(self.breaker.allow()).to_be_false()
+
+    def test_a_success_clears_the_failures(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        expect(self.breaker.success()).to_be_false()
+
+        expect(self.breaker.failure()).to_be_false()
+        expect(self.breaker.state).to_equal(CLOSED)
+
+    def test_lets_a_single_probe_through_once_half_open(self):
+        self.trip()
+        self.clock.now = 30
+
+        expect(self.breaker.allow()).to_be_true()
+        expect(self.breaker.state).to_equal(HALF_OPEN)
+        expect(self.breaker.allow()).to_be_false()
+
+    def test_closes_when_the_probe_succeeds(self):
+        self.trip()
+        self.clock.now = 30
+        self.breaker.allow()
+
+        expect(self.breaker.success()).to_be_true()
+        expect(self.breaker.state).to_equal(CLOSED)
+        expect(self.breaker.allow()).to_be_true()
+
+    def test_opens_again_when_the_probe_fails(self):
+        self.trip()
+        self.clock.now = 30
+        self.breaker.allow()
+
+        expect(self.breaker.failure()).to_be_true()
+        expect(self.breaker.allow()).to_be_false()
+        expect(self.breaker.stats()["trips"]).to_equal(2)
+
+    def test_replaces_a_probe_that_never_reports_back(self):
+        self.trip()
+        self.clock.now = 30
+        self.breaker.allow()
+
+        self.clock.now = 60
+        expect(self.breaker.allow()).to_be_true()
+
+
+class GetBreakerTestCase(TestCase):
+    def setUp(self):
+        circuit.breakers.clear()
+        self.config = Config()
+
+    def test_is_disabled_by_default(self):
+        expect(get_breaker("example.com", self.config)).to_be_null()
+
+    def test_returns_the_breaker_of_each_origin(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_CIRCUIT_FAILURES = 2
+        breaker = get_breaker("example.com", self.config)
+
+        expect(breaker.max_failures).to_equal(2)
+        expect(get_breaker("example.com", self.config)).to_equal(breaker)
+        expect(get_breaker("other.com", self.config)).not_to_equal(breaker)
+
+    def test_has_no_breaker_for_images_without_origin(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_CIRCUIT_FAILURES = 2
+
+        expect(get_breaker(None, self.config)).to_be_null()
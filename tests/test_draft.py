@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+from os.path import dirname, join
+from unittest import TestCase
+
+from preggy import expect
+from thumbor.config import Config
+from thumbor.context import Context
+from thumbor.engines.pil import Engine
+
+from thumbor_distributed_collage_filter.draft import draft
+
+FIXTURES = join(dirname(__file__), "fixtures", "filters")
+
+
+def load(name):
+    with open(join(FIXTURES, name), "rb") as fixture:
+        engine = Engine(Context(config=Config()))
+        engine.load(fixture.read(), None)
+    return engine
+
+
+class DraftTestCase(TestCase):
+    def test_decodes_at_the_smallest_scale_covering_the_tile(self):
+        engine = load("800px-Guido-portrait-2014.jpg")
+
+        expect(draft(engine, 100, 60)).to_equal(8)
+        expect(engine.size).to_equal((100, 67))
+
+    def test_never_decodes_smaller_than_the_tile(self):
+        engine = load("800px-Guido-portrait-2014.jpg")
+
+        expect(draft(engine, 75, 200)).to_equal(2)
+        expect(engine.size).to_equal((400, 267))
+
+    def test_keeps_images_smaller_than_twice_the_tile(self):
+        engine = load("800px-Guido-portrait-2014.jpg")
+
+        expect(draft(engine, 300, 400)).to_equal(1)
+        expect(engine.size).to_equal((800, 533))
+
+    def test_keeps_other_formats(self):
+        engine = load("PNG_transparency_demonstration_1.png")
+        size = engine.size
+
+        expect(draft(engine, 10, 10)).to_equal(1)
+        expect(engine.size).to_equal(size)
+
+    def test_keeps_images_going_to_empty_tiles(self):
+        engine = load("800px-Guido-portrait-2014.jpg")
+
+        expect(draft(engine, 0, 200)).to_equal(1)
+        expect(engine.size).to_equal((800, 533))
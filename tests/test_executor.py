@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+import asyncio
+import threading
+from unittest import TestCase
+
+from preggy import expect
+from thumbor.config import Config
+
+from thumbor_distributed_collage_filter import executor
+from thumbor_distributed_collage_filter.executor import (
+    AssemblyPool,
+    AssemblyPoolFull,
+    get_assembly_pool,
+)
+
+
+class AssemblyPoolTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.pool = AssemblyPool(1, 1)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.shutdown()
+        self.loop.close()
+
+    def block(self):
+        self.release.wait(5)
+        return "blocked"
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_runs_out_of_the_calling_thread(self):
+        wait, thread = self.run_async(self.pool.run(threading.get_ident))
+
+        expect(thread).not_to_equal(threading.get_ident())
+        expect(wait).to_be_greater_or_equal_to(0)
+        expect(self.pool.stats()).to_equal(
+            {"size": 1, "max_queue": 1, "queued": 0, "running": 0}
+        )
+
+    def test_refuses_calls_beyond_the_queue(self):
+        async def run():
+            running = asyncio.ensure_future(self.pool.run(self.block))
+            await asyncio.sleep(0.05)
+            queued = asyncio.ensure_future(self.pool.run(str, 1))
+            await asyncio.sleep(0)
+            expect(self.pool.stats()["running"]).to_equal(1)
+            expect(self.pool.stats()["queued"]).to_equal(1)
+
+            with self.assertRaises(AssemblyPoolFull):
+                await self.pool.run(str, 2)
+
+            self.release.set()
+            return await running, await queued
+
+        (_, blocked), (wait, result) = self.run_async(run())
+
+        expect(blocked).to_equal("blocked")
+        expect(result).to_equal("1")
+        expect(wait).to_be_greater_than(0)
+
+    def test_cancelled_calls_leave_the_queue(self):
+        async def run():
+            running = asyncio.ensure_future(self.pool.run(self.block))
+            await asyncio.sleep(0.05)
+            queued = asyncio.ensure_future(self.pool.run(str, 1))
+            await asyncio.sleep(0)
+            queued.cancel()
+            await asyncio.sleep(0)
+            self.release.set()
+            await running
+
+        self.run_async(run())
+
+        expect(self.pool.stats()["queued"]).to_equal(0)
+
+
+class GetAssemblyPoolTestCase(TestCase):
+    def tearDown(self):
+        for pool in executor.pools.values():
+            pool.shutdown()
+        executor.pools.clear()
+
+    def test_is_disabled_by_default(self):
+        expect(get_assembly_pool(Config())).to_be_null()
+
+    def test_is_shared(self):
+        config = Config()
+        config.DISTRIBUTED_COLLAGE_FILTER_ASSEMBLY_THREADS = 2
+        config.DISTRIBUTED_COLLAGE_FILTER_ASSEMBLY_QUEUE_SIZE = 4
+
+        pool = get_assembly_pool(config)
+
+        expect(pool.size).to_equal(2)
+        expect(pool.max_queue).to_equal(4)
+        expect(get_assembly_pool(config)).to_equal(pool)
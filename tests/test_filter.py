@@ -8,15 +8,46 @@
 # http://www.opensource.org/licenses/mit-license
 # Copyright (c) 2011 globo.com thumbor@googlegroups.com
 
+import asyncio
+import tempfile
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+import mock
+from PIL import Image
 from preggy import expect
+from thumbor.detectors import face_detector
+from thumbor.loaders import LoaderResult, http_loader
+from thumbor.point import FocalPoint
+from thumbor.result_storages import file_storage as result_file_storage
 
+from tests import fake_metrics
 from tests.base import BaseTestCase
-
+from tests.stand_in import StandInServer, get_jpeg
+from thumbor_distributed_collage_filter import (
+    admission,
+    cache,
+    circuit,
+    executor,
+    latency,
+    routing,
+    shared_tiles,
+)
+from thumbor_distributed_collage_filter.admission import get_memory_budget
+from thumbor_distributed_collage_filter import http_loader as pooled_http_loader
+from thumbor_distributed_collage_filter.cache import (
+    MemoryTileCache,
+    SharedMemoryTileCache,
+    StorageTileCache,
+)
+from thumbor_distributed_collage_filter.filter import Filter
+from thumbor_distributed_collage_filter.focal_points import MemoryFocalPointStore
 
 CONFIDENCE_LEVEL = 0.95
 
 
-class DistributedCollageFilterTestCase(BaseTestCase):
+class CollageTestCase(BaseTestCase):
     urls = (
         "800px-Guido-portrait-2014.jpg",
         "800px-Katherine_Maher.jpg",
@@ -27,12 +58,21 @@ class DistributedCollageFilterTestCase(BaseTestCase):
         "513px-Coffee_beans_-_ziarna_kawy",
     )
 
-    def get_filtered(self, filter_string, width=300, height=200):
+    def get_filtered(
+        self,
+        filter_string,
+        width=300,
+        height=200,
+        orientation="horizontal",
+        alignment="smart",
+    ):
         response = self.fetch(
-            "/unsafe/%dx%d/filters:quality(99):distributed_collage(horizontal,smart,%s)/distributed_collage_fallback.png"
+            "/unsafe/%dx%d/filters:quality(99):distributed_collage(%s,%s,%s)/distributed_collage_fallback.png"
             % (
                 width,
                 height,
+                orientation,
+                alignment,
                 filter_string,
             ),
             method="GET",
@@ -42,6 +82,8 @@ class DistributedCollageFilterTestCase(BaseTestCase):
         eng = self.get_engine(response.body)
         return eng.image
 
+
+class DistributedCollageFilterTestCase(CollageTestCase):
     def test_fallback_when_have_not_enough_images(self):
         image = self.get_filtered("")
         expected = self.get_fixture("distributed_collage_fallback.png")
@@ -95,3 +137,1446 @@ class DistributedCollageFilterTestCase(BaseTestCase):
         expected = self.get_fixture("distributed_collage_fallback.png")
         ssim = self.get_ssim(image, expected)
         expect(ssim).to_be_greater_than(CONFIDENCE_LEVEL)
+
+
+class TileLoaderSpy(object):
+    def __init__(self, delay=0, fail=None):
+        self.delay = delay
+        self.fail = fail
+        self.running = 0
+        self.max_running = 0
+        self.cancelled = 0
+        self.original_load = http_loader.load
+
+    async def load(self, context, url):
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.fail is not None and self.fail in url:
+                return LoaderResult(
+                    successful=False, error=LoaderResult.ERROR_NOT_FOUND
+                )
+            return await self.original_load(context, url)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.running -= 1
+
+
+class ConcurrentFetchTestCase(CollageTestCase):
+    def test_loads_all_tiles_concurrently(self):
+        spy = TileLoaderSpy(delay=0.05)
+        with mock.patch.object(http_loader, "load", spy.load):
+            image = self.get_filtered("|".join(self.urls[:4]))
+
+        expect(spy.max_running).to_equal(4)
+        expect(image.size).to_equal((300, 200))
+
+    def test_cancels_pending_tiles_when_one_fails(self):
+        spy = TileLoaderSpy(fail=self.urls[0])
+        slow = TileLoaderSpy(delay=0.5)
+
+        async def load(context, url):
+            if self.urls[0] in url:
+                return await spy.load(context, url)
+            return await slow.load(context, url)
+
+        with mock.patch.object(http_loader, "load", load):
+            image = self.get_filtered("|".join(self.urls[:3]))
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+        expect(slow.cancelled).to_equal(2)
+
+
+class LimitedConcurrencyFetchTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(LimitedConcurrencyFetchTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_MAX_CONCURRENCY = 2
+        return cfg
+
+    def test_respects_the_concurrency_limit(self):
+        spy = TileLoaderSpy(delay=0.05)
+        with mock.patch.object(http_loader, "load", spy.load):
+            self.get_filtered("|".join(self.urls[:4]))
+
+        expect(spy.max_running).to_equal(2)
+
+
+class FetchDeadlineTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(FetchDeadlineTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_TIMEOUT = 0.1
+        return cfg
+
+    def test_falls_back_when_the_deadline_is_exceeded(self):
+        spy = TileLoaderSpy(delay=1)
+        with mock.patch.object(http_loader, "load", spy.load):
+            image = self.get_filtered("|".join(self.urls[:2]))
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+        expect(spy.cancelled).to_equal(2)
+
+
+class LocalRenderingTestCase(DistributedCollageFilterTestCase):
+    def get_config(self):
+        cfg = super(LocalRenderingTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_MODE = "local"
+        return cfg
+
+    def test_does_not_request_tiles_over_http(self):
+        spy = TileLoaderSpy()
+        with mock.patch.object(http_loader, "load", spy.load):
+            self.get_filtered("|".join(self.urls[:4]))
+
+        expect(spy.max_running).to_equal(0)
+
+    def test_renders_smart_tiles_like_the_tile_server(self):
+        for count in (2, 3, 4):
+            urls = "|".join(self.urls[:count])
+            self.config.DISTRIBUTED_COLLAGE_FILTER_MODE = "local"
+            local = self.get_filtered(urls)
+            self.config.DISTRIBUTED_COLLAGE_FILTER_MODE = "http"
+            remote = self.get_filtered(urls)
+
+            expect(self.get_ssim(local, remote)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+    def test_falls_back_when_a_source_image_is_missing(self):
+        image = self.get_filtered("%s|missing.jpg" % self.urls[0])
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+
+
+class PngTileFormatTestCase(CollageTestCase):
+    tile_format = "png"
+
+    def get_config(self):
+        cfg = super(PngTileFormatTestCase, self).get_config()
+        cfg.FILTERS = cfg.FILTERS + ["thumbor.filters.format"]
+        cfg.DISTRIBUTED_COLLAGE_FILTER_TILE_FORMAT = self.tile_format
+        return cfg
+
+    def test_requests_tiles_in_the_configured_format(self):
+        urls = []
+        original_load = http_loader.load
+
+        async def load(context, url):
+            urls.append(url)
+            return await original_load(context, url)
+
+        with mock.patch.object(http_loader, "load", load):
+            image = self.get_filtered("|".join(self.urls[:1]))
+
+        expect(urls[0]).to_include("format(%s)" % self.tile_format)
+        expected = self.get_fixture("distributed_collage_1i.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+
+class WebpTileFormatTestCase(PngTileFormatTestCase):
+    tile_format = "webp"
+
+
+class TileCacheTestCase(CollageTestCase):
+    def setUp(self):
+        super(TileCacheTestCase, self).setUp()
+        cache.shared_caches.clear()
+
+    def get_config(self):
+        cfg = super(TileCacheTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE = "memory"
+        return cfg
+
+    def test_reuses_rendered_tiles(self):
+        spy = TileLoaderSpy()
+        calls = []
+
+        async def load(context, url):
+            calls.append(url)
+            return await spy.load(context, url)
+
+        with mock.patch.object(http_loader, "load", load):
+            first = self.get_filtered("|".join(self.urls[:2]))
+            second = self.get_filtered("|".join(self.urls[:2]))
+            self.get_filtered("|".join(self.urls[:3]))
+
+        expect(len(calls)).to_equal(5)
+        expect(self.get_ssim(first, second)).to_equal(1)
+        stats = MemoryTileCache(self.context).cache.stats()
+        expect(stats["hits"]).to_equal(2)
+        expect(stats["misses"]).to_equal(5)
+
+    def test_uses_the_tile_max_age_as_ttl(self):
+        original_load = http_loader.load
+
+        async def load(context, url):
+            result = await original_load(context, url)
+            result.metadata["Cache-Control"] = "max-age=30,public"
+            return result
+
+        tile_cache = MemoryTileCache(self.context).cache
+        with mock.patch.object(http_loader, "load", load):
+            with mock.patch.object(tile_cache, "put") as put:
+                self.get_filtered(self.urls[0])
+
+        expect(put.call_args[0][3]).to_equal(30)
+
+    def test_sends_the_remaining_max_age_of_cached_tiles(self):
+        original_load = http_loader.load
+
+        async def load(context, url):
+            result = await original_load(context, url)
+            result.metadata["Cache-Control"] = "max-age=300,public"
+            return result
+
+        path = (
+            "/unsafe/300x200/filters:distributed_collage(horizontal,smart,%s)"
+            "/distributed_collage_fallback.png" % self.urls[0]
+        )
+        with mock.patch.object(http_loader, "load", load):
+            first = self.fetch(path)
+            later = time.time() + 100
+            with mock.patch.object(time, "time", return_value=later):
+                second = self.fetch(path)
+
+        expect(first.headers["Cache-Control"]).to_equal("max-age=300,public")
+        expect(second.headers["Cache-Control"]).to_equal("max-age=200,public")
+
+
+class StorageTileCacheTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(StorageTileCacheTestCase, self).get_config()
+        cfg.STORAGE = "thumbor.storages.file_storage"
+        cfg.FILE_STORAGE_ROOT_PATH = tempfile.mkdtemp()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE = "storage"
+        return cfg
+
+    def test_reuses_tiles_kept_in_thumbor_storage(self):
+        spy = TileLoaderSpy()
+        hits = StorageTileCache.hits
+
+        with mock.patch.object(http_loader, "load", spy.load):
+            self.get_filtered(self.urls[0])
+            spy.max_running = 0
+            image = self.get_filtered(self.urls[0])
+
+        expect(spy.max_running).to_equal(0)
+        expect(StorageTileCache.hits - hits).to_equal(1)
+        expected = self.get_fixture("distributed_collage_1i.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+    def test_keeps_the_max_age_of_tiles_kept_in_thumbor_storage(self):
+        original_load = http_loader.load
+        calls = []
+
+        async def load(context, url):
+            calls.append(url)
+            result = await original_load(context, url)
+            result.metadata["Cache-Control"] = "max-age=120"
+            return result
+
+        path = (
+            "/unsafe/300x200/filters:distributed_collage(horizontal,smart,%s)"
+            "/distributed_collage_fallback.png" % self.urls[0]
+        )
+        with mock.patch.object(http_loader, "load", load):
+            self.fetch(path)
+            response = self.fetch(path)
+
+        expect(calls).to_length(1)
+        expect(response.headers["Cache-Control"]).to_equal("max-age=120,public")
+
+
+class SharedMemoryTileCacheTestCase(CollageTestCase):
+    def setUp(self):
+        super(SharedMemoryTileCacheTestCase, self).setUp()
+        shared_tiles.tables.clear()
+
+    def get_config(self):
+        cfg = super(SharedMemoryTileCacheTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE = "shared_memory"
+        cfg.DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_PATH = "%s/tiles" % (
+            tempfile.mkdtemp()
+        )
+        return cfg
+
+    def test_reuses_tiles_kept_by_another_process(self):
+        spy = TileLoaderSpy()
+        hits = SharedMemoryTileCache.hits
+
+        with mock.patch.object(http_loader, "load", spy.load):
+            first = self.get_filtered(self.urls[0])
+            # another process maps the same file
+            shared_tiles.tables.clear()
+            spy.max_running = 0
+            second = self.get_filtered(self.urls[0])
+
+        expect(spy.max_running).to_equal(0)
+        expect(SharedMemoryTileCache.hits - hits).to_equal(1)
+        expect(self.get_ssim(first, second)).to_equal(1)
+
+
+class CollageCoalescingTestCase(CollageTestCase):
+    def test_composes_concurrent_identical_collages_once(self):
+        spy = TileLoaderSpy(delay=0.1)
+        calls = []
+
+        async def load(context, url):
+            calls.append(url)
+            return await spy.load(context, url)
+
+        path = (
+            "/unsafe/300x200/filters:distributed_collage(horizontal,smart,%s)"
+            "/distributed_collage_fallback.png" % "|".join(self.urls[:2])
+        )
+
+        async def fetch_all():
+            return await asyncio.gather(
+                *[self.http_client.fetch(self.get_url(path)) for _ in range(3)]
+            )
+
+        with mock.patch.object(http_loader, "load", load):
+            responses = self.io_loop.run_sync(fetch_all)
+
+        expect(len(calls)).to_equal(2)
+        images = [self.get_engine(response.body).image for response in responses]
+        expect(self.get_ssim(images[0], images[1])).to_equal(1)
+        expect(self.get_ssim(images[0], images[2])).to_equal(1)
+
+
+class CollageResultCacheTestCase(CollageTestCase):
+    def setUp(self):
+        super(CollageResultCacheTestCase, self).setUp()
+        cache.shared_caches.clear()
+
+    def get_config(self):
+        cfg = super(CollageResultCacheTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_RESULT_CACHE_SIZE = 1024 * 1024
+        return cfg
+
+    def test_reuses_composed_collages(self):
+        spy = TileLoaderSpy()
+        with mock.patch.object(http_loader, "load", spy.load):
+            first = self.get_filtered("|".join(self.urls[:2]))
+            spy.max_running = 0
+            second = self.get_filtered("|".join(self.urls[:2]))
+            other_size = self.get_filtered(
+                "|".join(self.urls[:2]), width=200, height=200
+            )
+
+        expect(spy.max_running).to_equal(2)
+        expect(self.get_ssim(first, second)).to_equal(1)
+        expect(other_size.size).to_equal((200, 200))
+
+    def test_sends_the_remaining_max_age_of_cached_collages(self):
+        path = (
+            "/unsafe/300x200/filters:distributed_collage(horizontal,smart,%s)"
+            "/distributed_collage_fallback.png" % "|".join(self.urls[:2])
+        )
+        first = self.fetch(path)
+        later = time.time() + 100
+        with mock.patch.object(time, "time", return_value=later):
+            second = self.fetch(path)
+
+        max_age = self.config.MAX_AGE
+        expect(first.headers["Cache-Control"]).to_equal("max-age=%d,public" % max_age)
+        expect(second.headers["Cache-Control"]).to_equal(
+            "max-age=%d,public" % (max_age - 100)
+        )
+
+
+class TransparentTilesTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(TransparentTilesTestCase, self).get_config()
+        cfg.FILTERS = cfg.FILTERS + ["thumbor.filters.format"]
+        cfg.DISTRIBUTED_COLLAGE_FILTER_TILE_FORMAT = "png"
+        return cfg
+
+    def test_merges_transparent_tiles_over_the_image(self):
+        tiles = []
+        original_load = http_loader.load
+
+        async def load(context, url):
+            result = await original_load(context, url)
+            tiles.append(result.buffer)
+            return result
+
+        with mock.patch.object(http_loader, "load", load):
+            image = self.get_filtered("PNG_transparency_demonstration_1.png")
+
+        tile = Image.open(BytesIO(tiles[0])).convert("RGBA")
+        expect(tile.getextrema()[3][0]).to_be_lesser_than(255)
+
+        base = Image.open(
+            self.get_fixture_path("distributed_collage_fallback.png")
+        ).convert("RGBA")
+        expected = Image.alpha_composite(base, tile)
+        expect(self.get_ssim(image, expected)).to_be_greater_than(0.99)
+
+
+class PooledTileLoaderTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(PooledTileLoaderTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER = (
+            "thumbor_distributed_collage_filter.http_loader"
+        )
+        return cfg
+
+    def test_loads_tiles_through_the_shared_pool(self):
+        image = self.get_filtered("|".join(self.urls[:1]))
+
+        expected = self.get_fixture("distributed_collage_1i.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+        stats = self.io_loop.run_sync(
+            lambda: asyncio.sleep(0, result=pooled_http_loader.get_pool_stats())
+        )
+        expect(stats["requests"]).to_equal(1)
+
+
+class CacheControlTestCase(CollageTestCase):
+    def fetch_with_tile_headers(self, *headers):
+        original_load = http_loader.load
+        tile_headers = list(headers)
+
+        async def load(context, url):
+            result = await original_load(context, url)
+            result.metadata["Cache-Control"] = tile_headers.pop(0)
+            return result
+
+        with mock.patch.object(http_loader, "load", load):
+            return self.fetch(
+                "/unsafe/300x200/filters:distributed_collage(horizontal,smart,%s)"
+                "/distributed_collage_fallback.png"
+                % "|".join(self.urls[: len(headers)])
+            )
+
+    def test_uses_the_smallest_tile_max_age(self):
+        response = self.fetch_with_tile_headers(
+            "max-age=300,public", "public, max-age=120"
+        )
+
+        expect(response.code).to_equal(200)
+        expect(response.headers["Cache-Control"]).to_equal("max-age=120,public")
+
+    def test_does_not_send_the_tile_s_maxage_to_browsers(self):
+        response = self.fetch_with_tile_headers("max-age=60, s-maxage=600")
+
+        expect(response.headers["Cache-Control"]).to_equal("max-age=60,public")
+
+    def test_does_not_cache_collages_with_tiles_that_must_not_be_stored(self):
+        response = self.fetch_with_tile_headers("max-age=300", "no-store")
+
+        expect(response.code).to_equal(200)
+        expect(response.headers.get("Cache-Control")).to_be_null()
+
+    def test_uses_the_failure_max_age_when_falling_back(self):
+        response = self.fetch(
+            "/unsafe/300x200/filters:distributed_collage(horizontal,smart,missing.jpg)"
+            "/distributed_collage_fallback.png"
+        )
+
+        expect(response.headers["Cache-Control"]).to_equal("max-age=60,public")
+
+    def test_uses_max_age_when_rejecting_the_collage(self):
+        response = self.fetch(
+            "/unsafe/300x200/filters:distributed_collage(horizontal,smart,%s)"
+            "/distributed_collage_fallback.png" % "|".join(self.urls[:5])
+        )
+
+        expect(response.headers["Cache-Control"]).to_equal(
+            "max-age=%d,public" % self.config.MAX_AGE
+        )
+
+
+class MetricsTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(MetricsTestCase, self).get_config()
+        cfg.METRICS = "tests.fake_metrics"
+        return cfg
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        fake_metrics.Metrics.reset()
+
+    def test_times_each_stage(self):
+        self.get_filtered("|".join(self.urls[:2]))
+
+        timings = fake_metrics.Metrics.timings
+        for stage in ("time", "dimensions.time", "paste.time"):
+            expect(timings["distributed_collage.%s" % stage]).to_length(1)
+        for stage in ("sign.time", "tile.time", "decode.time", "assembly.time"):
+            expect(timings["distributed_collage.%s" % stage]).to_length(2)
+        expect(timings["distributed_collage.tile.time.0.success"]).to_length(1)
+        expect(timings["distributed_collage.tile.time.1.success"]).to_length(1)
+        expect(fake_metrics.Metrics.counters).not_to_include(
+            "distributed_collage.fallback"
+        )
+
+    def test_counts_tile_failures_and_fallbacks(self):
+        with mock.patch.object(http_loader, "load", TileLoaderSpy(fail="Maher").load):
+            self.get_filtered("|".join(self.urls[:2]))
+
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.tile.failure"]).to_equal(1)
+        expect(counters["distributed_collage.fallback"]).to_equal(1)
+        expect(
+            fake_metrics.Metrics.timings["distributed_collage.tile.time.1.failure"]
+        ).to_length(1)
+        expect(fake_metrics.Metrics.timings).not_to_include(
+            "distributed_collage.paste.time"
+        )
+
+    def test_counts_collages_with_too_many_images(self):
+        self.get_filtered("|".join(self.urls[:5]))
+
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.too_many_images"]).to_equal(1)
+        expect(fake_metrics.Metrics.timings).not_to_include("distributed_collage.time")
+
+
+class RedistributeFailurePolicyTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(RedistributeFailurePolicyTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_FAILURE_POLICY = "redistribute"
+        return cfg
+
+    def test_shares_the_width_of_the_failed_tiles(self):
+        spy = TileLoaderSpy(fail="Maher")
+        with mock.patch.object(http_loader, "load", spy.load):
+            response = self.fetch(
+                "/unsafe/300x200/filters:distributed_collage(horizontal,smart,%s)"
+                "/distributed_collage_fallback.png" % "|".join(self.urls[:2])
+            )
+
+        expect(response.code).to_equal(200)
+        expect(response.headers["Cache-Control"]).to_equal("max-age=300,public")
+        image = self.get_engine(response.body).image
+        expected = self.get_fixture("distributed_collage_1i.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+    def test_falls_back_when_every_tile_fails(self):
+        spy = TileLoaderSpy(fail=".jpg")
+        with mock.patch.object(http_loader, "load", spy.load):
+            image = self.get_filtered("|".join(self.urls[:2]))
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+
+
+class PlaceholderFailurePolicyTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(PlaceholderFailurePolicyTestCase, self).get_config()
+        cfg.FILTERS = cfg.FILTERS + ["thumbor.filters.format"]
+        cfg.DISTRIBUTED_COLLAGE_FILTER_FAILURE_POLICY = "placeholder"
+        cfg.DISTRIBUTED_COLLAGE_FILTER_PLACEHOLDER_COLOR = "#ff0000"
+        cfg.DISTRIBUTED_COLLAGE_FILTER_FAILURE_MAX_AGE = 10
+        return cfg
+
+    def test_fills_the_slots_of_the_failed_tiles(self):
+        spy = TileLoaderSpy(fail="Maher")
+        with mock.patch.object(http_loader, "load", spy.load):
+            response = self.fetch(
+                "/unsafe/300x200/filters:format(png):distributed_collage"
+                "(horizontal,smart,%s)/distributed_collage_fallback.png"
+                % "|".join(self.urls[:3])
+            )
+
+        expect(response.code).to_equal(200)
+        expect(response.headers["Cache-Control"]).to_equal("max-age=10,public")
+        image = self.get_engine(response.body).image.convert("RGB")
+        expect(image.crop((100, 0, 200, 200)).getcolors()).to_equal(
+            [(100 * 200, (255, 0, 0))]
+        )
+        expect(image.getpixel((50, 100))).not_to_equal((255, 0, 0))
+        expect(image.getpixel((250, 100))).not_to_equal((255, 0, 0))
+
+
+class ResultStorageTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(ResultStorageTestCase, self).get_config()
+        cfg.RESULT_STORAGE = "thumbor.result_storages.file_storage"
+        cfg.RESULT_STORAGE_FILE_STORAGE_ROOT_PATH = tempfile.mkdtemp()
+        cfg.RESULT_STORAGE_STORES_UNSAFE = True
+        return cfg
+
+    def setUp(self):
+        super(ResultStorageTestCase, self).setUp()
+        admission.budgets.clear()
+
+    def fetch_stored(self, urls):
+        original_put = result_file_storage.Storage.put
+        stored = []
+
+        async def put(storage, image_bytes):
+            stored.append(storage.context.request.url)
+            return await original_put(storage, image_bytes)
+
+        spy = TileLoaderSpy(fail="Maher")
+        with mock.patch.object(http_loader, "load", spy.load):
+            with mock.patch.object(result_file_storage.Storage, "put", put):
+                response = self.fetch(
+                    "/unsafe/300x200/filters:distributed_collage"
+                    "(horizontal,smart,%s)/distributed_collage_fallback.png"
+                    % "|".join(urls)
+                )
+
+        expect(response.code).to_equal(200)
+        self.cache_control = response.headers.get("Cache-Control")
+        return [url for url in stored if "distributed_collage(" in url]
+
+    def test_stores_complete_collages(self):
+        expect(self.fetch_stored(self.urls[2:4])).to_length(1)
+
+    def test_does_not_store_fallbacks(self):
+        expect(self.fetch_stored(self.urls[:2])).to_be_empty()
+        # MAX_AGE_TEMP_IMAGE
+        expect(self.cache_control).to_be_null()
+
+    def test_does_not_store_degraded_collages(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_FAILURE_POLICY = "placeholder"
+
+        expect(self.fetch_stored(self.urls[:3])).to_be_empty()
+
+    def test_does_not_store_fallbacks_over_the_memory_budget(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MAX_COLLAGE_BYTES = 1024
+        self.config.DISTRIBUTED_COLLAGE_FILTER_OVER_BUDGET = "fallback"
+
+        expect(self.fetch_stored(self.urls[2:4])).to_be_empty()
+
+
+class LayoutTestCase(CollageTestCase):
+    def test_vertical_layout(self):
+        image = self.get_filtered(
+            "|".join(self.urls[:2]), width=200, height=300, orientation="vertical"
+        )
+        expected = self.get_fixture("distributed_collage_2i_vertical.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+    def test_grid_layout(self):
+        image = self.get_filtered("|".join(self.urls[:4]), orientation="grid")
+        expected = self.get_fixture("distributed_collage_4i_grid.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+    def test_justified_layout(self):
+        image = self.get_filtered("|".join(self.urls[:3]), orientation="justified")
+        expected = self.get_fixture("distributed_collage_3i_justified.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+    def test_tiles_aligned_to_the_top(self):
+        image = self.get_filtered("|".join(self.urls[:2]), alignment="top")
+        expected = self.get_fixture("distributed_collage_2i_top.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+    def test_tiles_aligned_to_the_top_are_not_smart_cropped(self):
+        spy = TileLoaderSpy()
+        urls = []
+
+        async def load(context, url):
+            urls.append(url)
+            return await spy.load(context, url)
+
+        with mock.patch.object(http_loader, "load", load):
+            self.get_filtered("|".join(self.urls[:2]), alignment="top")
+
+        expect(urls).to_length(2)
+        for url in urls:
+            expect(url).to_include("/top/")
+            expect(url).not_to_include("/smart/")
+
+    def test_unknown_orientation_is_horizontal(self):
+        image = self.get_filtered("|".join(self.urls[:1]), orientation="diagonal")
+        expected = self.get_fixture("distributed_collage_1i.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+
+class ManyImagesTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(ManyImagesTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_MAX_IMAGES = 16
+        return cfg
+
+    def test_composes_up_to_the_configured_cap(self):
+        spy = TileLoaderSpy(delay=0.01)
+        urls = [self.urls[index % 4] for index in range(16)]
+        with mock.patch.object(http_loader, "load", spy.load):
+            image = self.get_filtered(
+                "|".join(urls), width=400, height=400, orientation="grid"
+            )
+
+        expect(image.size).to_equal((400, 400))
+        # each of the 4 sources is loaded once
+        expect(spy.max_running).to_equal(4)
+        # 4x4 cells of 100x100, every row has the same 4 sources
+        first_row = image.crop((0, 0, 400, 100))
+        last_row = image.crop((0, 300, 400, 400))
+        expect(self.get_ssim(first_row, last_row)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+    def test_falls_back_above_the_cap(self):
+        urls = [self.urls[index % 4] for index in range(17)]
+        image = self.get_filtered("|".join(urls), orientation="grid")
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+
+class AssemblyPoolTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(AssemblyPoolTestCase, self).get_config()
+        cfg.METRICS = "tests.fake_metrics"
+        cfg.DISTRIBUTED_COLLAGE_FILTER_ASSEMBLY_THREADS = 2
+        cfg.DISTRIBUTED_COLLAGE_FILTER_ASSEMBLY_QUEUE_SIZE = 4
+        return cfg
+
+    def setUp(self):
+        super(AssemblyPoolTestCase, self).setUp()
+        fake_metrics.Metrics.reset()
+
+    def tearDown(self):
+        super(AssemblyPoolTestCase, self).tearDown()
+        for pool in executor.pools.values():
+            pool.shutdown()
+        executor.pools.clear()
+
+    def test_composes_the_collage_in_the_pool(self):
+        image = self.get_filtered("|".join(self.urls[:1]))
+
+        expected = self.get_fixture("distributed_collage_1i.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+        # the tiles, then the collage over the image
+        expect(
+            fake_metrics.Metrics.timings["distributed_collage.assembly_pool.wait"]
+        ).to_length(2)
+
+    def test_falls_back_when_the_pool_is_full(self):
+        with mock.patch.object(
+            executor.AssemblyPool, "run", side_effect=executor.AssemblyPoolFull()
+        ):
+            image = self.get_filtered("|".join(self.urls[:1]))
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.assembly_pool.full"]).to_equal(1)
+        expect(counters["distributed_collage.fallback"]).to_equal(1)
+
+
+class DefaultHttpLoaderTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(DefaultHttpLoaderTestCase, self).get_config()
+        del cfg.DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER
+        return cfg
+
+    def test_uses_thumbor_http_loader_without_changing_the_config(self):
+        spy = TileLoaderSpy()
+        with mock.patch.object(http_loader, "load", spy.load):
+            image = self.get_filtered("|".join(self.urls[:1]))
+
+        expected = self.get_fixture("distributed_collage_1i.png")
+        expect(self.get_ssim(image, expected)).to_be_greater_than(CONFIDENCE_LEVEL)
+        expect(spy.max_running).to_equal(1)
+        expect(
+            hasattr(self.config, "DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER")
+        ).to_be_false()
+
+
+class FocalPointStoreTestCase(CollageTestCase):
+    def setUp(self):
+        super(FocalPointStoreTestCase, self).setUp()
+        cache.shared_caches.clear()
+
+    def get_config(self):
+        cfg = super(FocalPointStoreTestCase, self).get_config()
+        cfg.FILTERS = cfg.FILTERS + ["thumbor.filters.focal"]
+        cfg.STORAGE = "thumbor.storages.no_storage"
+        return cfg
+
+
+class HttpFocalPointStoreTestCase(FocalPointStoreTestCase):
+    def test_requests_the_known_focal_points(self):
+        store = MemoryFocalPointStore(self.context)
+        points = [FocalPoint.from_square(300, 100, 120, 160).to_dict()]
+        asyncio.get_event_loop().run_until_complete(store.put(self.urls[0], points))
+
+        spy = TileLoaderSpy()
+        calls = []
+
+        async def load(context, url):
+            calls.append(url)
+            return await spy.load(context, url)
+
+        with mock.patch.object(http_loader, "load", load):
+            self.get_filtered("|".join(self.urls[:2]))
+
+        expect(calls).to_length(2)
+        known = [url for url in calls if self.urls[0] in url][0]
+        expect(known).to_include("focal(300x100:420x260)")
+        expect(known).Not.to_include("/smart/")
+        unknown = [url for url in calls if self.urls[1] in url][0]
+        expect(unknown).to_include("/smart/")
+
+
+class SharedStorageFocalPointStoreTestCase(FocalPointStoreTestCase):
+    def get_config(self):
+        cfg = super(SharedStorageFocalPointStoreTestCase, self).get_config()
+        cfg.STORAGE = "thumbor.storages.file_storage"
+        cfg.FILE_STORAGE_ROOT_PATH = tempfile.mkdtemp()
+        return cfg
+
+    def test_requests_the_focal_points_detected_by_the_tile_server(self):
+        spy = TileLoaderSpy()
+        calls = []
+
+        async def load(context, url):
+            calls.append(url)
+            return await spy.load(context, url)
+
+        with mock.patch.object(http_loader, "load", load):
+            self.get_filtered(self.urls[0])
+            self.get_filtered(self.urls[0], width=400)
+
+        expect(calls).to_length(2)
+        expect(calls[0]).to_include("/smart/")
+        expect(calls[1]).to_include("focal(")
+        expect(calls[1]).Not.to_include("/smart/")
+
+
+class LocalFocalPointStoreTestCase(FocalPointStoreTestCase):
+    def get_config(self):
+        cfg = super(LocalFocalPointStoreTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_MODE = "local"
+        return cfg
+
+    def test_detects_each_image_once(self):
+        with mock.patch.object(
+            face_detector.Detector,
+            "detect",
+            autospec=True,
+            side_effect=face_detector.Detector.detect,
+        ) as detect:
+            self.get_filtered("|".join(self.urls[:2]), width=300)
+            self.get_filtered("|".join(self.urls[:2]), width=400)
+
+        expect(detect.call_count).to_equal(2)
+
+    def test_detects_every_tile_without_a_store(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_FOCAL_POINT_STORE = None
+        with mock.patch.object(
+            face_detector.Detector,
+            "detect",
+            autospec=True,
+            side_effect=face_detector.Detector.detect,
+        ) as detect:
+            self.get_filtered("|".join(self.urls[:2]), width=300)
+            self.get_filtered("|".join(self.urls[:2]), width=400)
+
+        expect(detect.call_count).to_equal(4)
+
+
+class StreamingAssemblyTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(StreamingAssemblyTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_STREAMING_ASSEMBLY = True
+        return cfg
+
+    def test_pastes_each_tile_while_the_others_load(self):
+        original_load = http_loader.load
+        running = []
+        pasted = []
+
+        async def load(context, url):
+            running.append(url)
+            try:
+                if self.urls[0] in url:
+                    await asyncio.sleep(0.2)
+                return await original_load(context, url)
+            finally:
+                running.remove(url)
+
+        original_paste = Filter._paste_tile
+
+        def paste_tile(fltr, canvas, image, slots):
+            pasted.append((slots[0][0].x, len(running)))
+            return original_paste(fltr, canvas, image, slots)
+
+        with mock.patch.object(http_loader, "load", load):
+            with mock.patch.object(Filter, "_paste_tile", paste_tile):
+                self.get_filtered("|".join(self.urls[:2]))
+
+        # the second tile lands first, while the first one is still loading
+        expect(pasted).to_equal([(150, 1), (0, 0)])
+
+    def test_composes_the_same_collage(self):
+        streamed = self.get_filtered("|".join(self.urls[:3]))
+        self.config.DISTRIBUTED_COLLAGE_FILTER_STREAMING_ASSEMBLY = False
+        composed = self.get_filtered("|".join(self.urls[:3]))
+
+        expect(self.get_ssim(streamed, composed)).to_equal(1)
+
+    def test_keeps_only_the_headers_of_pasted_tiles(self):
+        original_assembly = Filter.assembly_images
+        assembled = []
+
+        def assembly_images(fltr, images):
+            assembled.extend(images)
+            return original_assembly(fltr, images)
+
+        with mock.patch.object(Filter, "assembly_images", assembly_images):
+            self.get_filtered("|".join(self.urls[:2]))
+
+        expect(assembled).to_length(2)
+        for image in assembled:
+            expect(image.buffer).to_be_null()
+            expect(image.extras).to_equal({"pasted": True})
+            expect(image.metadata).to_include("Cache-Control")
+
+
+class StreamingPlaceholderFailurePolicyTestCase(PlaceholderFailurePolicyTestCase):
+    def get_config(self):
+        cfg = super(StreamingPlaceholderFailurePolicyTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_STREAMING_ASSEMBLY = True
+        return cfg
+
+
+class StreamingAssemblyPoolTestCase(AssemblyPoolTestCase):
+    def get_config(self):
+        cfg = super(StreamingAssemblyPoolTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_STREAMING_ASSEMBLY = True
+        return cfg
+
+
+class StandInServersTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(StandInServersTestCase, self).get_config()
+        cfg.METRICS = "tests.fake_metrics"
+        return cfg
+
+    def setUp(self):
+        super(StandInServersTestCase, self).setUp()
+        fake_metrics.Metrics.reset()
+        latency.trackers.clear()
+        routing.health.clear()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        super(StandInServersTestCase, self).tearDown()
+
+    def start_server(self, color, delay=0):
+        server = StandInServer(color, delay)
+        self.servers.append(server)
+        return server
+
+    def keep_servers_order(self):
+        """Requests every tile to the first server, whatever its image."""
+        patcher = mock.patch(
+            "thumbor_distributed_collage_filter.filter.route",
+            lambda nodes, key, config: list(nodes),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use_servers(self, *servers):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_THUMBOR_SERVER_URL = [
+            server.url for server in servers
+        ]
+
+    def get_colors(self, image):
+        """Dominant channel of each tile: 0 for red, 2 for blue."""
+        pixels = [image.convert("RGB").getpixel((x, 100)) for x in (75, 225)]
+        return [pixel.index(max(pixel)) for pixel in pixels]
+
+
+class HedgedRequestTestCase(StandInServersTestCase):
+    def get_config(self):
+        cfg = super(HedgedRequestTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_HEDGE_DELAY = 0.05
+        return cfg
+
+    def setUp(self):
+        super(HedgedRequestTestCase, self).setUp()
+        self.keep_servers_order()
+
+    def test_takes_the_tiles_of_the_hedged_server(self):
+        slow = self.start_server("red", delay=1)
+        fast = self.start_server("blue")
+        self.use_servers(slow, fast)
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        # blue
+        expect(self.get_colors(image)).to_equal([2, 2])
+        expect(slow.requests).to_length(2)
+        expect(sorted(fast.requests)).to_equal(sorted(slow.requests))
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.hedge"]).to_equal(2)
+        expect(counters["distributed_collage.hedge.win"]).to_equal(2)
+
+    def test_does_not_hedge_fast_tiles(self):
+        fast = self.start_server("blue")
+        other = self.start_server("red")
+        self.use_servers(fast, other)
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        expect(self.get_colors(image)).to_equal([2, 2])
+        expect(other.requests).to_be_empty()
+        expect(fake_metrics.Metrics.counters["distributed_collage.hedge"]).to_equal(0)
+
+    def test_hedges_after_the_p95_of_the_server(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_HEDGE_DELAY = "p95"
+        slow = self.start_server("red", delay=1)
+        fast = self.start_server("blue")
+        self.use_servers(slow, fast)
+        for _ in range(10):
+            latency.get_tracker(slow.url).observe(0.02)
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        expect(self.get_colors(image)).to_equal([2, 2])
+        expect(fake_metrics.Metrics.counters["distributed_collage.hedge"]).to_equal(2)
+
+
+class AdaptiveTimeoutTestCase(StandInServersTestCase):
+    def get_config(self):
+        cfg = super(AdaptiveTimeoutTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_ADAPTIVE_TIMEOUT = True
+        cfg.DISTRIBUTED_COLLAGE_FILTER_ADAPTIVE_TIMEOUT_MIN = 0.05
+        return cfg
+
+    def test_times_out_tiles_slower_than_the_server_used_to_be(self):
+        slow = self.start_server("red", delay=1)
+        self.use_servers(slow)
+        tracker = latency.get_tracker(slow.url)
+        for _ in range(10):
+            tracker.observe(0.01)
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+        counters = fake_metrics.Metrics.counters
+        expect(
+            counters["distributed_collage.tile.adaptive_timeout"]
+        ).to_be_greater_than(0)
+        # the timeouts are observed too, so the timeout grows with the server
+        expect(tracker.samples).to_be_greater_than(10)
+
+    def test_waits_for_servers_without_enough_samples(self):
+        slow = self.start_server("red", delay=0.2)
+        self.use_servers(slow)
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        expect(self.get_colors(image)).to_equal([0, 0])
+        expect(latency.get_tracker(slow.url).samples).to_equal(2)
+
+    def test_hedged_server_answers_the_timed_out_tiles(self):
+        self.keep_servers_order()
+        self.config.DISTRIBUTED_COLLAGE_FILTER_HEDGE_DELAY = 0.5
+        slow = self.start_server("red", delay=1)
+        fast = self.start_server("blue")
+        self.use_servers(slow, fast)
+        for _ in range(10):
+            latency.get_tracker(slow.url).observe(0.01)
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        expect(self.get_colors(image)).to_equal([2, 2])
+
+
+class TileRoutingTestCase(StandInServersTestCase):
+    def get_config(self):
+        cfg = super(TileRoutingTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_EJECT_FAILURES = 1
+        return cfg
+
+    def setUp(self):
+        super(TileRoutingTestCase, self).setUp()
+        self.nodes = [
+            self.start_server(color) for color in ("red", "green", "blue", "white")
+        ]
+        self.use_servers(*self.nodes)
+
+    def get_owner(self, url):
+        urls = [node.url for node in self.nodes]
+        owner = routing.get_ring(urls).get_nodes(url)[0]
+        return [node for node in self.nodes if node.url == owner][0]
+
+    def get_node_images(self):
+        return {
+            node.url: sorted(set(path.rsplit("/", 1)[1] for path in node.requests))
+            for node in self.nodes
+        }
+
+    def test_renders_each_image_on_the_same_node(self):
+        urls = [self.urls[0], self.urls[1], self.urls[3], self.urls[4]]
+        self.get_filtered("|".join(urls))
+        self.get_filtered("|".join(urls[1:3]), width=200, height=300)
+        self.get_filtered(urls[2], width=100, height=100)
+
+        expect(sum(len(node.requests) for node in self.nodes)).to_equal(7)
+        for url in urls:
+            owner = self.get_owner(url)
+            expect(self.get_node_images()[owner.url]).to_include(url)
+        # every image is only requested to its own node
+        images = sum(self.get_node_images().values(), [])
+        expect(sorted(images)).to_equal(sorted(urls))
+
+    def test_ejects_failing_nodes(self):
+        owner = self.get_owner(self.urls[0])
+        owner.stop()
+
+        image = self.get_filtered(self.urls[0])
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.node.ejected"]).to_equal(1)
+
+        image = self.get_filtered(self.urls[0])
+        expect(self.get_ssim(image, expected)).to_be_lesser_than(1)
+        others = [node for node in self.nodes if node is not owner]
+        expect(sum(len(node.requests) for node in others)).to_equal(1)
+
+
+class RevalidationTestCase(StandInServersTestCase):
+    def get_config(self):
+        cfg = super(RevalidationTestCase, self).get_config()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER = (
+            "thumbor_distributed_collage_filter.http_loader"
+        )
+        cfg.DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE = "memory"
+        cfg.DISTRIBUTED_COLLAGE_FILTER_REVALIDATE_TTL = 3600
+        return cfg
+
+    def setUp(self):
+        super(RevalidationTestCase, self).setUp()
+        cache.shared_caches.clear()
+        self.server = self.start_server("blue")
+        self.use_servers(self.server)
+
+    @contextmanager
+    def tiles_expired(self):
+        later = time.time() + self.config.MAX_AGE + 1
+        with mock.patch.object(time, "time", return_value=later):
+            yield
+
+    def test_reuses_expired_tiles_that_were_not_modified(self):
+        first = self.get_filtered("|".join(self.urls[:2]))
+
+        with self.tiles_expired():
+            second = self.get_filtered("|".join(self.urls[:2]))
+
+        expect(self.server.requests).to_length(4)
+        expect(self.server.revalidations).to_length(2)
+        expect(self.get_ssim(first, second)).to_equal(1)
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.tile_cache.revalidate"]).to_equal(2)
+        expect(counters["distributed_collage.tile_cache.not_modified"]).to_equal(2)
+
+        # fresh again
+        with self.tiles_expired():
+            self.get_filtered("|".join(self.urls[:2]))
+        expect(self.server.requests).to_length(4)
+
+    def test_loads_expired_tiles_that_were_modified(self):
+        self.get_filtered("|".join(self.urls[:2]))
+        self.server.body = get_jpeg("red")
+
+        with self.tiles_expired():
+            image = self.get_filtered("|".join(self.urls[:2]))
+
+        expect(self.server.revalidations).to_length(2)
+        # red
+        expect(self.get_colors(image)).to_equal([0, 0])
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.tile_cache.not_modified"]).to_equal(0)
+
+
+class StorageRevalidationTestCase(RevalidationTestCase):
+    def get_config(self):
+        cfg = super(StorageRevalidationTestCase, self).get_config()
+        cfg.STORAGE = "thumbor.storages.file_storage"
+        cfg.FILE_STORAGE_ROOT_PATH = tempfile.mkdtemp()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE = "storage"
+        return cfg
+
+
+class DeduplicatedTilesTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(DeduplicatedTilesTestCase, self).get_config()
+        cfg.METRICS = "tests.fake_metrics"
+        return cfg
+
+    def setUp(self):
+        super(DeduplicatedTilesTestCase, self).setUp()
+        fake_metrics.Metrics.reset()
+
+    def get_loads(self, urls, **kw):
+        spy = TileLoaderSpy()
+        calls = []
+
+        async def load(context, url):
+            calls.append(url)
+            return await spy.load(context, url)
+
+        with mock.patch.object(http_loader, "load", load):
+            image = self.get_filtered("|".join(urls), **kw)
+        return image, calls
+
+    def test_loads_a_repeated_tile_once(self):
+        image, calls = self.get_loads([self.urls[1], self.urls[1]])
+
+        expect(calls).to_length(1)
+        left = image.crop((0, 0, 150, 200))
+        right = image.crop((150, 0, 300, 200))
+        expect(self.get_ssim(left, right)).to_equal(1)
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.tile.deduplicated"]).to_equal(1)
+
+    def test_crops_narrower_tiles_from_the_widest_one(self):
+        # slots of 100, 100 and 101 pixels
+        image, calls = self.get_loads(
+            [self.urls[1], self.urls[0], self.urls[1]], width=301
+        )
+
+        expect(calls).to_length(2)
+        expect([url for url in calls if self.urls[1] in url][0]).to_include("/101x200/")
+        first = image.crop((0, 0, 100, 200))
+        last = image.crop((200, 0, 300, 200))
+        expect(self.get_ssim(first, last)).to_be_greater_than(CONFIDENCE_LEVEL)
+
+    def test_loads_tiles_of_other_ratios_separately(self):
+        # justified slots of 150x100, 150x100 and 300x100 pixels
+        urls = [self.urls[0], self.urls[4], self.urls[0]]
+        image, calls = self.get_loads(urls, orientation="justified")
+
+        expect(calls).to_length(3)
+        expected = self.get_filtered(self.urls[0], width=150, height=100)
+        expect(
+            self.get_ssim(image.crop((0, 0, 150, 100)), expected)
+        ).to_be_greater_than(CONFIDENCE_LEVEL)
+        counters = fake_metrics.Metrics.counters
+        expect(counters.get("distributed_collage.tile.deduplicated")).to_be_null()
+
+    def test_pastes_a_repeated_tile_to_every_slot_when_streaming(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_STREAMING_ASSEMBLY = True
+        image, calls = self.get_loads([self.urls[1], self.urls[0], self.urls[1]])
+
+        expect(calls).to_length(2)
+        first = image.crop((0, 0, 100, 200))
+        last = image.crop((200, 0, 300, 200))
+        expect(self.get_ssim(first, last)).to_equal(1)
+
+
+class AdmissionControlTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(AdmissionControlTestCase, self).get_config()
+        cfg.METRICS = "tests.fake_metrics"
+        return cfg
+
+    def setUp(self):
+        super(AdmissionControlTestCase, self).setUp()
+        fake_metrics.Metrics.reset()
+        admission.budgets.clear()
+
+    def test_scales_down_collages_over_their_budget(self):
+        full = self.get_filtered("|".join(self.urls[:2]))
+        # a quarter of a 300x200 collage of 2 tiles
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MAX_COLLAGE_BYTES = 3 * 150 * 100 * 4
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        expect(image.size).to_equal((150, 100))
+        expect(self.get_ssim(image, full.resize((150, 100)))).to_be_greater_than(
+            CONFIDENCE_LEVEL
+        )
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.memory.scaled"]).to_equal(1)
+
+    def test_falls_back_when_over_budget(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MAX_COLLAGE_BYTES = 1024
+        self.config.DISTRIBUTED_COLLAGE_FILTER_OVER_BUDGET = "fallback"
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.memory.rejected"]).to_equal(1)
+        expect(counters["distributed_collage.fallback"]).to_equal(1)
+
+    def test_reports_the_bytes_in_flight(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MEMORY_BUDGET = 1024 * 1024
+
+        self.get_filtered("|".join(self.urls[:2]))
+
+        timings = fake_metrics.Metrics.timings
+        expect(timings["distributed_collage.memory.in_flight"]).to_equal(
+            [3 * 300 * 200 * 4]
+        )
+        expect(get_memory_budget(self.config).in_flight).to_equal(0)
+
+    def test_falls_back_when_the_process_budget_stays_full(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MEMORY_BUDGET = 1024 * 1024
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MEMORY_QUEUE_TIMEOUT = 0.05
+        budget = get_memory_budget(self.config)
+        self.io_loop.run_sync(lambda: budget.acquire(1024 * 1024))
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.memory.rejected"]).to_equal(1)
+
+        budget.release(1024 * 1024)
+        image = self.get_filtered("|".join(self.urls[:2]))
+        expect(self.get_ssim(image, expected)).to_be_lesser_than(1)
+
+    def test_queues_collages_until_memory_is_released(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MEMORY_BUDGET = 1024 * 1024
+        budget = get_memory_budget(self.config)
+        self.io_loop.run_sync(lambda: budget.acquire(1024 * 1024))
+        self.io_loop.call_later(0.1, budget.release, 1024 * 1024)
+
+        image = self.get_filtered("|".join(self.urls[:2]))
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_be_lesser_than(1)
+        wait = fake_metrics.Metrics.timings["distributed_collage.memory.wait"]
+        expect(wait[0]).to_be_greater_than(50)
+
+    def test_reserves_the_memory_of_coalesced_collages_once(self):
+        # the budget of a single 300x200 collage of 2 tiles
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MEMORY_BUDGET = 3 * 300 * 200 * 4
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MEMORY_QUEUE_TIMEOUT = 0.05
+        spy = TileLoaderSpy(delay=0.2)
+        path = (
+            "/unsafe/300x200/filters:distributed_collage(horizontal,smart,%s)"
+            "/distributed_collage_fallback.png" % "|".join(self.urls[:2])
+        )
+
+        async def fetch_all():
+            return await asyncio.gather(
+                *[self.http_client.fetch(self.get_url(path)) for _ in range(3)]
+            )
+
+        with mock.patch.object(http_loader, "load", spy.load):
+            responses = self.io_loop.run_sync(fetch_all)
+
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        for response in responses:
+            image = self.get_engine(response.body).image
+            expect(self.get_ssim(image, expected)).to_be_lesser_than(1)
+        counters = fake_metrics.Metrics.counters
+        expect(counters.get("distributed_collage.memory.rejected")).to_be_null()
+        expect(get_memory_budget(self.config).in_flight).to_equal(0)
+
+
+class SourceFailuresTestCase(CollageTestCase):
+    def get_config(self):
+        cfg = super(SourceFailuresTestCase, self).get_config()
+        cfg.METRICS = "tests.fake_metrics"
+        return cfg
+
+    def setUp(self):
+        super(SourceFailuresTestCase, self).setUp()
+        fake_metrics.Metrics.reset()
+        cache.shared_caches.clear()
+        circuit.breakers.clear()
+
+    def get_loads(self, urls, fail=None):
+        spy = TileLoaderSpy(fail=fail)
+        calls = []
+
+        async def load(context, url):
+            calls.append(url)
+            return await spy.load(context, url)
+
+        with mock.patch.object(http_loader, "load", load):
+            image = self.get_filtered("|".join(urls))
+        return image, calls
+
+    def test_does_not_request_tiles_of_urls_that_just_failed(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_NEGATIVE_CACHE_TTL = 60
+        _, calls = self.get_loads(self.urls[1:2], fail="Maher")
+        expect(calls).to_length(1)
+
+        image, calls = self.get_loads(self.urls[1:2])
+
+        expect(calls).to_length(0)
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.negative_cache.hit"]).to_equal(1)
+
+        cache.shared_caches.clear()
+        _, calls = self.get_loads(self.urls[1:2])
+        expect(calls).to_length(1)
+
+    def get_origin_loads(self, urls, code=None):
+        """Loads tiles of images of a host answering `code` (or the tiles)."""
+        calls = []
+
+        async def load(context, url):
+            calls.append(url)
+            if code is None:
+                return LoaderResult(buffer=get_jpeg("red"))
+            # as the tile loader maps the statuses of the tile server
+            error = LoaderResult.ERROR_NOT_FOUND
+            if code == 599:
+                error = LoaderResult.ERROR_TIMEOUT
+            return LoaderResult(successful=False, error=error, extras={"code": code})
+
+        with mock.patch.object(http_loader, "load", load):
+            image = self.get_filtered(
+                "|".join("origin.example.com/%s" % url for url in urls)
+            )
+        return image, calls
+
+    def test_short_circuits_origins_failing_repeatedly(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_CIRCUIT_FAILURES = 2
+        self.get_origin_loads(["a.jpg"], code=502)
+        self.get_origin_loads(["b.jpg"], code=504)
+
+        image, calls = self.get_origin_loads(["c.jpg"])
+
+        expect(calls).to_length(0)
+        expected = self.get_fixture("distributed_collage_fallback.png")
+        expect(self.get_ssim(image, expected)).to_equal(1)
+        counters = fake_metrics.Metrics.counters
+        expect(counters["distributed_collage.circuit.open"]).to_equal(1)
+        expect(counters["distributed_collage.circuit.short_circuit"]).to_equal(1)
+
+        # once the origin had time to recover a probe closes the circuit
+        circuit.breakers["origin.example.com"].opened_at -= 60
+        image, calls = self.get_origin_loads(["c.jpg"])
+
+        expect(calls).to_length(1)
+        expect(self.get_ssim(image, expected)).to_be_lesser_than(1)
+        expect(counters["distributed_collage.circuit.close"]).to_equal(1)
+
+    def test_does_not_open_the_circuit_of_origins_missing_images(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_CIRCUIT_FAILURES = 2
+        for url in ("a.jpg", "b.jpg", "c.jpg"):
+            self.get_origin_loads([url], code=404)
+
+        _, calls = self.get_origin_loads(["d.jpg"])
+
+        expect(calls).to_length(1)
+        expect(circuit.breakers["origin.example.com"].state).to_equal(circuit.CLOSED)
+        counters = fake_metrics.Metrics.counters
+        expect(counters.get("distributed_collage.circuit.open")).to_be_null()
+
+    def test_does_not_blame_origins_for_thumbor_server_timeouts(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_NEGATIVE_CACHE_TTL = 60
+        self.config.DISTRIBUTED_COLLAGE_FILTER_CIRCUIT_FAILURES = 1
+        self.get_origin_loads(["a.jpg"], code=599)
+
+        _, calls = self.get_origin_loads(["a.jpg"])
+        expect(calls).to_length(1)
+        expect(circuit.breakers["origin.example.com"].state).to_equal(circuit.CLOSED)
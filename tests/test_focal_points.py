@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+import asyncio
+from unittest import TestCase
+
+import mock
+from preggy import expect
+from thumbor.config import Config
+from thumbor.point import FocalPoint
+
+from thumbor_distributed_collage_filter import cache
+from thumbor_distributed_collage_filter.focal_points import (
+    FocalPointStorage,
+    MemoryFocalPointStore,
+    StorageFocalPointStore,
+    get_focal_filters,
+)
+
+POINTS = [FocalPoint.from_square(100, 40, 60, 80).to_dict()]
+
+
+def run_async(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+class FakeStorage(object):
+    def __init__(self, points=None):
+        self.points = points
+        self.put = mock.Mock()
+
+    async def get_detector_data(self, path):
+        return self.points
+
+    async def put_detector_data(self, path, data):
+        self.points = data
+
+
+class MemoryFocalPointStoreTestCase(TestCase):
+    def setUp(self):
+        cache.shared_caches.clear()
+
+    def get_store(self, **config):
+        return MemoryFocalPointStore(mock.Mock(config=Config(**config)))
+
+    def test_shares_the_points_between_stores(self):
+        run_async(self.get_store().put("image.jpg", POINTS))
+
+        expect(run_async(self.get_store().get("image.jpg"))).to_equal(POINTS)
+        expect(run_async(self.get_store().get("other.jpg"))).to_be_null()
+
+    def test_keeps_the_last_images(self):
+        store = self.get_store(DISTRIBUTED_COLLAGE_FILTER_FOCAL_POINT_CACHE_SIZE=1)
+        run_async(store.put("image.jpg", POINTS))
+        run_async(store.put("other.jpg", []))
+
+        expect(run_async(store.get("image.jpg"))).to_be_null()
+        expect(run_async(store.get("other.jpg"))).to_equal([])
+
+
+class StorageFocalPointStoreTestCase(TestCase):
+    def test_uses_the_detector_data_of_the_storage(self):
+        storage = FakeStorage()
+        store = StorageFocalPointStore(mock.Mock(modules=mock.Mock(storage=storage)))
+
+        run_async(store.put("image.jpg", POINTS))
+
+        expect(storage.points).to_equal(POINTS)
+        expect(run_async(store.get("image.jpg"))).to_equal(POINTS)
+
+
+class FocalPointStorageTestCase(TestCase):
+    def setUp(self):
+        cache.shared_caches.clear()
+        self.store = MemoryFocalPointStore(mock.Mock(config=Config()))
+        self.metrics = mock.Mock()
+
+    def test_returns_the_points_of_the_store(self):
+        run_async(self.store.put("image.jpg", POINTS))
+        storage = FocalPointStorage(FakeStorage(), self.store, self.metrics)
+
+        expect(run_async(storage.get_detector_data("image.jpg"))).to_equal(POINTS)
+        self.metrics.incr.assert_called_once_with(
+            "distributed_collage.focal_points.hit"
+        )
+
+    def test_keeps_the_points_of_the_storage(self):
+        storage = FocalPointStorage(FakeStorage(POINTS), self.store, self.metrics)
+
+        expect(run_async(storage.get_detector_data("image.jpg"))).to_equal(POINTS)
+        expect(run_async(self.store.get("image.jpg"))).to_equal(POINTS)
+
+    def test_keeps_detected_points_in_both(self):
+        wrapped = FakeStorage()
+        storage = FocalPointStorage(wrapped, self.store, self.metrics)
+
+        run_async(storage.put_detector_data("image.jpg", POINTS))
+
+        expect(wrapped.points).to_equal(POINTS)
+        expect(run_async(self.store.get("image.jpg"))).to_equal(POINTS)
+
+    def test_delegates_everything_else(self):
+        wrapped = FakeStorage()
+        storage = FocalPointStorage(wrapped, self.store, self.metrics)
+
+        storage.put("image.jpg", b"bytes")
+
+        wrapped.put.assert_called_once_with("image.jpg", b"bytes")
+
+
+class GetFocalFiltersTestCase(TestCase):
+    def test_places_each_point(self):
+        filters = get_focal_filters(POINTS)
+
+        expect(filters).to_equal(["focal(100x40:160x120)"])
+
+    def test_places_features_as_single_pixels(self):
+        filters = get_focal_filters([FocalPoint(30, 20).to_dict()])
+
+        expect(filters).to_equal(["focal(30x20:31x21)"])
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+import asyncio
+
+import mock
+from preggy import expect
+from thumbor.config import Config
+from thumbor.context import Context
+from thumbor.loaders import LoaderResult
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.web import Application, RequestHandler
+
+from thumbor_distributed_collage_filter import http_loader
+
+TILE = b"tile contents"
+
+
+class TileHandler(RequestHandler):
+    running = 0
+    max_running = 0
+
+    async def get(self, delay):
+        TileHandler.running += 1
+        TileHandler.max_running = max(TileHandler.running, TileHandler.max_running)
+        try:
+            await asyncio.sleep(float(delay))
+        finally:
+            TileHandler.running -= 1
+
+        self.set_header("Cache-Control", "max-age=60,public")
+        self.write(TILE)
+
+
+class MissingHandler(RequestHandler):
+    def get(self):
+        self.set_status(404)
+
+
+class HttpLoaderTestCase(AsyncHTTPTestCase):
+    def setUp(self):
+        super(HttpLoaderTestCase, self).setUp()
+        TileHandler.running = TileHandler.max_running = 0
+
+    def get_app(self):
+        return Application(
+            [
+                (r"/tile/([0-9.]+)", TileHandler),
+                (r"/missing", MissingHandler),
+            ]
+        )
+
+    def get_context(self, **settings):
+        return Context(config=Config(**settings))
+
+    @gen_test
+    async def test_loads_tiles(self):
+        result = await http_loader.load(self.get_context(), self.get_url("/tile/0"))
+
+        expect(result.successful).to_be_true()
+        expect(result.buffer).to_equal(TILE)
+        expect(result.metadata["Cache-Control"]).to_equal("max-age=60,public")
+
+    @gen_test
+    async def test_revalidates_tiles(self):
+        url = self.get_url("/tile/0")
+        result = await http_loader.load(self.get_context(), url)
+
+        result = await http_loader.load(
+            self.get_context(), url, headers={"If-None-Match": result.metadata["Etag"]}
+        )
+
+        expect(result.successful).to_be_true()
+        expect(result.buffer).to_be_null()
+        expect(result.extras).to_equal({"not_modified": True})
+        expect(result.metadata["Cache-Control"]).to_equal("max-age=60,public")
+
+    @gen_test
+    async def test_fails_on_http_errors(self):
+        result = await http_loader.load(self.get_context(), self.get_url("/missing"))
+
+        expect(result.successful).to_be_false()
+        expect(result.error).to_equal(LoaderResult.ERROR_NOT_FOUND)
+        expect(result.extras["code"]).to_equal(404)
+
+    @gen_test
+    async def test_fails_when_the_server_is_down(self):
+        result = await http_loader.load(self.get_context(), "http://127.0.0.1:1/")
+
+        expect(result.successful).to_be_false()
+
+    @gen_test
+    async def test_times_out(self):
+        context = self.get_context(
+            DISTRIBUTED_COLLAGE_FILTER_LOADER_REQUEST_TIMEOUT=0.05
+        )
+        result = await http_loader.load(context, self.get_url("/tile/1"))
+
+        expect(result.successful).to_be_false()
+        expect(result.error).to_equal(LoaderResult.ERROR_TIMEOUT)
+
+    @gen_test
+    async def test_shares_a_pool_with_a_per_host_limit(self):
+        context = self.get_context(
+            DISTRIBUTED_COLLAGE_FILTER_LOADER_MAX_CONNECTIONS_PER_HOST=2
+        )
+        loads = [
+            http_loader.load(context, self.get_url("/tile/0.05")) for _ in range(5)
+        ]
+
+        async def stats_while_loading():
+            await asyncio.sleep(0.02)
+            return http_loader.get_pool_stats()
+
+        results = await asyncio.gather(stats_while_loading(), *loads)
+        stats = results[0]
+
+        expect(all(result.successful for result in results[1:])).to_be_true()
+        expect(TileHandler.max_running).to_equal(2)
+        expect(stats["active"]).to_equal(2)
+        expect(stats["queued"]).to_equal(3)
+        expect(stats["max_connections_per_host"]).to_equal(2)
+        expect(http_loader.get_pool_stats()["requests"]).to_equal(5)
+        expect(http_loader.get_pool_stats()["active"]).to_equal(0)
+
+    def test_warns_once_without_pycurl(self):
+        with mock.patch.object(http_loader, "CurlAsyncHTTPClient", None):
+            with mock.patch.object(http_loader, "simple_client_warned", False):
+                with mock.patch.object(http_loader.logger, "warning") as warning:
+                    first = http_loader.TilePool(4, 2)
+                    second = http_loader.TilePool(4, 2)
+
+        first.client.close()
+        second.client.close()
+        expect(first.stats()["client"]).to_equal("SimpleAsyncHTTPClient")
+        expect(warning.call_count).to_equal(1)
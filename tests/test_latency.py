@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+from unittest import TestCase
+
+from preggy import expect
+
+from thumbor_distributed_collage_filter import latency
+from thumbor_distributed_collage_filter.latency import LatencyTracker, get_tracker
+
+
+class LatencyTrackerTestCase(TestCase):
+    def test_has_no_p95_before_enough_samples(self):
+        tracker = LatencyTracker(min_samples=3)
+        tracker.observe(0.1)
+        tracker.observe(0.1)
+
+        expect(tracker.p95).to_be_null()
+
+    def test_p95_of_constant_latencies_is_the_latency(self):
+        tracker = LatencyTracker(min_samples=3)
+        for _ in range(3):
+            tracker.observe(0.1)
+
+        expect(round(tracker.p95, 6)).to_equal(0.1)
+
+    def test_p95_covers_most_latencies(self):
+        tracker = LatencyTracker()
+        latencies = [0.1, 0.12, 0.09, 0.11, 0.1, 0.3, 0.1, 0.08, 0.1, 0.12] * 10
+        for value in latencies:
+            tracker.observe(value)
+
+        expect(tracker.p95).to_be_greater_than(tracker.mean)
+        slower = [value for value in latencies if value > tracker.p95]
+        expect(len(slower)).to_be_lesser_than(len(latencies) * 0.15)
+
+    def test_follows_a_slower_server(self):
+        tracker = LatencyTracker()
+        for _ in range(20):
+            tracker.observe(0.1)
+        before = tracker.p95
+        for _ in range(20):
+            tracker.observe(0.5)
+
+        expect(tracker.p95).to_be_greater_than(before)
+        expect(tracker.mean).to_be_greater_than(0.4)
+
+
+class GetTrackerTestCase(TestCase):
+    def setUp(self):
+        latency.trackers.clear()
+
+    def test_shares_the_tracker_of_each_host(self):
+        expect(get_tracker("http://a")).to_equal(get_tracker("http://a"))
+        expect(get_tracker("http://a")).not_to_equal(get_tracker("http://b"))
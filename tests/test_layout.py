@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2011 globo.com thumbor@googlegroups.com
+
+from unittest import TestCase
+
+from preggy import expect
+
+from thumbor_distributed_collage_filter.layout import (
+    LAYOUTS,
+    Slot,
+    get_grid_size,
+    get_slots,
+    split,
+)
+
+
+class SplitTestCase(TestCase):
+    def test_gives_the_remainder_to_the_last_part(self):
+        expect(split(100, 3)).to_equal([(0, 33), (33, 33), (66, 34)])
+
+    def test_splits_exactly(self):
+        expect(split(300, 2)).to_equal([(0, 150), (150, 150)])
+
+    def test_single_part(self):
+        expect(split(300, 1)).to_equal([(0, 300)])
+
+
+class LayoutTestCase(TestCase):
+    def test_horizontal(self):
+        expect(get_slots("horizontal", 300, 200, 3)).to_equal(
+            [Slot(0, 0, 100, 200), Slot(100, 0, 100, 200), Slot(200, 0, 100, 200)]
+        )
+
+    def test_horizontal_with_remainder(self):
+        expect(get_slots("horizontal", 200, 200, 3)).to_equal(
+            [Slot(0, 0, 66, 200), Slot(66, 0, 66, 200), Slot(132, 0, 68, 200)]
+        )
+
+    def test_vertical(self):
+        expect(get_slots("vertical", 200, 301, 2)).to_equal(
+            [Slot(0, 0, 200, 150), Slot(0, 150, 200, 151)]
+        )
+
+    def test_grid_size(self):
+        expect(get_grid_size(1)).to_equal((1, 1))
+        expect(get_grid_size(4)).to_equal((2, 2))
+        expect(get_grid_size(5)).to_equal((3, 2))
+        expect(get_grid_size(16)).to_equal((4, 4))
+        expect(get_grid_size(17)).to_equal((5, 4))
+
+    def test_grid(self):
+        expect(get_slots("grid", 300, 200, 4)).to_equal(
+            [
+                Slot(0, 0, 150, 100),
+                Slot(150, 0, 150, 100),
+                Slot(0, 100, 150, 100),
+                Slot(150, 100, 150, 100),
+            ]
+        )
+
+    def test_grid_leaves_the_last_cells_empty(self):
+        expect(get_slots("grid", 300, 200, 5)).to_equal(
+            [
+                Slot(0, 0, 100, 100),
+                Slot(100, 0, 100, 100),
+                Slot(200, 0, 100, 100),
+                Slot(0, 100, 100, 100),
+                Slot(100, 100, 100, 100),
+            ]
+        )
+
+    def test_justified_spreads_every_row(self):
+        expect(get_slots("justified", 300, 200, 5)).to_equal(
+            [
+                Slot(0, 0, 100, 100),
+                Slot(100, 0, 100, 100),
+                Slot(200, 0, 100, 100),
+                Slot(0, 100, 150, 100),
+                Slot(150, 100, 150, 100),
+            ]
+        )
+
+    def test_justified_balances_the_rows(self):
+        slots = get_slots("justified", 300, 300, 7)
+
+        expect([slot.y for slot in slots]).to_equal([0, 0, 0, 100, 100, 200, 200])
+        expect([slot.width for slot in slots]).to_equal(
+            [100, 100, 100, 150, 150, 150, 150]
+        )
+
+    def test_slots_cover_the_collage_without_overlapping(self):
+        for name in ("horizontal", "vertical", "justified"):
+            for count in range(1, 18):
+                covered = set()
+                for slot in get_slots(name, 301, 199, count):
+                    pixels = {
+                        (x, y)
+                        for x in range(slot.x, slot.x + slot.width)
+                        for y in range(slot.y, slot.y + slot.height)
+                    }
+                    expect(covered & pixels).to_be_empty()
+                    covered |= pixels
+                expect(len(covered)).to_equal(301 * 199)
+
+    def test_layouts(self):
+        expect(sorted(LAYOUTS)).to_equal(
+            ["grid", "horizontal", "justified", "vertical"]
+        )
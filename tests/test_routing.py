@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+from collections import Counter
+from unittest import TestCase
+
+from preggy import expect
+from thumbor.config import Config
+
+from thumbor_distributed_collage_filter import routing
+from thumbor_distributed_collage_filter.routing import (
+    HashRing,
+    NodeHealth,
+    get_health,
+    route,
+)
+
+NODES = ["http://a", "http://b", "http://c"]
+KEYS = ["image-%d.jpg" % index for index in range(1000)]
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class HashRingTestCase(TestCase):
+    def test_orders_every_node_for_a_key(self):
+        nodes = HashRing(NODES).get_nodes("image.jpg")
+
+        expect(sorted(nodes)).to_equal(NODES)
+        expect(HashRing(NODES).get_nodes("image.jpg")).to_equal(nodes)
+
+    def test_spreads_the_keys_over_the_nodes(self):
+        ring = HashRing(NODES)
+        owners = Counter(ring.get_nodes(key)[0] for key in KEYS)
+
+        for node in NODES:
+            expect(owners[node]).to_be_greater_than(len(KEYS) / 6)
+
+    def test_moves_only_the_keys_of_a_removed_node(self):
+        ring = HashRing(NODES)
+        smaller = HashRing(NODES[:2])
+
+        for key in KEYS:
+            owner = ring.get_nodes(key)[0]
+            if owner != NODES[2]:
+                expect(smaller.get_nodes(key)[0]).to_equal(owner)
+            else:
+                # its keys go to the next node on the ring
+                expect(smaller.get_nodes(key)[0]).to_equal(ring.get_nodes(key)[1])
+
+
+class NodeHealthTestCase(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.health = NodeHealth(3, 10, 30, clock=self.clock)
+
+    def test_ejects_after_too_many_recent_failures(self):
+        expect(self.health.failure()).to_be_false()
+        expect(self.health.failure()).to_be_false()
+        expect(self.health.failure()).to_be_true()
+        expect(self.health.healthy).to_be_false()
+
+        self.clock.now = 30
+        expect(self.health.healthy).to_be_true()
+
+    def test_forgets_old_failures(self):
+        self.health.failure()
+        self.health.failure()
+        self.clock.now = 11
+
+        expect(self.health.failure()).to_be_false()
+        expect(self.health.healthy).to_be_true()
+
+    def test_a_success_clears_the_failures(self):
+        self.health.failure()
+        self.health.failure()
+        self.health.success()
+
+        expect(self.health.failure()).to_be_false()
+
+
+class RouteTestCase(TestCase):
+    def setUp(self):
+        routing.health.clear()
+        routing.rings.clear()
+        self.config = Config(DISTRIBUTED_COLLAGE_FILTER_EJECT_FAILURES=1)
+
+    def test_keeps_a_single_node(self):
+        expect(route(NODES[:1], "image.jpg", self.config)).to_equal(NODES[:1])
+
+    def test_leaves_ejected_nodes_out(self):
+        nodes = route(NODES, "image.jpg", self.config)
+        get_health(nodes[0], self.config).failure()
+
+        expect(route(NODES, "image.jpg", self.config)).to_equal(nodes[1:])
+
+    def test_uses_every_node_when_all_are_ejected(self):
+        nodes = route(NODES, "image.jpg", self.config)
+        for node in NODES:
+            get_health(node, self.config).failure()
+
+        expect(route(NODES, "image.jpg", self.config)).to_equal(nodes)
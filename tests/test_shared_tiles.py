@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+import os
+import tempfile
+from unittest import TestCase
+
+from preggy import expect
+
+from thumbor_distributed_collage_filter.shared_tiles import (
+    SEQUENCE,
+    SharedTileTable,
+    get_shared_table,
+    tables,
+)
+
+
+class Config(object):
+    pass
+
+
+class SharedTileTableTestCase(TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "tiles")
+        self.table = self.get_table()
+
+    def tearDown(self):
+        self.table.close()
+
+    def get_table(self, slots=16, slot_size=64, ways=4):
+        return SharedTileTable(self.path, slots, slot_size, ways)
+
+    def test_returns_stored_values(self):
+        expect(self.table.put("a", b"value", 60)).to_be_true()
+
+        expect(self.table.get("a")).to_equal(b"value")
+        expect(self.table.get("b")).to_be_null()
+
+    def test_replaces_values_of_the_same_key(self):
+        self.table.put("a", b"first", 60)
+        self.table.put("a", b"second", 60)
+
+        expect(self.table.get("a")).to_equal(b"second")
+        expect(self.table.stats()["used"]).to_equal(1)
+
+    def test_expires_values(self):
+        self.table.put("a", b"value", 10, now=100)
+
+        expect(self.table.get("a", now=109)).to_equal(b"value")
+        expect(self.table.get("a", now=110)).to_be_null()
+
+    def test_does_not_store_values_larger_than_a_slot(self):
+        expect(self.table.put("a", b"x" * 65, 60)).to_be_false()
+        expect(self.table.put("b", b"x" * 64, 0)).to_be_false()
+
+        expect(self.table.get("a")).to_be_null()
+        expect(self.table.get("b")).to_be_null()
+
+    def test_evicts_values_not_read_since_the_clock_hand_passed(self):
+        table = SharedTileTable(self.path + "-set", 2, 64, ways=2)
+        table.put("a", b"a", 60)
+        table.put("b", b"b", 60)
+        table.get("a")
+
+        table.put("c", b"c", 60)
+
+        expect(table.get("a")).to_equal(b"a")
+        expect(table.get("b")).to_be_null()
+        expect(table.get("c")).to_equal(b"c")
+        table.close()
+
+    def test_shares_values_with_other_processes(self):
+        self.table.put("a", b"parent", 60)
+
+        pid = os.fork()
+        if pid == 0:
+            child = self.get_table()
+            found = child.get("a") == b"parent"
+            child.put("b", b"child", 60)
+            os._exit(0 if found else 1)
+
+        _, status = os.waitpid(pid, 0)
+        expect(os.WEXITSTATUS(status)).to_equal(0)
+        expect(self.table.get("b")).to_equal(b"child")
+
+    def test_keeps_values_of_an_existing_file(self):
+        self.table.put("a", b"value", 60)
+
+        other = self.get_table()
+
+        expect(other.get("a")).to_equal(b"value")
+        other.close()
+
+    def test_refuses_a_file_of_another_size(self):
+        with expect.error_to_happen(ValueError):
+            self.get_table(slot_size=128)
+
+    def test_refuses_a_symbolic_link(self):
+        os.symlink(self.path, self.path + "-link")
+
+        with expect.error_to_happen(OSError):
+            SharedTileTable(self.path + "-link", 16, 64, 4)
+
+    def test_refuses_a_file_open_to_other_users(self):
+        os.chmod(self.path, 0o666)
+
+        with expect.error_to_happen(ValueError):
+            self.get_table()
+
+    def test_misses_slots_being_written(self):
+        self.table.put("a", b"value", 60)
+        for slot in range(self.table.slots):
+            offset = self.table._get_offset(slot)
+            sequence = SEQUENCE.unpack_from(self.table.map, offset)[0]
+            SEQUENCE.pack_into(self.table.map, offset, sequence | 1)
+
+        expect(self.table.get("a")).to_be_null()
+
+    def test_clears_values(self):
+        self.table.put("a", b"value", 60)
+
+        self.table.clear()
+
+        expect(self.table.get("a")).to_be_null()
+        expect(self.table.stats()["used"]).to_equal(0)
+
+
+class GetSharedTableTestCase(TestCase):
+    def setUp(self):
+        tables.clear()
+        self.config = Config()
+        self.config.DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_PATH = os.path.join(
+            tempfile.mkdtemp(), "tiles"
+        )
+        self.config.DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_SLOTS = 16
+        self.config.DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_SLOT_SIZE = 64
+
+    def tearDown(self):
+        tables.clear()
+
+    def test_returns_the_same_table(self):
+        expect(get_shared_table(self.config)).to_equal(get_shared_table(self.config))
+
+    def test_returns_none_if_the_file_cannot_be_mapped(self):
+        get_shared_table(self.config)
+        tables.clear()
+        self.config.DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_SLOT_SIZE = 128
+
+        expect(get_shared_table(self.config)).to_be_null()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+from unittest import TestCase
+
+import mock
+from libthumbor import CryptoURL
+from preggy import expect
+
+from thumbor_distributed_collage_filter import cache, signing
+from thumbor_distributed_collage_filter.signing import get_signer, sign
+
+PARAMS = {
+    "width": 150,
+    "height": 200,
+    "image_url": "image.jpg",
+    "smart": True,
+    "halign": "center",
+    "valign": "middle",
+    "filters": ["quality(100)"],
+}
+
+
+class SignTestCase(TestCase):
+    def setUp(self):
+        cache.shared_caches.clear()
+        signing.signers.clear()
+
+    def test_shares_the_signer_of_each_key(self):
+        expect(get_signer("KEY")).to_equal(get_signer("KEY"))
+        expect(get_signer("KEY")).not_to_equal(get_signer("OTHER KEY"))
+
+    def test_signs_like_libthumbor(self):
+        expect(sign("KEY", PARAMS)).to_equal(CryptoURL(key="KEY").generate(**PARAMS))
+
+    def test_signs_each_tile_once(self):
+        with mock.patch.object(CryptoURL, "generate", return_value="/path") as generate:
+            sign("KEY", PARAMS)
+            sign("KEY", dict(PARAMS))
+
+        expect(generate.call_count).to_equal(1)
+
+    def test_signs_different_tiles_and_keys(self):
+        paths = {
+            sign("KEY", PARAMS),
+            sign("KEY", dict(PARAMS, width=100)),
+            sign("KEY", dict(PARAMS, filters=["format(png)"])),
+            sign("OTHER KEY", PARAMS),
+        }
+
+        expect(paths).to_length(4)
+
+    def test_keeps_the_last_paths(self):
+        for width in range(10):
+            sign("KEY", dict(PARAMS, width=width), max_size=4)
+
+        expect(len(cache.get_shared_cache("signed_paths", 4))).to_equal(4)
+
+    def test_can_sign_every_tile_again(self):
+        with mock.patch.object(CryptoURL, "generate", return_value="/path") as generate:
+            sign("KEY", PARAMS, max_size=0)
+            sign("KEY", PARAMS, max_size=0)
+
+        expect(generate.call_count).to_equal(2)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+import json
+import tempfile
+from io import StringIO
+from os.path import dirname, join
+from unittest import TestCase
+
+import mock
+from preggy import expect
+from thumbor.loaders import http_loader
+from tornado.httpclient import AsyncHTTPClient
+
+from tests.stand_in import StandInServer
+from tests.test_filter import CollageTestCase, TileLoaderSpy
+from thumbor_distributed_collage_filter import cache
+from thumbor_distributed_collage_filter.cache import StorageTileCache
+from thumbor_distributed_collage_filter.warm import main, parse_spec, warm
+
+FIXTURES = join(dirname(__file__), "fixtures", "filters")
+URLS = ["800px-Guido-portrait-2014.jpg", "800px-Katherine_Maher.jpg"]
+
+
+class ParseSpecTestCase(TestCase):
+    def test_parses_specs(self):
+        spec = parse_spec('{"urls": "a.jpg|b.jpg", "width": 300, "height": 200}')
+
+        expect(spec).to_equal(
+            {
+                "urls": ["a.jpg", "b.jpg"],
+                "width": 300,
+                "height": 200,
+                "orientation": "horizontal",
+                "alignment": "smart",
+                "image": None,
+            }
+        )
+
+    def test_rejects_invalid_specs(self):
+        for line in (
+            "a.jpg",
+            "[]",
+            '{"width": 300, "height": 200}',
+            '{"urls": ["a.jpg"], "width": 300}',
+            '{"urls": ["a.jpg"], "width": 0, "height": 200}',
+        ):
+            with expect.error_to_happen(ValueError):
+                parse_spec(line)
+
+
+class WarmTestCase(CollageTestCase):
+    spec = {
+        "urls": URLS,
+        "width": 300,
+        "height": 200,
+        "orientation": "horizontal",
+        "alignment": "smart",
+        "image": None,
+    }
+
+    def setUp(self):
+        super(WarmTestCase, self).setUp()
+        cache.shared_caches.clear()
+        self.server = StandInServer("blue")
+
+    def tearDown(self):
+        self.server.stop()
+        super(WarmTestCase, self).tearDown()
+
+    def get_config(self):
+        cfg = super(WarmTestCase, self).get_config()
+        cfg.STORAGE = "thumbor.storages.file_storage"
+        cfg.FILE_STORAGE_ROOT_PATH = tempfile.mkdtemp()
+        cfg.DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE = "storage"
+        return cfg
+
+    def test_fills_the_tile_cache_in_process(self):
+        report = self.io_loop.run_sync(
+            lambda: warm(self.context, self.spec, in_process=True)
+        )
+
+        expect(report["tiles"]).to_equal(2)
+        expect(report["failed"]).to_be_empty()
+
+        spy = TileLoaderSpy()
+        hits = StorageTileCache.hits
+        with mock.patch.object(http_loader, "load", spy.load):
+            self.get_filtered("|".join(URLS))
+
+        expect(spy.max_running).to_equal(0)
+        expect(StorageTileCache.hits - hits).to_equal(2)
+
+    def test_requests_the_tiles_the_filter_would_request(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE = None
+        self.config.DISTRIBUTED_COLLAGE_FILTER_THUMBOR_SERVER_URL = self.server.url
+
+        report = self.io_loop.run_sync(lambda: warm(self.context, self.spec))
+        warmed = list(self.server.requests)
+        self.get_filtered("|".join(URLS))
+
+        expect(report["failed"]).to_be_empty()
+        expect(warmed).to_length(2)
+        expect(sorted(self.server.requests[2:])).to_equal(sorted(warmed))
+
+    def test_requests_the_collage_with_an_image(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_THUMBOR_SERVER_URL = self.get_url("")
+        spec = dict(self.spec, image="distributed_collage_fallback.png")
+        client = AsyncHTTPClient(force_instance=True)
+        self.addCleanup(client.close)
+
+        report = self.io_loop.run_sync(lambda: warm(self.context, spec, client=client))
+
+        expect(report["failed"]).to_be_empty()
+        expect(report["collage"]["status"]).to_equal(200)
+
+    def test_reports_the_failed_tiles(self):
+        spec = dict(self.spec, urls=[URLS[0], "missing.jpg"])
+
+        report = self.io_loop.run_sync(
+            lambda: warm(self.context, spec, in_process=True)
+        )
+
+        expect(report["failed"]).to_equal(
+            [{"url": "missing.jpg", "error": "not_found"}]
+        )
+
+    def test_rejects_specs_with_too_many_images(self):
+        self.config.DISTRIBUTED_COLLAGE_FILTER_MAX_IMAGES = 1
+        spy = TileLoaderSpy()
+
+        with mock.patch.object(http_loader, "load", spy.load):
+            report = self.io_loop.run_sync(lambda: warm(self.context, self.spec))
+
+        expect(report["error"]).to_equal("too many images")
+        expect(spy.max_running).to_equal(0)
+
+
+class MainTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.conf = join(self.root, "thumbor.conf")
+        with open(self.conf, "w") as conf:
+            conf.write(
+                'LOADER = "thumbor.loaders.file_loader"\n'
+                "FILE_LOADER_ROOT_PATH = %r\n"
+                'STORAGE = "thumbor.storages.file_storage"\n'
+                "FILE_STORAGE_ROOT_PATH = %r\n"
+                'DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE = "storage"\n'
+                % (FIXTURES, join(self.root, "storage"))
+            )
+
+    def run_main(self, lines, *args):
+        specs = join(self.root, "specs.jsonl")
+        with open(specs, "w") as specs_file:
+            specs_file.write("\n".join(lines))
+
+        with mock.patch("sys.stdout", StringIO()) as stdout:
+            status = main(["-c", self.conf] + list(args) + [specs])
+        return status, [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_reports_each_spec_as_a_json_line(self):
+        status, reports = self.run_main(
+            [
+                json.dumps({"urls": URLS, "width": 300, "height": 200}),
+                "",
+                "not a spec",
+            ],
+            "--in-process",
+        )
+
+        expect(status).to_equal(1)
+        reports = sorted(reports, key=lambda report: report["line"])
+        expect(reports).to_length(2)
+        expect(reports[0]["tiles"]).to_equal(2)
+        expect(reports[0]["failed"]).to_be_empty()
+        expect(reports[0]["time_ms"]).to_be_greater_than(0)
+        expect(reports[1]["line"]).to_equal(3)
+        expect(reports[1]).to_include("error")
+
+    def test_succeeds_when_every_spec_is_warmed(self):
+        status, _ = self.run_main(
+            [json.dumps({"urls": URLS[:1], "width": 300, "height": 200})],
+            "--in-process",
+        )
+
+        expect(status).to_equal(0)
+
+    def test_requires_a_server_unless_in_process(self):
+        with mock.patch("sys.stderr", StringIO()):
+            with expect.error_to_happen(SystemExit):
+                main(["-c", self.conf, "-"])
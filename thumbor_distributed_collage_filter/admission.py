@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Memory admission of the collages. Each collage reserves the bytes of its
+pixels from a budget shared by every collage of the process before its
+tiles are loaded, so a burst of large collages waits for memory instead of
+allocating all their canvases and tiles at once.
+"""
+
+import asyncio
+from collections import deque
+
+# RGBA
+BYTES_PER_PIXEL = 4
+
+budgets = {}
+
+
+def get_collage_bytes(width, height, slots, streaming=False):
+    """
+    Estimates the peak bytes of a collage: its canvas, the copy of the canvas
+    pasted over the image and the decoded tiles held at the same time (all
+    of them, or the largest one with streaming assembly).
+    """
+    tiles = [slot.width * slot.height * BYTES_PER_PIXEL for slot in slots]
+    tiles_bytes = (max(tiles) if streaming else sum(tiles)) if tiles else 0
+    return 2 * width * height * BYTES_PER_PIXEL + tiles_bytes
+
+
+class MemoryBudget(object):
+    """
+    Bytes reserved by the collages in flight, at most `max_bytes`. Collages
+    over the budget wait for the ones before them, in order.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.waiters = deque()
+
+    def _fits(self, nbytes):
+        return self.in_flight + nbytes <= self.max_bytes
+
+    async def acquire(self, nbytes, timeout=None):
+        """
+        Reserves `nbytes`, waiting at most `timeout` seconds for them. Returns
+        False if they were not available in time.
+        """
+        if nbytes > self.max_bytes:
+            return False
+
+        if not self.waiters and self._fits(nbytes):
+            self.in_flight += nbytes
+            return True
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (nbytes, waiter)
+        self.waiters.append(entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # granted while timing out
+                self.release(nbytes)
+            else:
+                self.waiters.remove(entry)
+                waiter.cancel()
+                self._wake()
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(nbytes)
+            elif entry in self.waiters:
+                self.waiters.remove(entry)
+                waiter.cancel()
+                self._wake()
+            raise
+        return True
+
+    def release(self, nbytes):
+        self.in_flight -= nbytes
+        self._wake()
+
+    def _wake(self):
+        while self.waiters and self._fits(self.waiters[0][0]):
+            nbytes, waiter = self.waiters.popleft()
+            self.in_flight += nbytes
+            waiter.set_result(True)
+
+    def stats(self):
+        return {
+            "max_bytes": self.max_bytes,
+            "in_flight": self.in_flight,
+            "waiting": len(self.waiters),
+        }
+
+
+def get_memory_budget(config):
+    """
+    Returns the budget shared by every collage of the process, or None if
+    DISTRIBUTED_COLLAGE_FILTER_MEMORY_BUDGET is 0.
+    """
+    max_bytes = getattr(config, "DISTRIBUTED_COLLAGE_FILTER_MEMORY_BUDGET", 0)
+    if not max_bytes:
+        return None
+
+    if max_bytes not in budgets:
+        budgets[max_bytes] = MemoryBudget(max_bytes)
+    return budgets[max_bytes]
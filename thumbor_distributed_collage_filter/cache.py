@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+import asyncio
+import json
+import struct
+import time
+from collections import OrderedDict
+
+from thumbor.context import Context, RequestParameters
+from thumbor.loaders import LoaderResult
+
+from thumbor_distributed_collage_filter.shared_tiles import get_shared_table
+
+DEFAULT_TILE_CACHE_SIZE = 64 * 1024 * 1024
+
+# headers and extras of a tile kept with its buffer by the caches storing
+# bytes (extras of epoch seconds, e.g. the freshness of revalidated tiles)
+TILE_HEADERS = ("Cache-Control", "ETag", "Last-Modified")
+TILE_EXTRAS = ("fresh_until", "stored_at")
+# magic and length of the JSON header preceding the buffer of a stored tile
+TILE_ENTRY = struct.Struct("<4sI")
+TILE_MAGIC = b"DCT1"
+
+
+class LRUCache(object):
+    """
+    Least recently used cache bounded by the total size of its values.
+
+    Every entry has its own time to live, expired entries are dropped when
+    they are looked up.
+    """
+
+    def __init__(self, max_size, clock=time.monotonic):
+        self.max_size = max_size
+        self.clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] <= self.clock():
+            self._remove(key)
+            entry = None
+
+        if entry is None:
+            if count:
+                self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        if count:
+            self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size, ttl):
+        if key in self._entries:
+            self._remove(key)
+
+        if ttl <= 0 or size > self.max_size:
+            return
+
+        self._entries[key] = (value, size, self.clock() + ttl)
+        self.size += size
+
+        while self.size > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size": self.size,
+        }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+
+shared_caches = {}
+
+
+def parse_cache_control(header):
+    """
+    Returns the directives of a Cache-Control header:
+    'max-age=86400, public' -> {"max-age": 86400, "public": True}
+    """
+    directives = {}
+    for directive in (header or "").split(","):
+        name, _, value = directive.partition("=")
+        name = name.strip().lower()
+        if not name:
+            continue
+
+        value = value.strip().strip('"')
+        if not value:
+            directives[name] = True
+            continue
+
+        try:
+            directives[name] = int(value)
+        except ValueError:
+            directives[name] = value
+    return directives
+
+
+def get_ttl(header, default, shared=True):
+    """
+    Seconds a cache may keep a response with the given Cache-Control header:
+    its s-maxage or max-age for a `shared` cache (a CDN or the collage
+    caches), only its max-age for a browser, or 0 if it must not be stored
+    or reused without revalidation.
+    """
+    directives = parse_cache_control(header)
+    if any(name in directives for name in ("no-store", "no-cache", "private")):
+        return 0
+
+    for name in ("s-maxage", "max-age") if shared else ("max-age",):
+        if isinstance(directives.get(name), int):
+            return max(directives[name], 0)
+
+    return default
+
+
+def get_aged_cache_control(header, age, default):
+    """
+    Returns the Cache-Control header of a response kept `age` seconds by a
+    cache: what is left of its max-age and s-maxage (`default` seconds if it
+    has none), so the responses made of it do not outlive it.
+    """
+    directives = parse_cache_control(header)
+    if not any(name in directives for name in ("max-age", "s-maxage")):
+        directives["max-age"] = default
+
+    parts = []
+    for name, value in directives.items():
+        if name in ("max-age", "s-maxage") and isinstance(value, int):
+            value = max(value - int(age), 0)
+        parts.append(name if value is True else "%s=%s" % (name, value))
+    return ", ".join(parts)
+
+
+def get_validators(metadata):
+    """
+    Returns the headers of a conditional request revalidating a response
+    with the given headers (its ETag and Last-Modified), empty if it has
+    none.
+    """
+    headers = {name.lower(): value for name, value in (metadata or {}).items()}
+    validators = {}
+    if headers.get("etag"):
+        validators["If-None-Match"] = headers["etag"]
+    if headers.get("last-modified"):
+        validators["If-Modified-Since"] = headers["last-modified"]
+    return validators
+
+
+def get_shared_cache(name, max_size):
+    """Returns the LRU cache `name` shared by every request of the process."""
+    key = (name, max_size)
+    if key not in shared_caches:
+        shared_caches[key] = LRUCache(max_size)
+    return shared_caches[key]
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: while a call is running,
+    the next ones with the same key wait for its result instead of running
+    again. The call runs in its own task, so cancelling one of the callers
+    does not cancel the others; it is cancelled with the last one.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.waiters = {}
+
+    def __len__(self):
+        return len(self.calls)
+
+    def _forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+            del self.waiters[key]
+
+    def _done(self, key, task):
+        self._forget(key, task)
+        if not task.cancelled():
+            # nobody may be waiting for it, do not log it as never retrieved
+            task.exception()
+
+    async def do(self, key, fn):
+        task = self.calls.get(key)
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(fn())
+            self.waiters[key] = 0
+            task.add_done_callback(lambda task: self._done(key, task))
+
+        self.waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.calls.get(key) is task and self.waiters[key] == 1:
+                self._forget(key, task)
+                task.cancel()
+            raise
+        finally:
+            if self.calls.get(key) is task:
+                self.waiters[key] -= 1
+
+
+def get_result_size(result):
+    """
+    Bytes held by a tile: its encoded buffer or, for tiles rendered in
+    process, the decoded pixels of its engine.
+    """
+    if result.buffer is not None:
+        return len(result.buffer)
+
+    engine = result.extras.get("engine")
+    if engine is None:
+        return 0
+
+    width, height = engine.size
+    return width * height * 4
+
+
+def pack_tile(result, ttl, now=None):
+    """
+    Returns the bytes of a tile stored for `ttl` seconds by the caches
+    storing bytes: its expiration, TILE_HEADERS and TILE_EXTRAS, then its
+    buffer.
+    """
+    now = time.time() if now is None else now
+    headers = {name.lower(): value for name, value in result.metadata.items()}
+    metadata = {
+        name: headers[name.lower()] for name in TILE_HEADERS if name.lower() in headers
+    }
+    extras = {
+        name: result.extras[name] for name in TILE_EXTRAS if name in result.extras
+    }
+    header = json.dumps(
+        {"expires": now + ttl, "metadata": metadata, "extras": extras}
+    ).encode("utf-8")
+    return TILE_ENTRY.pack(TILE_MAGIC, len(header)) + header + (result.buffer or b"")
+
+
+def unpack_tile(data, now=None):
+    """
+    Returns the `LoaderResult` of the bytes of `pack_tile`, with its headers
+    as metadata and its extras, or None if they expired or are not a stored
+    tile.
+    """
+    if not data or len(data) < TILE_ENTRY.size:
+        return None
+
+    magic, length = TILE_ENTRY.unpack_from(data)
+    if magic != TILE_MAGIC:
+        return None
+
+    start = TILE_ENTRY.size
+    try:
+        header = json.loads(bytes(data[start : start + length]).decode("utf-8"))
+    except ValueError:
+        return None
+
+    now = time.time() if now is None else now
+    if header["expires"] <= now:
+        return None
+    return LoaderResult(
+        buffer=bytes(data[start + length :]),
+        metadata=header["metadata"],
+        extras=header.get("extras", {}),
+    )
+
+
+class BaseTileCache(object):
+    """
+    Interface of the rendered tile caches. `key` is the thumbor path of the
+    tile and values are the successful `LoaderResult`s of its load.
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    async def get(self, key):
+        raise NotImplementedError()
+
+    async def put(self, key, result, ttl):
+        raise NotImplementedError()
+
+
+class MemoryTileCache(BaseTileCache):
+    """Keeps the tiles in a LRU cache shared by every request of the process."""
+
+    def __init__(self, context):
+        super(MemoryTileCache, self).__init__(context)
+        max_size = getattr(
+            context.config,
+            "DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE_SIZE",
+            DEFAULT_TILE_CACHE_SIZE,
+        )
+        self.cache = get_shared_cache("tiles", max_size)
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def put(self, key, result, ttl):
+        self.cache.put(key, result, get_result_size(result), ttl)
+
+
+class StorageTileCache(BaseTileCache):
+    """
+    Keeps the encoded tiles in thumbor's STORAGE, so they can be shared by
+    every thumbor process using it, with their expiration and headers (see
+    `pack_tile`). The storage may drop them sooner (see
+    STORAGE_EXPIRATION_SECONDS).
+    """
+
+    hits = 0
+    misses = 0
+
+    def get_path(self, key):
+        return "distributed_collage/%s" % key
+
+    async def get(self, key):
+        result = unpack_tile(await self.context.modules.storage.get(self.get_path(key)))
+        if result is None:
+            StorageTileCache.misses += 1
+            return None
+
+        StorageTileCache.hits += 1
+        return result
+
+    async def put(self, key, result, ttl):
+        if result.buffer is None or ttl <= 0:
+            return
+
+        await self.context.modules.storage.put(
+            self.get_path(key), pack_tile(result, ttl)
+        )
+
+
+class ResultStorageTileCache(BaseTileCache):
+    """
+    Keeps the encoded tiles in thumbor's RESULT_STORAGE under the unsigned
+    tile path. The tile servers keep their results under the signed request
+    paths, so neither finds the entries of the other. Their expiration and
+    headers are kept apart, under "distributed_collage/meta/" and the tile
+    path (see `pack_tile`). The result storage may drop them sooner (see
+    RESULT_STORAGE_EXPIRATION_SECONDS).
+    """
+
+    hits = 0
+    misses = 0
+
+    def get_result_storage(self, key):
+        context = Context(
+            server=self.context.server,
+            config=self.context.config,
+            importer=self.context.modules.importer,
+            request_handler=self.context.request_handler,
+        )
+        context.request = RequestParameters(url="/%s" % key)
+        return context.modules.result_storage
+
+    def get_meta_key(self, key):
+        return "distributed_collage/meta/%s" % key
+
+    async def get_buffer(self, key):
+        result = await self.get_result_storage(key).get()
+        if isinstance(result, bytes):
+            return result
+        if result is None or not result.successful:
+            return None
+        return result.buffer
+
+    async def get(self, key):
+        meta = unpack_tile(await self.get_buffer(self.get_meta_key(key)))
+        buffer = await self.get_buffer(key) if meta is not None else None
+        if buffer is None:
+            ResultStorageTileCache.misses += 1
+            return None
+
+        ResultStorageTileCache.hits += 1
+        return LoaderResult(buffer=buffer, metadata=meta.metadata, extras=meta.extras)
+
+    async def put(self, key, result, ttl):
+        if result.buffer is None or ttl <= 0:
+            return
+
+        await self.get_result_storage(key).put(result.buffer)
+        await self.get_result_storage(self.get_meta_key(key)).put(
+            pack_tile(LoaderResult(metadata=result.metadata, extras=result.extras), ttl)
+        )
+
+
+class SharedMemoryTileCache(BaseTileCache):
+    """
+    Keeps the encoded tiles in a memory-mapped table shared by every thumbor
+    process of the host (see DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_*).
+    Tiles larger than a slot of the table, with their headers (see
+    `pack_tile`), are not kept.
+    """
+
+    hits = 0
+    misses = 0
+
+    def __init__(self, context):
+        super(SharedMemoryTileCache, self).__init__(context)
+        self.table = get_shared_table(context.config)
+
+    async def get(self, key):
+        result = unpack_tile(self.table.get(key)) if self.table is not None else None
+        if result is None:
+            SharedMemoryTileCache.misses += 1
+            return None
+
+        SharedMemoryTileCache.hits += 1
+        return result
+
+    async def put(self, key, result, ttl):
+        if self.table is None or result.buffer is None or ttl <= 0:
+            return
+
+        self.table.put(key, pack_tile(result, ttl), ttl)
+
+
+TILE_CACHES = {
+    "memory": MemoryTileCache,
+    "storage": StorageTileCache,
+    "result_storage": ResultStorageTileCache,
+    "shared_memory": SharedMemoryTileCache,
+}
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+import numpy as np
+
+
+def to_rgba(mode, data, size):
+    """
+    Returns the pixels returned by `engine.image_data_as_rgb()` as an RGBA
+    array of shape (height, width, 4).
+    """
+    width, height = size
+    pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width, len(mode))
+    if mode == "RGBA":
+        return pixels
+
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    for index, channel in enumerate("RGB"):
+        rgba[..., index] = pixels[..., mode.index(channel)]
+    rgba[..., 3] = pixels[..., mode.index("A")] if "A" in mode else 255
+    return rgba
+
+
+class Canvas(object):
+    """
+    Transparent RGBA canvas the tiles of a collage are written to.
+
+    Tiles never overlap, so each one is copied straight into its slot
+    instead of being alpha composited over the whole canvas.
+    """
+
+    def __init__(self, width, height):
+        self.pixels = np.zeros((height, width, 4), dtype=np.uint8)
+        self.covered = 0
+        self.has_alpha = False
+
+    @property
+    def size(self):
+        return self.pixels.shape[1], self.pixels.shape[0]
+
+    @property
+    def opaque(self):
+        """True when every pixel of the canvas was covered by an opaque tile."""
+        width, height = self.size
+        return not self.has_alpha and self.covered == width * height
+
+    def paste(self, tile, x, y):
+        width, height = self.size
+        tile = tile[: max(height - y, 0), : max(width - x, 0)]
+        tile_height, tile_width = tile.shape[:2]
+
+        self.pixels[y : y + tile_height, x : x + tile_width] = tile
+        self.covered += tile_width * tile_height
+        if not self.has_alpha and tile_width and tile_height:
+            self.has_alpha = bool(tile[..., 3].min() < 255)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Circuit breakers of the origins of the source images. After failing
+repeatedly, an origin is not requested again for a while, so the tiles of
+every collage referencing it fail right away instead of each one waiting
+for it and retrying.
+"""
+
+import time
+from urllib.parse import urlparse
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+breakers = {}
+
+
+def get_origin(url):
+    """
+    Returns the host of the source image `url`, with or without a scheme
+    ("s.glbimg.com/image.jpg" -> "s.glbimg.com"), or None for a path
+    without one ("image.jpg", "images/image.jpg"), which has no origin.
+    """
+    if "://" in url:
+        return urlparse(url).netloc.lower() or None
+
+    host, slash, _ = url.partition("/")
+    host = host.lower()
+    if slash and ("." in host or ":" in host or host == "localhost"):
+        return host
+    return None
+
+
+class CircuitBreaker(object):
+    """
+    Closed until `max_failures` consecutive failures, then open (every call
+    is refused) for `reset_seconds`. Then half open: a single call is let
+    through as a probe, closing the circuit if it succeeds and opening it
+    again if it fails. A probe that never reports back is replaced after
+    `reset_seconds`.
+    """
+
+    def __init__(self, max_failures, reset_seconds, clock=time.monotonic):
+        self.max_failures = max_failures
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_at = None
+        self.trips = 0
+
+    def allow(self):
+        """Returns whether a call may be made now."""
+        if self.state == CLOSED:
+            return True
+
+        now = self.clock()
+        if self.state == OPEN:
+            if now < self.opened_at + self.reset_seconds:
+                return False
+            self.state = HALF_OPEN
+            self.probe_at = None
+
+        if self.probe_at is not None and now < self.probe_at + self.reset_seconds:
+            return False
+        self.probe_at = now
+        return True
+
+    def success(self):
+        """Records a successful call, returning True if it closed the circuit."""
+        closed = self.state != CLOSED
+        self.state = CLOSED
+        self.failures = 0
+        self.probe_at = None
+        return closed
+
+    def failure(self):
+        """Records a failed call, returning True if it opened the circuit."""
+        self.failures += 1
+        if self.state == CLOSED and self.failures < self.max_failures:
+            return False
+
+        self.state = OPEN
+        self.opened_at = self.clock()
+        self.probe_at = None
+        self.trips += 1
+        return True
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "trips": self.trips}
+
+
+def get_breaker(origin, config):
+    """
+    Returns the circuit breaker of `origin`, or None if it has no origin or
+    DISTRIBUTED_COLLAGE_FILTER_CIRCUIT_FAILURES is 0.
+    """
+    max_failures = getattr(config, "DISTRIBUTED_COLLAGE_FILTER_CIRCUIT_FAILURES", 0)
+    if origin is None or not max_failures:
+        return None
+
+    if origin not in breakers:
+        breakers[origin] = CircuitBreaker(
+            max_failures,
+            getattr(config, "DISTRIBUTED_COLLAGE_FILTER_CIRCUIT_RESET_SECONDS", 30),
+        )
+    return breakers[origin]
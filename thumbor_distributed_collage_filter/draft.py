@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Reduced decoding of the source images of the tiles rendered in process.
+JPEG images can be decoded at 1/2, 1/4 or 1/8 of their size for almost
+the cost of a decode at that size, so a 800px source going to a 75px
+tile never has all its pixels decoded. Smart tiles are not drafted, their
+focal points are detected on and cropped from the full image.
+"""
+
+from thumbor.utils import logger
+
+
+def draft(engine, width, height):
+    """
+    Asks PIL to decode the image of `engine` at the smallest JPEG scale
+    still covering a `width` x `height` tile, before its pixels are read.
+    Returns the scale the image was reduced by, 1 for any other engine or
+    format.
+    """
+    image_draft = getattr(engine.image, "draft", None)
+    if image_draft is None or not width or not height:
+        return 1
+
+    # the tile is cropped from the image after its EXIF rotation
+    if engine.get_orientation() in (5, 6, 7, 8):
+        width, height = height, width
+
+    source_width = engine.size[0]
+    try:
+        image_draft(None, (width, height))
+    except Exception as err:
+        logger.warning("filters.distributed_collage: Reduced decoding failed: %s" % err)
+        return 1
+
+    return source_width / float(engine.size[0])
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Thread pool running the CPU bound work of the collages (decoding the tiles
+and composing them) out of the IOLoop, so a collage does not stall the
+other requests of its thumbor process. PIL and NumPy release the GIL while
+decoding and copying pixels.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+pools = {}
+
+
+class AssemblyPoolFull(Exception):
+    pass
+
+
+class AssemblyPool(object):
+    """
+    Runs functions in `size` threads. At most `max_queue` calls wait for a
+    free thread (0 for no limit), the next ones are refused with
+    `AssemblyPoolFull`.
+    """
+
+    def __init__(self, size, max_queue):
+        self.size = size
+        self.max_queue = max_queue
+        self.queued = 0
+        self.running = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            size, thread_name_prefix="distributed_collage"
+        )
+
+    async def run(self, fn, *args):
+        """Returns the seconds the call waited for a thread and its result."""
+        with self.lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                raise AssemblyPoolFull()
+            self.queued += 1
+
+        submitted = time.perf_counter()
+
+        def call():
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            wait = time.perf_counter() - submitted
+            try:
+                return wait, fn(*args)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        future = self.executor.submit(call)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # it never got a thread, so it never left the queue
+            if future.cancel():
+                with self.lock:
+                    self.queued -= 1
+            raise
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "max_queue": self.max_queue,
+            "queued": self.queued,
+            "running": self.running,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def get_assembly_pool(config):
+    """
+    Returns the pool shared by every collage of the process, or None if
+    DISTRIBUTED_COLLAGE_FILTER_ASSEMBLY_THREADS is 0.
+    """
+    size = getattr(config, "DISTRIBUTED_COLLAGE_FILTER_ASSEMBLY_THREADS", 0)
+    if not size:
+        return None
+
+    max_queue = getattr(config, "DISTRIBUTED_COLLAGE_FILTER_ASSEMBLY_QUEUE_SIZE", 0)
+    key = (size, max_queue)
+    if key not in pools:
+        pools[key] = AssemblyPool(size, max_queue)
+    return pools[key]
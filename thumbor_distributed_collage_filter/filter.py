@@ -8,125 +8,1178 @@
 # http://www.opensource.org/licenses/MIT-license
 # Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
 
-# TODO: vertical distribution
 # TODO: separator line between images
-# TODO: custom alignment
 
+import asyncio
 import math
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from os.path import abspath, dirname, isabs, join
+from urllib.parse import quote
 
-import cv2
 import numpy as np
+from PIL import ImageColor
+from thumbor.context import Context, RequestParameters
 from thumbor.filters import BaseFilter, filter_method
 from thumbor.loaders import LoaderResult
-from thumbor.point import FocalPoint
+from thumbor.transformer import Transformer
 from thumbor.utils import logger
-from libthumbor import CryptoURL
+from libthumbor.url import plain_image_url
+
+from thumbor_distributed_collage_filter.admission import (
+    get_collage_bytes,
+    get_memory_budget,
+)
+from thumbor_distributed_collage_filter.canvas import Canvas, to_rgba
+from thumbor_distributed_collage_filter.circuit import get_breaker, get_origin
+from thumbor_distributed_collage_filter.draft import draft
+from thumbor_distributed_collage_filter.focal_points import (
+    FOCAL_POINT_STORES,
+    FocalPointStorage,
+    get_focal_filters,
+)
+from thumbor_distributed_collage_filter.executor import (
+    AssemblyPoolFull,
+    get_assembly_pool,
+)
+from thumbor_distributed_collage_filter.latency import get_tracker
+from thumbor_distributed_collage_filter.layout import LAYOUTS, get_slots
+from thumbor_distributed_collage_filter.routing import get_health, route
+from thumbor_distributed_collage_filter.signing import (
+    DEFAULT_SIGNED_PATHS_SIZE,
+    get_params_key,
+    sign,
+)
+from thumbor_distributed_collage_filter.cache import (
+    TILE_CACHES,
+    SingleFlight,
+    get_aged_cache_control,
+    get_shared_cache,
+    get_ttl,
+    get_validators,
+)
+
+# composed tiles of a collage: an RGBA array, whether it is fully opaque,
+# the smallest max-age of its tiles and whether some of them failed (laid
+# out again or replaced by placeholders)
+Collage = namedtuple("Collage", ["pixels", "opaque", "max_age", "degraded"])
 
 
 class Filter(BaseFilter):
+    # defaults of DISTRIBUTED_COLLAGE_FILTER_MAX_IMAGES and
+    # DISTRIBUTED_COLLAGE_FILTER_MAX_CONCURRENCY
     MAX_IMAGES = 4
+    MAX_CONCURRENCY = 8
+    # default of DISTRIBUTED_COLLAGE_FILTER_NEGATIVE_CACHE_SIZE, in urls
+    NEGATIVE_CACHE_SIZE = 10000
+    # widest difference, in pixels, of the tiles of an image loaded once and
+    # cropped: the rounding of the layouts, not a crop of another ratio
+    MAX_CROPPED_WIDTH = 4
+    # statuses of the tile servers when the origin of an image failed or
+    # timed out
+    ORIGIN_FAILURE_CODES = (502, 504)
+
+    # crop of each tile: smart, halign and valign
+    ALIGNMENTS = {
+        "smart": (True, "center", "middle"),
+        "center": (False, "center", "middle"),
+        "top": (False, "center", "top"),
+        "bottom": (False, "center", "bottom"),
+        "left": (False, "left", "middle"),
+        "right": (False, "right", "middle"),
+    }
+
+    # thumbor filters used to pick the intermediate format of each tile;
+    # webp at quality 100 is encoded losslessly by thumbor
+    TILE_FORMATS = {
+        "jpeg": ["quality(100)"],
+        "png": ["format(png)"],
+        "webp": ["format(webp)", "quality(100)"],
+    }
+
+    # what to do when some of the tiles fail, with the max-age of the
+    # collages composed (or fallen back) because of it:
+    # - all_or_nothing: return the original image
+    # - redistribute: lay the remaining tiles out again, without the failed ones
+    # - placeholder: fill the slots of the failed tiles with a colour
+    FAILURE_POLICIES = {
+        "all_or_nothing": 60,
+        "redistribute": 300,
+        "placeholder": 60,
+    }
+
+    # collages being composed by this process, shared by identical requests
+    in_flight = SingleFlight()
+    # tiles already pasted by the streaming assembly
+    canvas = None
+    # index of the loaded tile and column it is cropped from, for each slot
+    sources = None
+
+    # modules of DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER, by name
+    http_loaders = {}
 
     @filter_method(BaseFilter.String, BaseFilter.String, r"[^\)]+")
     async def distributed_collage(self, orientation, alignment, urls):
-        self.orientation = orientation
-        self.alignment = alignment
+        self.orientation = self._get_option(orientation, LAYOUTS, "horizontal")
+        self.alignment = self._get_option(alignment, self.ALIGNMENTS, "smart")
         self.urls = urls.split("|")
         self.images = {}
 
+        max_images = getattr(
+            self.context.config,
+            "DISTRIBUTED_COLLAGE_FILTER_MAX_IMAGES",
+            self.MAX_IMAGES,
+        )
         total = len(self.urls)
-        if total > self.MAX_IMAGES:
+        if total > max_images:
             logger.error("filters.distributed_collage: Too many images to join")
+            self.context.metrics.incr("distributed_collage.too_many_images")
             return
         elif total == 0:
             logger.error("filters.distributed_collage: No images to join")
+            self.context.metrics.incr("distributed_collage.no_images")
             return
         else:
-            self.urls = self.urls[: self.MAX_IMAGES]
+            self.urls = self.urls[:max_images]
 
             self.max_age = self.context.config.MAX_AGE
 
-            self._calculate_dimensions()
-            await self._fetch_images()
+            with self._timing("distributed_collage.time"):
+                self.scale = 1
+                with self._timing("distributed_collage.dimensions.time"):
+                    self._calculate_dimensions()
+
+                collage = None
+                if self._fit_budget():
+                    try:
+                        collage = await self._get_collage()
+                        if collage is not None:
+                            with self._timing("distributed_collage.paste.time"):
+                                await self._run_assembly(self._paste_collage, collage)
+                    except AssemblyPoolFull:
+                        self._assembly_pool_full()
+                        collage = None
+
+                if collage is not None:
+                    self.max_age = collage.max_age
+                    if not self.max_age:
+                        # at least one of the tiles must not be cached
+                        self.context.request.prevent_result_storage = True
+                    elif collage.degraded:
+                        self._prevent_failure_storage()
+                else:
+                    self.context.metrics.incr("distributed_collage.fallback")
+                    self.max_age = min(self.max_age, self._get_failure_max_age())
+                    self._prevent_failure_storage()
 
             self.context.request.max_age = self.max_age
 
+    @contextmanager
+    def _timing(self, metricname):
+        """Sends the time spent in the block, in milliseconds, to the metrics."""
+        start = time.perf_counter()
+        yield
+        self.context.metrics.timing(metricname, (time.perf_counter() - start) * 1000)
+
+    def _get_option(self, value, options, default):
+        option = value.strip().lower()
+        if option not in options:
+            logger.warning(
+                "filters.distributed_collage: Unknown option %s, using %s"
+                % (value, default)
+            )
+            option = default
+        return option
+
     def _calculate_dimensions(self):
-        width = (
+        self.width = int(
             self.context.request.width
             or self.context.transformer.get_target_dimensions()[0]
         )
-        self.image_width = math.floor(width / len(self.urls))
-        self.last_image_width = width - ((len(self.urls) - 1) * self.image_width)
+        self.height = int(
+            self.context.request.height
+            or self.context.transformer.get_target_dimensions()[1]
+        )
+        if self.scale != 1:
+            self.width = max(int(self.width * self.scale), 1)
+            self.height = max(int(self.height * self.scale), 1)
+        self.slots = get_slots(
+            self.orientation, self.width, self.height, len(self.urls)
+        )
 
-    async def _fetch_images(self):
-        crypto = CryptoURL(key=self.context.server.security_key)
+    def _get_collage_bytes(self):
+        streaming = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_STREAMING_ASSEMBLY", False
+        )
+        return get_collage_bytes(self.width, self.height, self.slots, streaming)
+
+    def _fit_budget(self):
+        """
+        Scales a collage over DISTRIBUTED_COLLAGE_FILTER_MAX_COLLAGE_BYTES (or
+        the whole DISTRIBUTED_COLLAGE_FILTER_MEMORY_BUDGET) down to fit it
+        or, with DISTRIBUTED_COLLAGE_FILTER_OVER_BUDGET = "fallback", rejects
+        it. Returns False if the collage falls back.
+        """
+        config = self.context.config
+        budget = get_memory_budget(config)
+        limits = [
+            getattr(config, "DISTRIBUTED_COLLAGE_FILTER_MAX_COLLAGE_BYTES", 0),
+            budget.max_bytes if budget is not None else 0,
+        ]
+        limits = [limit for limit in limits if limit]
+
+        nbytes = self._get_collage_bytes()
+        if limits and nbytes > min(limits):
+            over_budget = getattr(
+                config, "DISTRIBUTED_COLLAGE_FILTER_OVER_BUDGET", "scale"
+            )
+            if over_budget == "fallback":
+                logger.error(
+                    "filters.distributed_collage: Collage of %d bytes is over "
+                    "the memory budget" % nbytes
+                )
+                self.context.metrics.incr("distributed_collage.memory.rejected")
+                return False
+
+            self.scale = math.sqrt(min(limits) / float(nbytes))
+            self._calculate_dimensions()
+            self.context.metrics.incr("distributed_collage.memory.scaled")
+        return True
+
+    async def _admit(self):
+        """
+        Reserves the memory of the collage in
+        DISTRIBUTED_COLLAGE_FILTER_MEMORY_BUDGET, waiting for it at most
+        DISTRIBUTED_COLLAGE_FILTER_MEMORY_QUEUE_TIMEOUT seconds. Only the
+        collages composed reserve it, not the identical ones waiting for
+        them.
+
+        Returns the reserved bytes, or None if the collage falls back.
+        """
+        config = self.context.config
+        budget = get_memory_budget(config)
+        if budget is None:
+            return 0
 
-        image_ops = []
-        if not hasattr(self.context.config, "DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER"):
-            self.context.config.DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER = (
-                "thumbor.loaders.http_loader"
+        nbytes = self._get_collage_bytes()
+        timeout = getattr(
+            config, "DISTRIBUTED_COLLAGE_FILTER_MEMORY_QUEUE_TIMEOUT", None
+        )
+        with self._timing("distributed_collage.memory.wait"):
+            admitted = await budget.acquire(nbytes, timeout)
+        if not admitted:
+            logger.error(
+                "filters.distributed_collage: Timed out waiting for the memory "
+                "of a collage"
+            )
+            self.context.metrics.incr("distributed_collage.memory.rejected")
+            return None
+
+        self.context.metrics.timing(
+            "distributed_collage.memory.in_flight", budget.in_flight
+        )
+        return nbytes
+
+    def _release(self, nbytes):
+        budget = get_memory_budget(self.context.config)
+        if budget is not None and nbytes:
+            budget.release(nbytes)
+
+    def _get_collage_key(self):
+        config = self.context.config
+        return (
+            self.orientation,
+            self.alignment,
+            tuple(url.strip() for url in self.urls),
+            self.width,
+            self.height,
+            getattr(config, "DISTRIBUTED_COLLAGE_FILTER_MODE", "http"),
+            getattr(config, "DISTRIBUTED_COLLAGE_FILTER_TILE_FORMAT", "jpeg"),
+            tuple(self._get_thumbor_servers()),
+        )
+
+    async def _get_collage(self):
+        """
+        Returns the composed tiles of the collage. Identical collages requested
+        at the same time share a single composition and, if
+        DISTRIBUTED_COLLAGE_FILTER_RESULT_CACHE_SIZE is set, composed collages
+        are kept in memory for the smallest max-age of their tiles.
+        """
+        key = self._get_collage_key()
+        cache_size = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_RESULT_CACHE_SIZE", 0
+        )
+        cache = get_shared_cache("collages", cache_size) if cache_size else None
+
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                self.context.metrics.incr("distributed_collage.result_cache.hit")
+                collage, stored_at = entry
+                # what is left of its max-age
+                age = int(time.time() - stored_at)
+                return collage._replace(max_age=max(collage.max_age - age, 0))
+            self.context.metrics.incr("distributed_collage.result_cache.miss")
+
+        async def create_collage():
+            reserved = await self._admit()
+            if reserved is None:
+                return None
+            try:
+                collage = await self._create_collage()
+            finally:
+                self._release(reserved)
+            if collage is not None and cache is not None:
+                cache.put(
+                    key,
+                    (collage, time.time()),
+                    collage.pixels.nbytes,
+                    collage.max_age,
+                )
+            return collage
+
+        return await self.in_flight.do(key, create_collage)
+
+    def _get_failure_policy(self):
+        policy = getattr(
+            self.context.config,
+            "DISTRIBUTED_COLLAGE_FILTER_FAILURE_POLICY",
+            "all_or_nothing",
+        )
+        if policy not in self.FAILURE_POLICIES:
+            logger.warning(
+                "filters.distributed_collage: Unknown failure policy %s, "
+                "using all_or_nothing" % policy
             )
-        self.context.modules.importer.import_item(
-            "DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER"
+            policy = "all_or_nothing"
+        return policy
+
+    def _prevent_failure_storage(self):
+        """
+        Keeps a degraded collage or the original image out of the result
+        storage, so the failed tiles are tried again on the next request.
+        thumbor then sends it with MAX_AGE_TEMP_IMAGE instead of the failure
+        max-age, which is left for deployments without a result storage.
+        """
+        if self.context.modules.result_storage is not None:
+            self.context.request.prevent_result_storage = True
+
+    def _get_failure_max_age(self):
+        policy = self._get_failure_policy()
+        return getattr(
+            self.context.config,
+            "DISTRIBUTED_COLLAGE_FILTER_FAILURE_MAX_AGE",
+            self.FAILURE_POLICIES[policy],
+        )
+
+    async def _create_collage(self):
+        try:
+            images = await self._fetch_images()
+        except AssemblyPoolFull:
+            self._assembly_pool_full()
+            return None
+        if images is None:
+            return None
+
+        max_age = min(
+            [
+                self.get_max_age(image.metadata.get("Cache-Control"), self.max_age)
+                for image in images
+                if image is not None
+            ]
         )
-        loader = self.context.modules.importer.distributed_collage_filter_http_loader
+        if self.degraded:
+            self.context.metrics.incr("distributed_collage.degraded")
+            max_age = min(max_age, self._get_failure_max_age())
 
-        for i, url in enumerate(self.urls):
-            width = (
-                self.image_width if i < len(self.urls) - 1 else self.last_image_width
+        try:
+            if self.canvas is not None:
+                # streamed: only the placeholders are left
+                canvas = self.assembly_images(images)
+            else:
+                canvas = await self._run_assembly(self.assembly_images, images)
+        except AssemblyPoolFull:
+            self._assembly_pool_full()
+            return None
+
+        return Collage(canvas.pixels, canvas.opaque, max_age, self.degraded)
+
+    async def _run_assembly(self, fn, *args):
+        """
+        Runs `fn` in the thread pool of DISTRIBUTED_COLLAGE_FILTER_ASSEMBLY_THREADS
+        or, without one, right away on the IOLoop.
+        """
+        pool = get_assembly_pool(self.context.config)
+        if pool is None:
+            return fn(*args)
+
+        wait, result = await pool.run(fn, *args)
+        self.context.metrics.timing(
+            "distributed_collage.assembly_pool.wait", wait * 1000
+        )
+        return result
+
+    def _assembly_pool_full(self):
+        logger.error(
+            "filters.distributed_collage: Too many collages waiting to be composed"
+        )
+        self.context.metrics.incr("distributed_collage.assembly_pool.full")
+
+    def _paste_collage(self, collage):
+        height, width = collage.pixels.shape[:2]
+        canvas = self.create_engine()
+        canvas.image = canvas.gen_image((width, height), "transparent")
+        canvas.set_image_data(collage.pixels.tobytes())
+
+        # a collage scaled down to fit the memory budget scales the image too
+        if self.scale != 1:
+            self.engine.resize(width, height)
+
+        # an opaque collage covering the whole image replaces it, anything
+        # else is merged over it
+        if collage.opaque and tuple(self.engine.size) == (width, height):
+            self.engine.image = canvas.image
+        else:
+            self.engine.paste(canvas, [0, 0], merge=True)
+
+    async def _fetch_images(self):
+        """
+        Loads the tiles of the collage. When some of them fail, the
+        DISTRIBUTED_COLLAGE_FILTER_FAILURE_POLICY decides whether the collage
+        falls back (`None` is returned), is composed again with the remaining
+        urls (`self.urls` is updated) or keeps `None` in the failed slots.
+        """
+        self.degraded = False
+        self.canvas = None
+        policy = self._get_failure_policy()
+        self.focal_point_store = self._get_focal_point_store()
+        streaming = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_STREAMING_ASSEMBLY", False
+        )
+
+        mode = getattr(self.context.config, "DISTRIBUTED_COLLAGE_FILTER_MODE", "http")
+        load_tile = self._get_tile_loader(mode)
+
+        timeout = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_TIMEOUT", None
+        )
+        deadline = None
+        if timeout:
+            deadline = asyncio.get_running_loop().time() + timeout
+
+        while True:
+            tiles, self.sources = self._get_unique_tiles(self._get_tiles())
+            if mode != "local":
+                tiles = await self._set_focal_points(tiles)
+
+            on_load = None
+            if streaming:
+                self.canvas = Canvas(self.width, self.height)
+                on_load = self._get_streaming_paste(self.canvas)
+
+            loaded = await self._load_images(
+                load_tile,
+                tiles,
+                deadline=deadline,
+                fail_fast=policy == "all_or_nothing",
+                on_load=on_load,
+            )
+            image_ops = [loaded[index] for index, _ in self.sources]
+
+            failed = [
+                index
+                for index, image in enumerate(image_ops)
+                if image is None or not image.successful
+            ]
+            if not failed:
+                return image_ops
+
+            errors = [
+                image.error
+                for image in image_ops
+                if image is not None and not image.successful
+            ]
+            if errors:
+                logger.error(
+                    "Retrieving at least one of the collaged images failed: %s"
+                    % (", ".join(errors),)
+                )
+
+            if policy == "all_or_nothing" or len(failed) == len(image_ops):
+                return None
+
+            self.degraded = True
+            if policy == "placeholder":
+                return [
+                    None if index in failed else image
+                    for index, image in enumerate(image_ops)
+                ]
+
+            # redistribute: the remaining tiles are rendered again in larger slots
+            self.urls = [
+                url for index, url in enumerate(self.urls) if index not in failed
+            ]
+            self._calculate_dimensions()
+
+    def _get_tile_loader(self, mode, load_tile=None):
+        """
+        Returns `load_tile` (by default, the tile loader of `mode`) guarded
+        against failing source images and wrapped with the tile cache.
+        """
+        if load_tile is None:
+            if mode == "local":
+                load_tile = self._render_tile
+            else:
+                load_tile = self._get_http_tile_loader()
+        load_tile = self._get_guarded_tile_loader(load_tile, mode)
+
+        tile_cache = self._get_tile_cache()
+        if tile_cache is None:
+            return load_tile
+
+        revalidate_ttl = 0
+        if mode != "local" and getattr(
+            self._get_http_loader(), "CONDITIONAL_REQUESTS", False
+        ):
+            revalidate_ttl = getattr(
+                self.context.config, "DISTRIBUTED_COLLAGE_FILTER_REVALIDATE_TTL", 0
+            )
+        return self._get_cached_tile_loader(load_tile, tile_cache, revalidate_ttl)
+
+    def _get_streaming_paste(self, canvas):
+        """
+        Returns the `on_load` callback of `_load_images` pasting each tile to
+        `canvas` as soon as it is loaded, while the other tiles are still on
+        their way. Only the headers of the tile are kept after that, so its
+        buffer and pixels can be released right away.
+        """
+
+        async def paste(index, result):
+            slots = [
+                (slot, crop_x)
+                for slot, (source, crop_x) in zip(self.slots, self.sources)
+                if source == index
+            ]
+            await self._run_assembly(self._paste_tile, canvas, result, slots)
+            return LoaderResult(metadata=result.metadata, extras={"pasted": True})
+
+        return paste
+
+    def _get_unique_tiles(self, tiles):
+        """
+        Returns the tiles to load, each one only once, and the source of each
+        slot: the index of its tile and the column the slot is cropped from.
+        Tiles of the same image whose widths differ by at most
+        MAX_CROPPED_WIDTH pixels are loaded once, at the largest width, and
+        cropped following the alignment. Wider differences are other crops
+        of the image, loaded as tiles of their own.
+        """
+        unique = []
+        narrowest = []
+        indexes = []
+        keys = {}
+        for tile in tiles:
+            candidates = keys.setdefault(get_params_key(dict(tile, width=None)), [])
+            for index in candidates:
+                widest = max(unique[index]["width"], tile["width"])
+                if (
+                    widest - min(narrowest[index], tile["width"])
+                    <= self.MAX_CROPPED_WIDTH
+                ):
+                    break
+            else:
+                index = len(unique)
+                candidates.append(index)
+                unique.append(dict(tile))
+                narrowest.append(tile["width"])
+            unique[index]["width"] = max(unique[index]["width"], tile["width"])
+            narrowest[index] = min(narrowest[index], tile["width"])
+            indexes.append(index)
+
+        sources = [
+            (index, self._get_crop_x(unique[index], tile))
+            for index, tile in zip(indexes, tiles)
+        ]
+        if len(unique) < len(tiles):
+            self.context.metrics.incr(
+                "distributed_collage.tile.deduplicated", len(tiles) - len(unique)
             )
-            height = (
-                self.context.request.height
-                or self.context.transformer.get_target_dimensions()[1]
+        return unique, sources
+
+    def _get_crop_x(self, loaded, tile):
+        extra = loaded["width"] - tile["width"]
+        if tile["halign"] == "left":
+            return 0
+        if tile["halign"] == "right":
+            return extra
+        return extra // 2
+
+    def _get_tiles(self):
+        """Returns the thumbor parameters of the tile of each url."""
+        tile_format = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_TILE_FORMAT", "jpeg"
+        )
+        if tile_format not in self.TILE_FORMATS:
+            logger.warning(
+                "filters.distributed_collage: Unknown tile format %s, using jpeg"
+                % tile_format
             )
-            params = {
-                "width": int(width),
-                "height": int(height),
+            tile_format = "jpeg"
+        tile_filters = self.TILE_FORMATS[tile_format]
+
+        smart, halign, valign = self.ALIGNMENTS[self.alignment]
+        return [
+            {
+                "width": slot.width,
+                "height": slot.height,
                 "image_url": url,
-                "smart": True,
-                "halign": "center",
-                "valign": "middle",
-                "filters": ["quality(100)"],
+                "smart": smart,
+                "halign": halign,
+                "valign": valign,
+                "filters": tile_filters,
             }
-            thumbor_host = getattr(
-                self.context.config,
-                "DISTRIBUTED_COLLAGE_FILTER_THUMBOR_SERVER_URL",
+            for url, slot in zip(self.urls, self.slots)
+        ]
+
+    def _get_focal_point_store(self):
+        name = getattr(
+            self.context.config,
+            "DISTRIBUTED_COLLAGE_FILTER_FOCAL_POINT_STORE",
+            "memory",
+        )
+        if not name:
+            return None
+
+        store_class = FOCAL_POINT_STORES.get(name)
+        if store_class is None:
+            store_class = self.context.modules.importer.import_class(name)
+        return store_class(self.context)
+
+    async def _set_focal_points(self, tiles):
+        """
+        Replaces the smart detection of the tiles whose source image has known
+        focal points with `focal()` filters, so the tile server only crops
+        them. The tile server needs thumbor's focal filter.
+
+        Points missing from the store are looked up in the detector data of
+        STORAGE, where the tile servers sharing it keep the points they
+        detected.
+        """
+        if self.focal_point_store is None:
+            return tiles
+        if "thumbor.filters.focal" not in (self.context.config.FILTERS or []):
+            return tiles
+
+        storage = FocalPointStorage(
+            self.context.modules.storage,
+            self.focal_point_store,
+            self.context.metrics,
+        )
+        for tile in tiles:
+            if not tile["smart"]:
+                continue
+
+            points = await storage.get_detector_data(
+                quote(tile["image_url"].encode("utf-8"))
+            )
+            if points is None:
+                continue
+
+            tile["smart"] = False
+            tile["filters"] = list(tile["filters"]) + get_focal_filters(points)
+        return tiles
+
+    def _get_http_loader(self):
+        """Returns the DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER module."""
+        name = getattr(
+            self.context.config,
+            "DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER",
+            "thumbor.loaders.http_loader",
+        )
+        if name not in self.http_loaders:
+            self.http_loaders[name] = self.context.modules.importer.import_class(
+                name, get_module=True
+            )
+        return self.http_loaders[name]
+
+    def _get_thumbor_servers(self):
+        """
+        Returns the DISTRIBUTED_COLLAGE_FILTER_THUMBOR_SERVER_URL, a url or a
+        list of them, as a list. The current host by default.
+        """
+        servers = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_THUMBOR_SERVER_URL", None
+        )
+        if not servers:
+            return [
                 "%s://%s"
                 % (
                     self.context.request_handler.request.protocol,
                     self.context.request_handler.request.host,
+                )
+            ]
+        if isinstance(servers, str):
+            return [servers]
+        return list(servers)
+
+    def _get_http_tile_loader(self):
+        security_key = self.context.server.security_key
+        signed_paths_size = getattr(
+            self.context.config,
+            "DISTRIBUTED_COLLAGE_FILTER_SIGNED_PATHS_SIZE",
+            DEFAULT_SIGNED_PATHS_SIZE,
+        )
+        loader = self._get_http_loader()
+        servers = self._get_thumbor_servers()
+
+        async def load(params, validators=None):
+            with self._timing("distributed_collage.sign.time"):
+                path = sign(security_key, params, signed_paths_size)
+
+            async def request(server):
+                return await self._request_tile(loader, server, path, validators)
+
+            nodes = route(servers, params["image_url"], self.context.config)
+            return await self._hedge(request, nodes)
+
+        return load
+
+    def _get_tile_timeout(self, server):
+        """
+        Returns the timeout of a tile requested to `server` with
+        DISTRIBUTED_COLLAGE_FILTER_ADAPTIVE_TIMEOUT: its observed p95 latency
+        times DISTRIBUTED_COLLAGE_FILTER_ADAPTIVE_TIMEOUT_FACTOR, at least
+        DISTRIBUTED_COLLAGE_FILTER_ADAPTIVE_TIMEOUT_MIN seconds. None until
+        enough tiles were requested to the server.
+        """
+        config = self.context.config
+        if not getattr(config, "DISTRIBUTED_COLLAGE_FILTER_ADAPTIVE_TIMEOUT", False):
+            return None
+
+        p95 = get_tracker(server).p95
+        if p95 is None:
+            return None
+
+        factor = getattr(
+            config, "DISTRIBUTED_COLLAGE_FILTER_ADAPTIVE_TIMEOUT_FACTOR", 2
+        )
+        minimum = getattr(
+            config, "DISTRIBUTED_COLLAGE_FILTER_ADAPTIVE_TIMEOUT_MIN", 0.1
+        )
+        return max(p95 * factor, minimum)
+
+    async def _request_tile(self, loader, server, path, validators=None):
+        """
+        Loads a tile from `server`, recording how long it took and its health.
+        With `validators` the request is conditional (see
+        thumbor_distributed_collage_filter.http_loader.CONDITIONAL_REQUESTS).
+        """
+        timeout = self._get_tile_timeout(server)
+        url = "%s%s" % (server, path)
+        start = time.perf_counter()
+        try:
+            if validators:
+                loading = loader.load(self.context, url, headers=validators)
+            else:
+                loading = loader.load(self.context, url)
+            result = await asyncio.wait_for(loading, timeout)
+            if result.successful:
+                get_tracker(server).observe(time.perf_counter() - start)
+        except asyncio.TimeoutError:
+            # only a lower bound, but it lets the timeout grow with the server
+            get_tracker(server).observe(time.perf_counter() - start)
+            self.context.metrics.incr("distributed_collage.tile.adaptive_timeout")
+            logger.warning(
+                "filters.distributed_collage: Tile from %s took more than %.3fs"
+                % (server, timeout)
+            )
+            result = LoaderResult(successful=False, error=LoaderResult.ERROR_TIMEOUT)
+        except OSError as err:
+            # thumbor's http_loader lets connection errors through
+            logger.warning(
+                "filters.distributed_collage: Tile from %s failed: %s" % (server, err)
+            )
+            result = LoaderResult(successful=False, error=LoaderResult.ERROR_UPSTREAM)
+
+        self._record_health(server, result)
+        return result
+
+    def _record_health(self, server, result):
+        """
+        Counts the connection errors, timeouts and empty answers of `server`
+        towards its ejection. Other errors, such as a missing source image,
+        are not the server's fault.
+        """
+        node_health = get_health(server, self.context.config)
+        if result.successful:
+            node_health.success()
+        elif result.error in (LoaderResult.ERROR_TIMEOUT, LoaderResult.ERROR_UPSTREAM):
+            if node_health.failure():
+                logger.error(
+                    "filters.distributed_collage: Ejecting %s for %ss"
+                    % (server, node_health.eject_seconds)
+                )
+                self.context.metrics.incr("distributed_collage.node.ejected")
+
+    def _get_hedge_delay(self, server):
+        """
+        Seconds of DISTRIBUTED_COLLAGE_FILTER_HEDGE_DELAY, or the observed p95
+        latency of `server` if it is "p95". None disables hedging.
+        """
+        delay = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_HEDGE_DELAY", None
+        )
+        if delay == "p95":
+            return get_tracker(server).p95
+        return delay
+
+    async def _hedge(self, request, servers):
+        """
+        Requests the tile to the first server and, if it has not answered
+        after the hedge delay or timed out, to the second one too. The first
+        successful answer wins and the other request is cancelled.
+        """
+        delay = self._get_hedge_delay(servers[0])
+        if delay is None or len(servers) < 2:
+            return await request(servers[0])
+
+        primary = asyncio.ensure_future(request(servers[0]))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # a tile the first server timed out is hedged right away
+            if not done or primary.result().error == LoaderResult.ERROR_TIMEOUT:
+                self.context.metrics.incr("distributed_collage.hedge")
+                tasks.append(asyncio.ensure_future(request(servers[1])))
+
+            result = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    result = task.result()
+                    if result.successful:
+                        if task is not primary:
+                            self.context.metrics.incr("distributed_collage.hedge.win")
+                        return result
+            return result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _get_tile_cache(self):
+        name = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_TILE_CACHE", None
+        )
+        if not name:
+            return None
+
+        cache_class = TILE_CACHES.get(name)
+        if cache_class is None:
+            cache_class = self.context.modules.importer.import_class(name)
+        return cache_class(self.context)
+
+    def _is_source_failure(self, result, mode):
+        """
+        Whether a failed tile is the fault of its source image. In "http"
+        mode timeouts and connection errors are the thumbor server's, and
+        count towards its ejection instead.
+        """
+        if mode == "local":
+            return True
+        return result.error not in (
+            LoaderResult.ERROR_TIMEOUT,
+            LoaderResult.ERROR_UPSTREAM,
+        )
+
+    def _is_origin_failure(self, result, mode):
+        """
+        Whether a source failure is its origin being down rather than the
+        image being missing or invalid: a timeout, a connection error or a
+        5xx of the origin. In "http" mode it is only known from the status
+        of the tile server, which the tile loader of this package keeps.
+        """
+        code = result.extras.get("code")
+        if mode == "local":
+            return (
+                result.error
+                in (LoaderResult.ERROR_TIMEOUT, LoaderResult.ERROR_UPSTREAM)
+                or (code or 0) >= 500
+            )
+        return code in self.ORIGIN_FAILURE_CODES
+
+    def _get_guarded_tile_loader(self, load_tile, mode):
+        """
+        Wraps `load_tile` so the tiles of source images that just failed
+        (DISTRIBUTED_COLLAGE_FILTER_NEGATIVE_CACHE_TTL) or whose origin is
+        down (DISTRIBUTED_COLLAGE_FILTER_CIRCUIT_FAILURES) fail without
+        being requested. An image missing from its origin is only negatively
+        cached: the origin answered, so it does not count towards its circuit.
+        """
+        config = self.context.config
+        negative_ttl = getattr(
+            config, "DISTRIBUTED_COLLAGE_FILTER_NEGATIVE_CACHE_TTL", 0
+        )
+        negative_cache = None
+        if negative_ttl:
+            negative_cache = get_shared_cache(
+                "negative_tiles",
+                getattr(
+                    config,
+                    "DISTRIBUTED_COLLAGE_FILTER_NEGATIVE_CACHE_SIZE",
+                    self.NEGATIVE_CACHE_SIZE,
                 ),
             )
-            encrypted_url = "%s%s" % (thumbor_host, crypto.generate(**params))
-            image_ops.append(await loader.load(self.context, encrypted_url))
 
-        successful = all([image.successful for image in image_ops])
-        if not successful:
-            logger.error(
-                "Retrieving at least one of the collaged images failed: %s"
-                % (
-                    ", ".join(
-                        [image.error for image in image_ops if not image.successful]
-                    ),
+        async def load(params, validators=None):
+            url = params["image_url"]
+            if negative_cache is not None:
+                error = negative_cache.get(url)
+                if error is not None:
+                    self.context.metrics.incr("distributed_collage.negative_cache.hit")
+                    return LoaderResult(successful=False, error=error)
+
+            origin = get_origin(url)
+            breaker = get_breaker(origin, config)
+            if breaker is not None and not breaker.allow():
+                self.context.metrics.incr("distributed_collage.circuit.short_circuit")
+                return LoaderResult(successful=False, error=LoaderResult.ERROR_UPSTREAM)
+
+            result = await load_tile(params, validators)
+            if not result.successful and not self._is_source_failure(result, mode):
+                return result
+
+            if not result.successful and self._is_origin_failure(result, mode):
+                if breaker is not None and breaker.failure():
+                    logger.error(
+                        "filters.distributed_collage: Opening the circuit of %s "
+                        "for %ss" % (origin, breaker.reset_seconds)
+                    )
+                    self.context.metrics.incr("distributed_collage.circuit.open")
+                return result
+
+            if not result.successful and negative_cache is not None:
+                negative_cache.put(url, result.error, 1, negative_ttl)
+            if breaker is not None and breaker.success():
+                logger.info(
+                    "filters.distributed_collage: Closing the circuit of %s" % origin
+                )
+                self.context.metrics.incr("distributed_collage.circuit.close")
+            return result
+
+        return load
+
+    def _get_cached_tile_loader(self, load_tile, tile_cache, revalidate_ttl=0):
+        """
+        Wraps `load_tile` with `tile_cache`. With `revalidate_ttl`, tiles with
+        an ETag or Last-Modified header are kept that many seconds after they
+        expire, and an expired tile is only requested again conditionally: if
+        the tile server answers it is not modified, it is reused for another
+        max-age.
+        """
+
+        async def load(params):
+            key = plain_image_url(**params)
+            result = await tile_cache.get(key)
+            stale = None
+            if result is not None:
+                fresh_until = result.extras.get("fresh_until")
+                if fresh_until is None or fresh_until > time.time():
+                    self.context.metrics.incr("distributed_collage.tile_cache.hit")
+                    return self._get_aged_tile(result)
+                stale = result
+
+            self.context.metrics.incr("distributed_collage.tile_cache.miss")
+            validators = None
+            if stale is not None:
+                self.context.metrics.incr("distributed_collage.tile_cache.revalidate")
+                validators = get_validators(stale.metadata)
+            result = await load_tile(params, validators)
+            if not result.successful:
+                return result
+
+            if result.extras.get("not_modified"):
+                self.context.metrics.incr("distributed_collage.tile_cache.not_modified")
+                result = LoaderResult(
+                    buffer=stale.buffer,
+                    metadata=dict(stale.metadata, **result.metadata),
+                    extras=stale.extras,
                 )
+
+            ttl = get_ttl(result.metadata.get("Cache-Control"), self.max_age)
+            # epoch seconds, as kept by the caches of other processes
+            extras = dict(result.extras, stored_at=time.time())
+            if revalidate_ttl and ttl > 0 and get_validators(result.metadata):
+                extras["fresh_until"] = extras["stored_at"] + ttl
+                ttl += revalidate_ttl
+            result = LoaderResult(
+                buffer=result.buffer, metadata=result.metadata, extras=extras
             )
-            return
+            await tile_cache.put(key, result, ttl)
+            return result
 
-        max_age = min(
-            [
-                self.get_max_age(image.metadata.get("Cache-Control"), self.max_age)
-                for image in image_ops
-            ]
+        return load
+
+    def _get_aged_tile(self, result):
+        """
+        Returns a cached tile with what is left of its max-age, so a collage
+        of tiles about to expire is not cached for their whole max-age.
+        """
+        stored_at = result.extras.get("stored_at")
+        if stored_at is None:
+            return result
+
+        header = get_aged_cache_control(
+            result.metadata.get("Cache-Control"),
+            time.time() - stored_at,
+            self.max_age,
+        )
+        return LoaderResult(
+            buffer=result.buffer,
+            metadata=dict(result.metadata, **{"Cache-Control": header}),
+            extras=result.extras,
         )
-        self.assembly_images(image_ops)
 
-    def get_max_age(self, header, default):
-        # 'max-age=86400,public'
-        if header is None or "max-age" not in header:
-            return default
+    async def _render_tile(self, params, validators=None):
+        """
+        Renders a tile inside the current request: the source image is read
+        with the configured LOADER and cropped by thumbor's own transformer on
+        a fresh engine, skipping the HTTP round trip to the tile server.
+        Its tiles have no validators to revalidate.
+        """
+        # same quoting thumbor's ImagingHandler applies to the tile's path
+        image_url = quote(params["image_url"].encode("utf-8"))
+        result = await self.context.modules.loader.load(self.context, image_url)
+        if isinstance(result, LoaderResult) and not result.successful:
+            return result
+
+        buffer = result.buffer if isinstance(result, LoaderResult) else result
+        if buffer is None:
+            return LoaderResult(successful=False, error=LoaderResult.ERROR_NOT_FOUND)
+
+        context = Context(
+            server=self.context.server,
+            config=self.context.config,
+            importer=self.context.modules.importer,
+            request_handler=self.context.request_handler,
+        )
+        context.request = RequestParameters(
+            width=params["width"],
+            height=params["height"],
+            smart=params["smart"],
+            halign=params["halign"],
+            valign=params["valign"],
+            image=image_url,
+        )
+        engine = context.request.engine = context.modules.engine
+
+        try:
+            engine.load(buffer, None)
+            if params["smart"] and self.focal_point_store is not None:
+                context.modules.storage = FocalPointStorage(
+                    context.modules.storage,
+                    self.focal_point_store,
+                    self.context.metrics,
+                )
+            if not params["smart"]:
+                # smart tiles are not drafted: the detectors and the crop
+                # around their points need the full image
+                draft(engine, params["width"], params["height"])
+            engine.normalize()
+            context.transformer = Transformer(context)
+            await context.transformer.transform()
+        except Exception as err:
+            logger.exception(err)
+            return LoaderResult(successful=False, error=LoaderResult.ERROR_BAD_REQUEST)
 
-        return int(header.split(",")[0].split("=")[-1])
+        return LoaderResult(extras={"engine": engine})
+
+    async def _load_images(
+        self, load_tile, tiles, deadline=None, fail_fast=True, on_load=None
+    ):
+        """
+        Loads all the tiles concurrently, limited by
+        DISTRIBUTED_COLLAGE_FILTER_MAX_CONCURRENCY and bounded by `deadline`
+        (in the time of the running loop).
+
+        Returns the results in the same order as `tiles`. When the deadline
+        is exceeded or, with `fail_fast`, as soon as one of the tiles fails,
+        the remaining loads are cancelled and their slots are left as `None`.
+
+        `on_load(index, result)` is awaited for each successful tile, in the
+        order they are loaded, and its return value replaces the result.
+        """
+        concurrency = getattr(
+            self.context.config,
+            "DISTRIBUTED_COLLAGE_FILTER_MAX_CONCURRENCY",
+            self.MAX_CONCURRENCY,
+        ) or len(tiles)
+        timeout = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_TIMEOUT", None
+        )
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def load(index, tile):
+            async with semaphore:
+                start = time.perf_counter()
+                result = await load_tile(tile)
+
+            # 'distributed_collage.tile.time.0.success'
+            elapsed = (time.perf_counter() - start) * 1000
+            status = "success" if result.successful else "failure"
+            self.context.metrics.timing("distributed_collage.tile.time", elapsed)
+            self.context.metrics.timing(
+                "distributed_collage.tile.time.%d.%s" % (index, status), elapsed
+            )
+            if not result.successful:
+                self.context.metrics.incr("distributed_collage.tile.failure")
+            return result
+
+        tasks = [
+            asyncio.ensure_future(load(index, tile)) for index, tile in enumerate(tiles)
+        ]
+        results = [None] * len(tiles)
+        loop = asyncio.get_running_loop()
+
+        try:
+            pending = set(tasks)
+            while pending:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - loop.time(), 0)
+
+                done, pending = await asyncio.wait(
+                    pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    self.context.metrics.incr("distributed_collage.tile.timeout")
+                    logger.error(
+                        "filters.distributed_collage: Retrieving the collaged "
+                        "images took more than %ss" % timeout
+                    )
+                    return results
+
+                for task in done:
+                    index = tasks.index(task)
+                    result = task.result()
+                    if fail_fast and not result.successful:
+                        results[index] = result
+                        return results
+                    if on_load is not None and result.successful:
+                        result = await on_load(index, result)
+                    results[index] = result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return results
+
+    def get_max_age(self, header, default):
+        # 'max-age=86400,public', the s-maxage of tiles is not for browsers
+        return get_ttl(header, default, shared=False)
 
     def create_engine(self):
         try:
@@ -135,12 +1188,56 @@ class Filter(BaseFilter):
             logger.exception(err)
 
     def assembly_images(self, images):
-        current_width = 0
+        """
+        Composes the tiles of the collage. With streaming assembly the loaded
+        tiles are already on `self.canvas`, so only the slots of the failed
+        ones are left. A tile shared by several slots is decoded once.
+        """
+        canvas = self.canvas
+        if canvas is None:
+            canvas = Canvas(self.width, self.height)
+        sources = self.sources or [(index, 0) for index in range(len(images))]
 
-        for image in images:
-            buffer = image.buffer
-            engine = self.create_engine()
-            engine.load(buffer, None)
+        shared = OrderedDict()
+        for image, slot, (_, crop_x) in zip(images, self.slots, sources):
+            if image is None:
+                canvas.paste(self._get_placeholder(slot), slot.x, slot.y)
+            elif not image.extras.get("pasted"):
+                shared.setdefault(id(image), (image, []))[1].append((slot, crop_x))
+
+        for image, slots in shared.values():
+            self._paste_tile(canvas, image, slots)
+
+        return canvas
+
+    def _paste_tile(self, canvas, image, slots):
+        """Decodes `image` and pastes it to its `slots`: [(slot, crop_x), ...]"""
+        with self._timing("distributed_collage.decode.time"):
+            engine = image.extras.get("engine")
+            if engine is None:
+                engine = self.create_engine()
+                engine.load(image.buffer, None)
 
-            self.engine.paste(engine, [current_width, 0], merge=True)
-            current_width += self.image_width
+            # PIL decodes lazily, on the first access to the pixels
+            mode, data = engine.image_data_as_rgb()
+
+        with self._timing("distributed_collage.assembly.time"):
+            tile = to_rgba(mode, data, engine.size)
+            for slot, crop_x in slots:
+                canvas.paste(
+                    tile[: slot.height, crop_x : crop_x + slot.width], slot.x, slot.y
+                )
+
+    def _get_placeholder(self, slot):
+        color = getattr(
+            self.context.config, "DISTRIBUTED_COLLAGE_FILTER_PLACEHOLDER_COLOR", "white"
+        )
+        try:
+            rgba = ImageColor.getcolor(color, "RGBA")
+        except ValueError:
+            logger.warning(
+                "filters.distributed_collage: Unknown placeholder color %s, "
+                "using white" % color
+            )
+            rgba = (255, 255, 255, 255)
+        return np.full((slot.height, slot.width, 4), rgba, dtype=np.uint8)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Focal points detected in the source images of the tiles, shared by every
+collage. Once the faces or features of an image are known, a tile of that
+image at any other size is only a crop and a resize.
+
+Points are lists of dicts in the format of thumbor's detector data
+(`FocalPoint.to_dict`), in the coordinates of the full image.
+"""
+
+from thumbor.point import FocalPoint
+
+from thumbor_distributed_collage_filter.cache import get_shared_cache
+
+DEFAULT_FOCAL_POINT_CACHE_SIZE = 10000
+
+
+class BaseFocalPointStore(object):
+    """Interface of the focal point stores. `key` is the path of the image."""
+
+    def __init__(self, context):
+        self.context = context
+
+    async def get(self, key):
+        raise NotImplementedError()
+
+    async def put(self, key, points):
+        raise NotImplementedError()
+
+
+class MemoryFocalPointStore(BaseFocalPointStore):
+    """
+    Keeps the points of the last images in a LRU cache shared by every
+    request of the process, for STORAGE_EXPIRATION_SECONDS.
+    """
+
+    def __init__(self, context):
+        super(MemoryFocalPointStore, self).__init__(context)
+        max_size = getattr(
+            context.config,
+            "DISTRIBUTED_COLLAGE_FILTER_FOCAL_POINT_CACHE_SIZE",
+            DEFAULT_FOCAL_POINT_CACHE_SIZE,
+        )
+        self.cache = get_shared_cache("focal_points", max_size)
+        self.ttl = context.config.STORAGE_EXPIRATION_SECONDS
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def put(self, key, points):
+        self.cache.put(key, points, 1, self.ttl)
+
+
+class StorageFocalPointStore(BaseFocalPointStore):
+    """
+    Uses the detector data of thumbor's STORAGE, shared with the tile servers
+    using the same storage.
+    """
+
+    async def get(self, key):
+        return await self.context.modules.storage.get_detector_data(key)
+
+    async def put(self, key, points):
+        await self.context.modules.storage.put_detector_data(key, points)
+
+
+FOCAL_POINT_STORES = {
+    "memory": MemoryFocalPointStore,
+    "storage": StorageFocalPointStore,
+}
+
+
+class FocalPointStorage(object):
+    """
+    Storage of a tile rendered in process: the transformer looks the
+    detector data of the image up in the focal point store before the
+    storage, and detected points are kept in both.
+    """
+
+    def __init__(self, storage, store, metrics):
+        self.storage = storage
+        self.store = store
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    async def get_detector_data(self, path):
+        points = await self.store.get(path)
+        if points is not None:
+            self.metrics.incr("distributed_collage.focal_points.hit")
+            return points
+
+        self.metrics.incr("distributed_collage.focal_points.miss")
+        points = await self.storage.get_detector_data(path)
+        if points is not None:
+            await self.store.put(path, points)
+        return points
+
+    async def put_detector_data(self, path, data):
+        await self.store.put(path, data)
+        return await self.storage.put_detector_data(path, data)
+
+
+def get_focal_filters(points):
+    """
+    Returns the `focal()` filters placing `points` on a thumbor server, so it
+    crops around them without detecting them again.
+    """
+    filters = []
+    for point in points:
+        point = FocalPoint.from_dict(point)
+        width = max(point.width, 1)
+        height = max(point.height, 1)
+        left = max(point.x - width // 2, 0)
+        top = max(point.y - height // 2, 0)
+        filters.append("focal(%dx%d:%dx%d)" % (left, top, left + width, top + height))
+    return filters
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Loader for the collage tiles. Unlike thumbor's http_loader, it keeps one
+HTTP client per IOLoop, with its own pool size, per host connection cap
+and timeouts, shared by every collage of the process.
+
+Connections are kept alive between tiles when pycurl is available
+(tornado's curl client reuses them, install it with the "curl" extra),
+otherwise tornado's simple client opens a connection per tile and a
+warning is logged once.
+
+Use it with:
+
+    DISTRIBUTED_COLLAGE_FILTER_HTTP_LOADER = (
+        "thumbor_distributed_collage_filter.http_loader"
+    )
+"""
+
+import asyncio
+import socket
+import weakref
+from collections import Counter, defaultdict
+from urllib.parse import urlparse
+
+import tornado.httpclient
+import tornado.iostream
+from tornado.ioloop import IOLoop
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from thumbor.loaders import LoaderResult
+from thumbor.loaders.http_loader import _normalize_url, return_contents
+from thumbor.utils import logger
+
+try:
+    import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    pycurl = CurlAsyncHTTPClient = None
+
+# load() takes the headers of conditional requests, answering a 304 with a
+# successful result without buffer and with extras {"not_modified": True}
+CONDITIONAL_REQUESTS = True
+
+DEFAULT_MAX_CLIENTS = 20
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 8
+
+pools = weakref.WeakKeyDictionary()
+
+# whether the fallback to the simple client was logged by this process
+simple_client_warned = False
+
+
+def warn_simple_client():
+    global simple_client_warned
+    if simple_client_warned:
+        return
+
+    simple_client_warned = True
+    logger.warning(
+        "filters.distributed_collage: pycurl is not installed, tiles are "
+        "loaded without keep-alive connections (pip install "
+        "thumbor-distributed-collage-filter[curl])"
+    )
+
+
+class TilePool(object):
+    """
+    HTTP client shared by the tiles of every collage running on an IOLoop.
+    Requests to a host beyond its connection cap wait for a free slot.
+    """
+
+    def __init__(self, max_clients, max_connections_per_host):
+        self.max_clients = max_clients
+        self.max_connections_per_host = max_connections_per_host
+        self.requests = 0
+        self.active = Counter()
+        self.queued = Counter()
+        self.hosts = defaultdict(
+            lambda: asyncio.Semaphore(self.max_connections_per_host)
+        )
+
+        if CurlAsyncHTTPClient is not None:
+            self.client = CurlAsyncHTTPClient(
+                force_instance=True, max_clients=max_clients
+            )
+            self.client._multi.setopt(
+                pycurl.M_MAX_HOST_CONNECTIONS, max_connections_per_host
+            )
+        else:
+            self.client = SimpleAsyncHTTPClient(
+                force_instance=True, max_clients=max_clients
+            )
+            warn_simple_client()
+
+    async def fetch(self, request):
+        host = urlparse(request.url).netloc
+        self.queued[host] += 1
+        async with self.hosts[host]:
+            self.queued[host] -= 1
+            self.active[host] += 1
+            self.requests += 1
+            try:
+                return await self.client.fetch(request, raise_error=False)
+            finally:
+                self.active[host] -= 1
+
+    def stats(self):
+        return {
+            "client": self.client.__class__.__name__,
+            "max_clients": self.max_clients,
+            "max_connections_per_host": self.max_connections_per_host,
+            "requests": self.requests,
+            "active": sum(self.active.values()),
+            "queued": sum(self.queued.values()),
+            "hosts": {
+                host: {"active": self.active[host], "queued": self.queued[host]}
+                for host in self.hosts
+            },
+        }
+
+    def close(self):
+        self.client.close()
+
+
+def get_pool(config):
+    io_loop = IOLoop.current()
+    if io_loop not in pools:
+        pools[io_loop] = TilePool(
+            getattr(
+                config,
+                "DISTRIBUTED_COLLAGE_FILTER_LOADER_MAX_CLIENTS",
+                DEFAULT_MAX_CLIENTS,
+            ),
+            getattr(
+                config,
+                "DISTRIBUTED_COLLAGE_FILTER_LOADER_MAX_CONNECTIONS_PER_HOST",
+                DEFAULT_MAX_CONNECTIONS_PER_HOST,
+            ),
+        )
+    return pools[io_loop]
+
+
+def get_pool_stats():
+    """Returns the stats of the pool of the current IOLoop, if any."""
+    pool = pools.get(IOLoop.current())
+    return pool.stats() if pool is not None else None
+
+
+async def load(context, url, headers=None):
+    config = context.config
+    url = _normalize_url(url)
+    request = tornado.httpclient.HTTPRequest(
+        url=url,
+        headers=dict(headers or {}, Accept="image/*;q=0.9,*/*;q=0.1"),
+        connect_timeout=getattr(
+            config,
+            "DISTRIBUTED_COLLAGE_FILTER_LOADER_CONNECT_TIMEOUT",
+            config.HTTP_LOADER_CONNECT_TIMEOUT,
+        ),
+        request_timeout=getattr(
+            config,
+            "DISTRIBUTED_COLLAGE_FILTER_LOADER_REQUEST_TIMEOUT",
+            config.HTTP_LOADER_REQUEST_TIMEOUT,
+        ),
+        user_agent=config.HTTP_LOADER_DEFAULT_USER_AGENT,
+    )
+
+    try:
+        response = await get_pool(config).fetch(request)
+    except tornado.httpclient.HTTPClientError as err:
+        response = tornado.httpclient.HTTPResponse(
+            request, err.code, reason=err.message
+        )
+    except (socket.gaierror, OSError, tornado.iostream.StreamClosedError) as err:
+        response = tornado.httpclient.HTTPResponse(request, 599, reason=str(err))
+
+    if response.code == 304:
+        return LoaderResult(
+            metadata=dict(response.headers), extras={"not_modified": True}
+        )
+    result = return_contents(response=response, url=url, context=context)
+    if not result.successful:
+        # tells a failed tile server from a failed origin of its image
+        result.extras["code"] = response.code
+    return result
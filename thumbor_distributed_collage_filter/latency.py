@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Latency of the tile requests to each thumbor server, shared by every
+collage of the process, so the timeout of a tile follows how fast its
+server has been lately instead of a fixed value.
+"""
+
+import math
+
+# z-score of the 95th percentile of a normal distribution
+P95_Z = 1.645
+
+trackers = {}
+
+
+class LatencyTracker(object):
+    """
+    Exponentially weighted moving average and variance of the latencies, in
+    seconds, of a server. `p95` estimates their 95th percentile once
+    `min_samples` latencies were observed, None before that.
+    """
+
+    def __init__(self, alpha=0.1, min_samples=10):
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.samples = 0
+        self.mean = 0.0
+        self.variance = 0.0
+
+    def observe(self, latency):
+        self.samples += 1
+        if self.samples == 1:
+            self.mean = latency
+            return
+
+        diff = latency - self.mean
+        self.mean += self.alpha * diff
+        self.variance = (1 - self.alpha) * (self.variance + self.alpha * diff * diff)
+
+    @property
+    def p95(self):
+        if self.samples < self.min_samples:
+            return None
+        return self.mean + P95_Z * math.sqrt(self.variance)
+
+    def stats(self):
+        return {"samples": self.samples, "mean": self.mean, "p95": self.p95}
+
+
+def get_tracker(host):
+    """Returns the latency tracker of the thumbor server `host`."""
+    if host not in trackers:
+        trackers[host] = LatencyTracker()
+    return trackers[host]
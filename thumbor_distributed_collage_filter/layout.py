@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Slots of the tiles of a collage. Every layout splits the collage in
+rectangles that never overlap, in the order of the urls, and the last
+tile of each row or column takes the pixels left by the rounding.
+"""
+
+import math
+from collections import namedtuple
+
+Slot = namedtuple("Slot", ["x", "y", "width", "height"])
+
+
+def split(length, count):
+    """
+    Splits `length` in `count` parts: [(offset, size), ...]
+    split(100, 3) -> [(0, 33), (33, 33), (66, 34)]
+    """
+    size = length // count
+    parts = [(index * size, size) for index in range(count - 1)]
+    parts.append(((count - 1) * size, length - (count - 1) * size))
+    return parts
+
+
+def horizontal(width, height, count):
+    """One row with a column per tile."""
+    return [Slot(x, 0, size, height) for x, size in split(width, count)]
+
+
+def vertical(width, height, count):
+    """One column with a row per tile."""
+    return [Slot(0, y, width, size) for y, size in split(height, count)]
+
+
+def get_grid_size(count):
+    """Columns and rows of the smallest square-ish grid holding `count` tiles."""
+    columns = int(math.ceil(math.sqrt(count)))
+    rows = int(math.ceil(count / columns))
+    return columns, rows
+
+
+def grid(width, height, count):
+    """
+    Cells of the same size, row by row. The last row may be left with
+    empty cells.
+    """
+    columns, rows = get_grid_size(count)
+    cells = [
+        Slot(x, y, cell_width, cell_height)
+        for y, cell_height in split(height, rows)
+        for x, cell_width in split(width, columns)
+    ]
+    return cells[:count]
+
+
+def justified(width, height, count):
+    """
+    Rows of the grid, each one with its tiles spread over the whole width,
+    so no cell is left empty.
+    """
+    _, rows = get_grid_size(count)
+    slots = []
+    for row, (y, row_height) in enumerate(split(height, rows)):
+        row_count = count // rows + (1 if row < count % rows else 0)
+        slots.extend(
+            Slot(x, y, size, row_height) for x, size in split(width, row_count)
+        )
+    return slots
+
+
+LAYOUTS = {
+    "horizontal": horizontal,
+    "vertical": vertical,
+    "grid": grid,
+    "justified": justified,
+}
+
+
+def get_slots(orientation, width, height, count):
+    return LAYOUTS[orientation](width, height, count)
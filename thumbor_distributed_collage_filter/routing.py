@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Routing of the tiles across several thumbor servers. Each source image is
+consistently hashed to the same server, so its tiles hit the result storage
+and detector data that server already has, and adding or removing a server
+only moves the images of its neighbours on the ring. Servers failing
+repeatedly are ejected for a while.
+"""
+
+import time
+from bisect import bisect
+from collections import deque
+from hashlib import md5
+
+DEFAULT_REPLICAS = 100
+
+rings = {}
+health = {}
+
+
+def hash_key(key):
+    """Hash of `key` that is the same in every process."""
+    return int(md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Ring of `replicas` virtual nodes per server."""
+
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        self.nodes = list(nodes)
+        ring = sorted(
+            (hash_key("%s#%d" % (node, replica)), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in ring]
+        self.ring = [node for _, node in ring]
+
+    def get_nodes(self, key):
+        """
+        Returns every server, starting with the one owning `key` and followed
+        by the next ones on the ring, which take over its keys when it fails.
+        """
+        nodes = []
+        start = bisect(self.hashes, hash_key(key))
+        for index in range(len(self.ring)):
+            node = self.ring[(start + index) % len(self.ring)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == len(self.nodes):
+                    break
+        return nodes
+
+
+def get_ring(nodes):
+    key = tuple(nodes)
+    if key not in rings:
+        rings[key] = HashRing(key)
+    return rings[key]
+
+
+class NodeHealth(object):
+    """
+    Failures of a server in the last `window` seconds. After `max_failures`
+    of them the server is ejected for `eject_seconds`.
+    """
+
+    def __init__(self, max_failures, window, eject_seconds, clock=time.monotonic):
+        self.max_failures = max_failures
+        self.window = window
+        self.eject_seconds = eject_seconds
+        self.clock = clock
+        self.failures = deque()
+        self.ejected_until = 0
+        self.ejections = 0
+
+    @property
+    def healthy(self):
+        return self.clock() >= self.ejected_until
+
+    def success(self):
+        self.failures.clear()
+
+    def failure(self):
+        """Records a failure, returning True if it ejected the server."""
+        now = self.clock()
+        self.failures.append(now)
+        while self.failures and self.failures[0] <= now - self.window:
+            self.failures.popleft()
+
+        if len(self.failures) < self.max_failures:
+            return False
+
+        self.failures.clear()
+        self.ejected_until = now + self.eject_seconds
+        self.ejections += 1
+        return True
+
+
+def get_health(node, config):
+    if node not in health:
+        health[node] = NodeHealth(
+            getattr(config, "DISTRIBUTED_COLLAGE_FILTER_EJECT_FAILURES", 5),
+            getattr(config, "DISTRIBUTED_COLLAGE_FILTER_EJECT_WINDOW", 10),
+            getattr(config, "DISTRIBUTED_COLLAGE_FILTER_EJECT_SECONDS", 30),
+        )
+    return health[node]
+
+
+def route(nodes, key, config):
+    """
+    Returns `nodes` in the order the tile of the source image `key` should
+    be requested to them, leaving the ejected ones out (unless every one of
+    them is ejected).
+    """
+    if len(nodes) < 2:
+        return list(nodes)
+
+    ordered = get_ring(nodes).get_nodes(key)
+    healthy = [node for node in ordered if get_health(node, config).healthy]
+    return healthy or ordered
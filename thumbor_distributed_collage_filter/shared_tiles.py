@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Table of encoded tiles in a memory-mapped file, shared by every thumbor
+process of a host that maps the same file.
+
+The file holds a header, the clock hand of each set and a fixed number of
+slots of the same size. Each key hashes to a set of `ways` consecutive
+slots. Reads take no lock: every slot starts with a sequence number that
+is odd while the slot is written, and a read is only kept if the number
+was even and the same before and after copying the slot. Writes lock the
+byte of their set with fcntl, so writers of different sets never wait for
+each other. A full set evicts with the clock algorithm: readers mark the
+slots they hit, and the hand skips (and unmarks) marked slots once.
+"""
+
+import fcntl
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import time
+from hashlib import md5
+
+from thumbor.utils import logger
+
+MAGIC = b"DCTILES1"
+# magic, slots, slot size, ways
+FILE_HEADER = struct.Struct("<8sIII")
+# sequence, key digest, expiration (epoch seconds), length, referenced
+SLOT_HEADER = struct.Struct("<I16sdIB")
+SEQUENCE = struct.Struct("<I")
+SLOT_HEADER_SIZE = 64
+REFERENCED_OFFSET = 4 + 16 + 8 + 4
+
+DEFAULT_SLOTS = 512
+DEFAULT_SLOT_SIZE = 128 * 1024
+DEFAULT_WAYS = 8
+READ_ATTEMPTS = 3
+
+tables = {}
+
+
+def get_default_path():
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "thumbor-distributed-collage-tiles-%d" % os.getuid())
+
+
+class SharedTileTable(object):
+    """
+    `slots` values of at most `slot_size` bytes, in sets of `ways` slots,
+    mapped from the file at `path`. Every process must map it with the same
+    sizes, a file created with other sizes raises ValueError.
+
+    Its tiles are sent as they are read, so the file must be a regular file
+    of the current user that no one else may read or write: a symbolic
+    link raises OSError and any other file raises ValueError.
+    """
+
+    def __init__(self, path, slots, slot_size, ways=DEFAULT_WAYS):
+        self.path = path
+        self.ways = max(min(ways, slots), 1)
+        self.sets = max(slots // self.ways, 1)
+        self.slots = self.sets * self.ways
+        self.slot_size = slot_size
+        self.stride = SLOT_HEADER_SIZE + slot_size
+        self.hands_offset = FILE_HEADER.size
+        self.slots_offset = self.hands_offset + self.sets
+        self.size = self.slots_offset + self.slots * self.stride
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            self._check_owner()
+            self._initialize()
+        except ValueError:
+            os.close(self.fd)
+            raise
+        self.map = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED)
+
+    def _check_owner(self):
+        info = os.fstat(self.fd)
+        if not stat.S_ISREG(info.st_mode):
+            raise ValueError("%s is not a regular file" % self.path)
+        if info.st_uid != os.getuid():
+            raise ValueError("%s belongs to another user" % self.path)
+        if info.st_mode & 0o077:
+            raise ValueError("%s is open to other users" % self.path)
+
+    def _initialize(self):
+        header = FILE_HEADER.pack(MAGIC, self.slots, self.slot_size, self.ways)
+        # the byte of the header is not the byte of any set
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            current = os.pread(self.fd, FILE_HEADER.size, 0)
+            if current == header and os.fstat(self.fd).st_size == self.size:
+                return
+
+            # other processes may have it mapped, so it is never resized
+            if current.strip(b"\0"):
+                raise ValueError(
+                    "%s was created with other sizes than %d slots of %d bytes"
+                    % (self.path, self.slots, self.slot_size)
+                )
+            os.ftruncate(self.fd, self.size)
+            os.pwrite(self.fd, header, 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+
+    def _get_set(self, digest):
+        return int.from_bytes(digest[:8], "little") % self.sets
+
+    def _get_offset(self, slot):
+        return self.slots_offset + slot * self.stride
+
+    def _read_slot(self, offset):
+        """Returns a consistent copy of the header and the value of a slot."""
+        for _ in range(READ_ATTEMPTS):
+            before = SEQUENCE.unpack_from(self.map, offset)[0]
+            if before % 2:
+                continue
+
+            header = SLOT_HEADER.unpack_from(self.map, offset)
+            length = min(header[3], self.slot_size)
+            value = self.map[
+                offset + SLOT_HEADER_SIZE : offset + SLOT_HEADER_SIZE + length
+            ]
+            if SEQUENCE.unpack_from(self.map, offset)[0] == before:
+                return header, value
+        return None, None
+
+    def get(self, key, now=None):
+        digest = md5(key.encode("utf-8")).digest()
+        now = time.time() if now is None else now
+        first = self._get_set(digest) * self.ways
+
+        for slot in range(first, first + self.ways):
+            offset = self._get_offset(slot)
+            header, value = self._read_slot(offset)
+            if header is None or header[1] != digest:
+                continue
+            if header[2] <= now:
+                return None
+
+            if not header[4]:
+                self.map[offset + REFERENCED_OFFSET] = 1
+            return value
+        return None
+
+    def put(self, key, value, ttl, now=None):
+        if ttl <= 0 or len(value) > self.slot_size:
+            return False
+
+        digest = md5(key.encode("utf-8")).digest()
+        now = time.time() if now is None else now
+        index = self._get_set(digest)
+        lock_offset = self.hands_offset + index
+
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, lock_offset)
+        try:
+            slot = self._get_victim(index, digest, now)
+            offset = self._get_offset(slot)
+            sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+
+            SEQUENCE.pack_into(self.map, offset, sequence + 1)
+            self.map[
+                offset + SLOT_HEADER_SIZE : offset + SLOT_HEADER_SIZE + len(value)
+            ] = value
+            SLOT_HEADER.pack_into(
+                self.map, offset, sequence + 1, digest, now + ttl, len(value), 0
+            )
+            SEQUENCE.pack_into(self.map, offset, sequence + 2)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, lock_offset)
+        return True
+
+    def _get_victim(self, index, digest, now):
+        """
+        Returns the slot of the set `index` to write `digest` to: its own
+        slot, an empty or expired one, or the next unmarked one after the
+        clock hand of the set.
+        """
+        first = index * self.ways
+        for slot in range(first, first + self.ways):
+            _, slot_digest, expires, length, _ = SLOT_HEADER.unpack_from(
+                self.map, self._get_offset(slot)
+            )
+            if slot_digest == digest or not length or expires <= now:
+                return slot
+
+        hand_offset = self.hands_offset + index
+        hand = self.map[hand_offset] % self.ways
+        for step in range(2 * self.ways):
+            way = (hand + step) % self.ways
+            referenced = self._get_offset(first + way) + REFERENCED_OFFSET
+            if not self.map[referenced]:
+                self.map[hand_offset] = (way + 1) % self.ways
+                return first + way
+            self.map[referenced] = 0
+        return first + hand
+
+    def clear(self):
+        for slot in range(self.slots):
+            offset = self._get_offset(slot)
+            SLOT_HEADER.pack_into(
+                self.map,
+                offset,
+                SEQUENCE.unpack_from(self.map, offset)[0] + 2,
+                b"\0" * 16,
+                0,
+                0,
+                0,
+            )
+
+    def stats(self):
+        used = 0
+        for slot in range(self.slots):
+            if SLOT_HEADER.unpack_from(self.map, self._get_offset(slot))[3]:
+                used += 1
+        return {
+            "path": self.path,
+            "slots": self.slots,
+            "slot_size": self.slot_size,
+            "used": used,
+        }
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def get_shared_table(config):
+    """
+    Returns the table of the process, None if its file cannot be mapped
+    (see DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_PATH).
+    """
+    path = (
+        getattr(config, "DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_PATH", None)
+        or get_default_path()
+    )
+    slots = getattr(
+        config, "DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_SLOTS", DEFAULT_SLOTS
+    )
+    slot_size = getattr(
+        config,
+        "DISTRIBUTED_COLLAGE_FILTER_SHARED_TILE_CACHE_SLOT_SIZE",
+        DEFAULT_SLOT_SIZE,
+    )
+    key = (path, slots, slot_size)
+    if key not in tables:
+        try:
+            tables[key] = SharedTileTable(path, slots, slot_size)
+        except (OSError, ValueError) as err:
+            logger.error(
+                "filters.distributed_collage: Shared tile cache disabled: %s" % err
+            )
+            tables[key] = None
+    return tables[key]
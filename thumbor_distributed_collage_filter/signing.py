@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Signed paths of the tiles requested to the thumbor server. The signer of
+each security key and the paths of the last signed tiles are shared by
+every request of the process, so hot collages are not signed again.
+"""
+
+from libthumbor import CryptoURL
+
+from thumbor_distributed_collage_filter.cache import get_shared_cache
+
+DEFAULT_SIGNED_PATHS_SIZE = 1024
+
+signers = {}
+
+
+def get_signer(security_key):
+    if security_key not in signers:
+        signers[security_key] = CryptoURL(key=security_key)
+    return signers[security_key]
+
+
+def get_params_key(params):
+    return tuple(
+        sorted(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in params.items()
+        )
+    )
+
+
+def sign(security_key, params, max_size=DEFAULT_SIGNED_PATHS_SIZE):
+    """
+    Returns the signed thumbor path of a tile. The last `max_size` paths
+    are kept in memory (0 signs every tile again).
+    """
+    if not max_size:
+        return get_signer(security_key).generate(**params)
+
+    paths = get_shared_cache("signed_paths", max_size)
+    key = (security_key, get_params_key(params))
+    path = paths.get(key)
+    if path is None:
+        path = get_signer(security_key).generate(**params)
+        paths.put(key, path, 1, float("inf"))
+    return path
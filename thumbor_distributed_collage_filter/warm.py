@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of thumbor-distributed-collage-filter.
+# https://github.com/globocom/thumbor-distributed-collage-filter
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2018, Globo.com <thumbor@corp.globo.com>
+
+"""
+Pre-renders the tiles of collages before they are requested, e.g. before
+a page launch, so their first requests hit warm caches. The tiles are the
+exact ones the filter would load with the same thumbor configuration:
+they are requested to the thumbor servers (filling their RESULT_STORAGE
+and detector data) or rendered in this process, and kept in the tile
+cache of the configuration. Collages with an "image" are then requested
+too, filling the result storage of the collage itself.
+
+Each line of the input is a JSON collage spec:
+
+    {"urls": ["a.jpg", "b.jpg"], "width": 300, "height": 200,
+     "orientation": "horizontal", "alignment": "smart", "image": "base.png"}
+
+and each line of the output reports one of them, as JSON too.
+
+    thumbor-collage-warm [-c thumbor.conf] [-s http://thumbor:8888]...
+                         [--in-process] [-j CONCURRENCY] [SPECS]
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from thumbor.config import Config
+from thumbor.context import Context, RequestParameters, ServerParameters
+from thumbor.importer import Importer
+from thumbor.loaders import LoaderResult
+from tornado.httpclient import AsyncHTTPClient
+
+from thumbor_distributed_collage_filter.filter import Filter
+from thumbor_distributed_collage_filter.layout import LAYOUTS
+from thumbor_distributed_collage_filter.signing import get_signer
+
+DEFAULT_CONCURRENCY = 4
+
+# extension and quality of each DISTRIBUTED_COLLAGE_FILTER_TILE_FORMAT,
+# as the tile server encodes them (see Filter.TILE_FORMATS)
+TILE_ENCODINGS = {
+    "jpeg": (".jpg", 100),
+    "png": (".png", None),
+    "webp": (".webp", 100),
+}
+
+
+def parse_spec(line):
+    """Returns the collage spec of a line, raising ValueError if it is invalid."""
+    spec = json.loads(line)
+    if not isinstance(spec, dict):
+        raise ValueError("a spec must be an object")
+
+    urls = spec.get("urls")
+    if isinstance(urls, str):
+        urls = urls.split("|")
+    if not urls:
+        raise ValueError("a spec must have urls")
+
+    width, height = spec.get("width"), spec.get("height")
+    if not isinstance(width, int) or not isinstance(height, int):
+        raise ValueError("a spec must have an integer width and height")
+    if width <= 0 or height <= 0:
+        raise ValueError("the width and height of a spec must be positive")
+
+    return {
+        "urls": list(urls),
+        "width": width,
+        "height": height,
+        "orientation": spec.get("orientation", "horizontal"),
+        "alignment": spec.get("alignment", "smart"),
+        "image": spec.get("image"),
+    }
+
+
+def read_specs(lines):
+    """Yields (index, spec or None, error or None) of the non-empty lines."""
+    for index, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            yield index, parse_spec(line), None
+        except ValueError as err:
+            yield index, None, str(err)
+
+
+def get_context(config, security_key):
+    importer = Importer(config)
+    importer.import_modules()
+    server = ServerParameters(None, None, None, None, "ERROR", None)
+    server.security_key = security_key
+    return Context(server, config, importer)
+
+
+def get_filter(context, spec):
+    """Returns the collage filter of `spec`, as if it was requested."""
+    spec_context = Context(
+        server=context.server,
+        config=context.config,
+        importer=context.modules.importer,
+    )
+    spec_context.request = RequestParameters(width=spec["width"], height=spec["height"])
+
+    if not hasattr(Filter, "regex"):
+        # compiled by thumbor when the filter is in FILTERS
+        Filter.pre_compile()
+    fltr = Filter("", spec_context)
+    fltr.orientation = fltr._get_option(spec["orientation"], LAYOUTS, "horizontal")
+    fltr.alignment = fltr._get_option(spec["alignment"], Filter.ALIGNMENTS, "smart")
+    fltr.urls = spec["urls"]
+    fltr.max_age = context.config.MAX_AGE
+    fltr.scale = 1
+    fltr.focal_point_store = fltr._get_focal_point_store()
+    fltr._calculate_dimensions()
+    return fltr
+
+
+def get_renderer(fltr):
+    """
+    Returns a tile loader rendering the tiles in this process and encoding
+    them in DISTRIBUTED_COLLAGE_FILTER_TILE_FORMAT, like a tile server.
+    """
+    tile_format = getattr(
+        fltr.context.config, "DISTRIBUTED_COLLAGE_FILTER_TILE_FORMAT", "jpeg"
+    )
+    extension, quality = TILE_ENCODINGS.get(tile_format, TILE_ENCODINGS["jpeg"])
+
+    async def render(params, validators=None):
+        result = await fltr._render_tile(params)
+        if not result.successful:
+            return result
+
+        engine = result.extras["engine"]
+        return LoaderResult(buffer=engine.read(extension, quality))
+
+    return render
+
+
+def get_collage_path(security_key, spec, width, height):
+    """Returns the signed thumbor path of the collage of `spec`."""
+    collage = "distributed_collage(%s,%s,%s)" % (
+        spec["orientation"],
+        spec["alignment"],
+        "|".join(spec["urls"]),
+    )
+    return get_signer(security_key).generate(
+        width=width, height=height, filters=[collage], image_url=spec["image"]
+    )
+
+
+async def warm(context, spec, in_process=False, client=None):
+    """
+    Loads the tiles of the collage of `spec` as the filter would and, with
+    a `client` and an "image" in the spec, requests the collage itself to
+    the first thumbor server. Returns the report of the spec.
+    """
+    start = time.perf_counter()
+    max_images = getattr(
+        context.config, "DISTRIBUTED_COLLAGE_FILTER_MAX_IMAGES", Filter.MAX_IMAGES
+    )
+    if len(spec["urls"]) > max_images:
+        # the filter rejects them too
+        return {
+            "urls": spec["urls"],
+            "error": "too many images",
+            "time_ms": round((time.perf_counter() - start) * 1000, 3),
+        }
+
+    fltr = get_filter(context, spec)
+    report = {"urls": spec["urls"], "width": fltr.width, "height": fltr.height}
+
+    reserved = await fltr._admit() if fltr._fit_budget() else None
+    if reserved is None:
+        report["error"] = "over the memory budget"
+        report["time_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        return report
+
+    try:
+        report["scale"] = fltr.scale
+        report["width"], report["height"] = fltr.width, fltr.height
+        tiles, fltr.sources = fltr._get_unique_tiles(fltr._get_tiles())
+        if in_process:
+            load_tile = fltr._get_tile_loader("local", get_renderer(fltr))
+        else:
+            tiles = await fltr._set_focal_points(tiles)
+            load_tile = fltr._get_tile_loader("http")
+
+        results = await fltr._load_images(load_tile, tiles, fail_fast=False)
+    finally:
+        fltr._release(reserved)
+
+    report["tiles"] = len(tiles)
+    report["failed"] = [
+        {"url": tile["image_url"], "error": result.error if result else "timeout"}
+        for tile, result in zip(tiles, results)
+        if result is None or not result.successful
+    ]
+
+    if client is not None and spec["image"]:
+        path = get_collage_path(
+            context.server.security_key, spec, spec["width"], spec["height"]
+        )
+        collage_start = time.perf_counter()
+        response = await client.fetch(
+            "%s%s" % (fltr._get_thumbor_servers()[0], path), raise_error=False
+        )
+        report["collage"] = {
+            "status": response.code,
+            "time_ms": round((time.perf_counter() - collage_start) * 1000, 3),
+        }
+
+    report["time_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return report
+
+
+def is_failure(report):
+    return bool(
+        report.get("error")
+        or report.get("failed")
+        or report.get("collage", {}).get("status", 200) != 200
+    )
+
+
+async def warm_all(context, specs, concurrency, in_process=False, output=None):
+    """
+    Warms the (index, spec, error) of `specs`, `concurrency` specs at a
+    time, writing the report of each one to `output` as a JSON line as soon
+    as it is done. Returns the number of failed specs.
+    """
+    output = output or sys.stdout
+    client = None
+    if not in_process:
+        client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def run(index, spec, error):
+        nonlocal failures
+        if error is None:
+            async with semaphore:
+                try:
+                    report = await warm(context, spec, in_process, client)
+                except Exception as err:
+                    report = {"urls": spec["urls"], "error": str(err)}
+        else:
+            report = {"error": error}
+
+        report = dict(report, line=index + 1)
+        if is_failure(report):
+            failures += 1
+        output.write(json.dumps(report, sort_keys=True) + "\n")
+        output.flush()
+
+    try:
+        await asyncio.gather(*[run(*entry) for entry in specs])
+    finally:
+        if client is not None:
+            client.close()
+    return failures
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="thumbor-collage-warm",
+        description="Pre-renders the tiles of distributed collages.",
+    )
+    parser.add_argument(
+        "specs",
+        nargs="?",
+        default="-",
+        help="file of JSON collage specs, one per line (stdin by default)",
+    )
+    parser.add_argument("-c", "--conf", help="thumbor configuration file")
+    parser.add_argument(
+        "-k",
+        "--security-key",
+        help="security key of the thumbor servers (SECURITY_KEY by default)",
+    )
+    parser.add_argument(
+        "-s",
+        "--server",
+        action="append",
+        dest="servers",
+        help="thumbor server rendering the tiles, may be repeated "
+        "(DISTRIBUTED_COLLAGE_FILTER_THUMBOR_SERVER_URL by default)",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="render the tiles in this process instead of a thumbor server",
+    )
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="collages warmed at the same time (default: %(default)s)",
+    )
+    return parser
+
+
+def main(args=None):
+    parser = get_parser()
+    options = parser.parse_args(args)
+
+    config = Config.load(options.conf) if options.conf else Config()
+    if options.servers:
+        config.DISTRIBUTED_COLLAGE_FILTER_THUMBOR_SERVER_URL = options.servers
+    if not options.in_process and not getattr(
+        config, "DISTRIBUTED_COLLAGE_FILTER_THUMBOR_SERVER_URL", None
+    ):
+        parser.error("a thumbor --server (or --in-process) is required")
+    context = get_context(config, options.security_key or config.SECURITY_KEY)
+
+    if options.specs == "-":
+        specs = list(read_specs(sys.stdin))
+    else:
+        with open(options.specs) as specs_file:
+            specs = list(read_specs(specs_file))
+
+    failures = asyncio.run(
+        warm_all(context, specs, max(options.concurrency, 1), options.in_process)
+    )
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())